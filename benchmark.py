@@ -0,0 +1,1696 @@
+import os
+import sys
+import time
+import hashlib
+import json
+import shutil
+import subprocess
+import argparse
+import builtins
+import tempfile
+import asyncio
+import contextlib
+import pathlib
+import re
+import random
+import collections
+import threading
+import mutagen
+import mutagen.id3
+import ytd
+import library
+import integrity
+import metadata_renamer
+
+"""
+Offline benchmarks for ytd.py, nothing here touches the network.
+
+usage:
+    python benchmark.py tags [--tracks N]
+        file opens and bytes written per track by the post-download tag chain,
+        old separate helpers vs the single TagSession
+    python benchmark.py engine [--tracks N] [--yt-dlp PATH]
+        per-track overhead of the subprocess and inprocess yt-dlp engines,
+        downloading local file:// URLs so only the engine overhead is measured
+    python benchmark.py library [--files N]
+        main()'s library scan on a synthetic library: full mutagen tag scan vs the header-only
+        reader, cold and warm index refresh, and checks that both readers agree
+    python benchmark.py postprocess [--tracks N]
+        per-track post-processing of process_audio() after ffmpeg (tags, move, index, lyrics)
+    python benchmark.py lyrics [--tracks N] [--provider-latency S]
+        the lyrics stage against a local fake provider, and checks of the cache: hits,
+        cached and expired misses, failed searches not cached, bounded submit()
+    python benchmark.py renamer [--files N] [--threads N]
+        metadata_renamer.main() on a synthetic library, against the old one-file-at-a-time renamer
+    python benchmark.py titles [--titles N]
+        clean_title() on synthetic YouTube titles, the old replace loop vs the compiled title rules
+    python benchmark.py art [--tracks N] [--albums N] [--fetch-latency S] [--ffmpeg PATH]
+        thumbnail fetch and square crop per track: a fetch and an ffmpeg spawn
+        per track vs the art cache shared by the tracks of an album
+    python benchmark.py pipeline [--tracks N] [--threads 1,4,8,16] [--download-latency S] [--transcode-latency S]
+        end-to-end throughput of run_pipeline() with fake yt-dlp and ffmpeg at several thread counts
+    python benchmark.py adaptive [--tracks N] [--threads N] [--throttle-above N] [--download-latency S] [--repeats N]
+        fixed vs adaptive download concurrency against a fake yt-dlp that answers
+        429 above a number of concurrent downloads
+    python benchmark.py startup [--files N] [--update-latency S]
+        wall-clock time of a run with nothing to download, from the interpreter start to the end of main():
+        the old synchronous yt-dlp -U and eager imports, a run with the update check due, and a run
+        within update_check_hours, with checks that the no-op run is fast and imports no lyrics or tag modules
+    python benchmark.py orphans [--files N] [--orphans N]
+        finding the files in Songs that are not in the input, the old list lookups vs the set
+        difference, and checks of orphan_policy keep, quarantine and delete
+    python benchmark.py failures [--tracks N] [--failing N] [--download-latency S]
+        two syncs of an input with private, removed and flaky videos: the second one skips the
+        videos in the failure cache, with checks of the classes, backoff, expiry and clearing
+    python benchmark.py duplicates [--tracks N] [--duplicate-every N] [--download-latency S]
+        a playlist where every Nth video is another upload of the song before it, synced with
+        duplicate_policy=off and skip, with checks of the song keys and the library lookup
+    python benchmark.py queue [--tracks N] [--workers N] [--lease S] [--download-latency S]
+        a --coordinator and 1 vs N --worker processes sharing Songs and the job queue, one of the
+        N workers killed mid-download, with checks that its jobs are finished by the others, and
+        2 workers at the default sizes, with checks that neither claims more than it can start soon
+    python benchmark.py api [--files N] [--requests N] [--tracks N] [--download-latency S]
+        the same no-op sync request with an exe start per request vs a warm Downloader, and checks of
+        concurrent syncs into two libraries, shared downloads, backpressure and closing a sync early
+    python benchmark.py verify [--files N] [--frames N] [--processes N]
+        --verify on a synthetic library with truncated and corrupt MP3s, one process vs a process pool
+        vs the cached results, with checks of what is found, the cache and the downloads of the broken files
+    python benchmark.py staging [--tracks N] [--latency S] [--download-latency S]
+        a sync into a Songs directory as slow as a network share, tagged there vs staged locally and
+        copied over in batches, with checks that every song is written once, nothing is read back and
+        the index mirror stays local, and of a failed copy being finished by the next run
+    python benchmark.py all
+        everything above except engine, with small sizes
+
+The library, postprocess and pipeline benchmarks replace yt_dlp_path and
+ffmpeg_path with stand-ins that write valid tagged MP3s after a configurable delay.
+"""
+
+
+
+
+
+# SYNTHETIC FILES ================================================
+def make_mp3(path, artist="Artist", title="Title", url=None, frames=200, art_size=100_000, lyrics=None, extra_tags=False, date="2024"):
+    """
+    Write a small but valid MP3 (silent MPEG-1 Layer III frames) with ID3 tags.
+
+    extra_tags adds the frames yt-dlp's --embed-metadata leaves behind
+    (encoder, comment, purl, description) so the cleanup has something to do.
+    """
+    frame = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413) # 128 kbit/s, 44.1 kHz, 417 bytes
+    with open(path, "wb") as f:
+        f.write(frame * frames)
+
+    tags = mutagen.id3.ID3()
+    tags.add(mutagen.id3.TPE1(encoding=3, text=artist))
+    tags.add(mutagen.id3.TIT2(encoding=3, text=title))
+    tags.add(mutagen.id3.TALB(encoding=3, text=f"{artist} Album"))
+    tags.add(mutagen.id3.TDRC(encoding=3, text=date))
+    if art_size:
+        tags.add(mutagen.id3.APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=b"\xff\xd8" + bytes(art_size)))
+    if lyrics:
+        tags.add(mutagen.id3.USLT(encoding=3, lang="eng", desc="Lyrics", text=lyrics))
+    if url:
+        tags.add(mutagen.id3.WXXX(encoding=3, desc="MusicVideoURL", url=url))
+    if extra_tags:
+        tags.add(mutagen.id3.TSSE(encoding=3, text="Lavf61.1.100"))
+        tags.add(mutagen.id3.COMM(encoding=3, lang="eng", desc="", text="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+        tags.add(mutagen.id3.TXXX(encoding=3, desc="purl", text="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+        tags.add(mutagen.id3.TXXX(encoding=3, desc="description", text="Official video description " * 40))
+    tags.save(path)
+    return path
+
+
+
+
+
+
+
+
+
+def make_jpeg(path, size=(480, 360)):
+    """ Write a real JPEG thumbnail (needs Pillow), or JPEG-looking bytes without it. """
+    try:
+        from PIL import Image
+        Image.new("RGB", size, (200, 30, 60)).save(path, "JPEG")
+    except ImportError:
+        with open(path, "wb") as f:
+            f.write(b"\xff\xd8\xff\xe0" + bytes(20_000) + b"\xff\xd9")
+    return path
+
+ARTISTS = ["Daft Punk", "Rick Astley", "Björk", "The Beatles", "Queen", "Rosalía", "AC/DC", "Eminem", "Sigur Rós", "ABBA"]
+WORDS = ["Love", "Night", "Star", "Fire", "Dream", "Heart", "Road", "Rain", "Gold", "Ocean", "Ghost", "City"]
+SUFFIXES = ["", " (Official Video)", " (Official Audio)", " (Official Lyric Video)", " [4K]", " (Live)"]
+
+def random_title(rng, i):
+    """ A YouTube-looking "Artist - Title (Official Video)" title. """
+    artist = rng.choice(ARTISTS)
+    words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+    return artist, f"{artist} - {words} {i}{rng.choice(SUFFIXES)}"
+
+def make_library(path, files, art_size=30_000, lyrics_lines=40, frames=20, seed=0):
+    """
+    Fill a directory with a synthetic library like the one ytd.py builds:
+    "artist - title.mp3" files with ID3 tags, cover art, lyrics and the MusicVideoURL frame.
+    Dates are a year, a full date or yt-dlp's upload_date (YYYYMMDD), which older versions wrote.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    lyrics = "".join(f"[00:{i:02d}.00] line {i} of the song\n" for i in range(lyrics_lines))
+    for i in range(files):
+        artist, title = random_title(rng, i)
+        title = ytd.clean_title(title, artist)
+        make_mp3(os.path.join(path, f"{artist.replace('/', '')} - {title}.mp3"), artist, title,
+                 url=ytd.video_url(f"vid{i:08d}"), frames=frames, art_size=art_size, lyrics=lyrics,
+                 date=("2024", "2024-03-01", "20240301")[i % 3])
+    return path
+
+
+
+
+
+
+
+
+
+# FAKE TOOLS ================================================
+# Stand-ins for yt-dlp and ffmpeg, only the arguments ytd.py uses are understood.
+# Delays and sizes come from environment variables so the benchmark can tune them.
+
+FAKE_YT_DLP = """
+import os, sys, json, time
+from urllib.parse import urlparse, parse_qs
+
+def song(video_id):
+    # "<id>dup" is another upload (a lyric video) of the same song as "<id>"
+    base = video_id[:-3] if video_id.endswith("dup") else video_id
+    n = int(base[-4:], 36) if len(base) >= 4 and base[-4:].isalnum() else 0
+    suffix = " (Official Lyric Video)" if base != video_id else " (Official Video)"
+    return {"id": video_id, "title": f"Fake Artist {n % 50} - Song {base}{suffix}", "uploader": f"Fake Artist {n % 50}", "duration": 200 + n % 60}
+
+args = sys.argv[1:]
+if args == ["-U"]:
+    time.sleep(float(os.environ.get("YTD_FAKE_UPDATE_LATENCY", "0")))
+    print("yt-dlp is up to date")
+    sys.exit(0)
+url = args[-1]
+query = parse_qs(urlparse(url).query)
+if "--flat-playlist" in args:
+    duplicate_every = int(os.environ.get("YTD_FAKE_DUPLICATE_EVERY", "0"))
+    for i in range(int(os.environ.get("YTD_FAKE_PLAYLIST_SIZE", "100"))):
+        video_id = f"{query['list'][0]}{i:06d}"
+        if duplicate_every and i % duplicate_every == duplicate_every - 1:
+            video_id = f"{query['list'][0]}{i - 1:06d}dup"
+        print(json.dumps(song(video_id)) if "--print" in args else video_id, flush=True)
+    sys.exit(0)
+
+video_id = query.get("v", [os.path.basename(urlparse(url).path)])[0]
+if video_id.startswith("private"):
+    sys.exit("ERROR: [youtube] " + video_id + ": Private video. Sign in if you've been granted access to this video")
+if video_id.startswith("removed"):
+    sys.exit("ERROR: [youtube] " + video_id + ": Video unavailable. This video has been removed by the uploader")
+if video_id.startswith("flaky") and not os.environ.get("YTD_FAKE_FLAKY_OK"):
+    sys.exit("ERROR: [youtube] " + video_id + ": Unable to download webpage: <urlopen error [Errno 104] Connection reset by peer>")
+# answer 429 when more than YTD_FAKE_THROTTLE_ABOVE downloads run at the same time
+active_dir = os.environ.get("YTD_FAKE_ACTIVE_DIR")
+if active_dir:
+    marker = os.path.join(active_dir, str(os.getpid()))
+    open(marker, "w").close()
+    if len(os.listdir(active_dir)) > int(os.environ["YTD_FAKE_THROTTLE_ABOVE"]):
+        os.remove(marker)
+        sys.exit("ERROR: [youtube] " + video_id + ": Unable to download webpage: HTTP Error 429: Too Many Requests")
+time.sleep(float(os.environ.get("YTD_FAKE_DOWNLOAD_LATENCY", "0")))
+if active_dir:
+    os.remove(marker)
+folder = args[args.index("-P") + 1]
+audio = os.path.join(folder, video_id + ".webm")
+with open(audio, "wb") as f:
+    f.write(os.urandom(int(os.environ.get("YTD_FAKE_AUDIO_SIZE", "200000"))))
+n = int(video_id[-4:], 36) if len(video_id) >= 4 and video_id[-4:].isalnum() else 0
+# the duration of the audio the fake ffmpeg writes, not the listed one
+duration = int(os.environ.get("YTD_FAKE_FRAMES", "200")) * 1152 / 44100
+print(json.dumps(dict(song(video_id), filepath=audio, duration=duration, upload_date="20240101", thumbnail=f"https://example.invalid/album{n % 10}.jpg")))
+"""
+
+FAKE_FFMPEG = """
+import os, sys, time
+import mutagen.id3
+
+args = sys.argv[1:]
+time.sleep(float(os.environ.get("YTD_FAKE_TRANSCODE_LATENCY", "0")))
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == "-i"]
+metadata = dict(args[i + 1].split("=", 1) for i, arg in enumerate(args) if arg == "-metadata")
+output = args[-1]
+
+frame = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)
+with open(output, "wb") as f:
+    f.write(frame * int(os.environ.get("YTD_FAKE_FRAMES", "200")))
+tags = mutagen.id3.ID3()
+for key, frame_type in (("title", mutagen.id3.TIT2), ("artist", mutagen.id3.TPE1), ("album", mutagen.id3.TALB), ("date", mutagen.id3.TDRC)):
+    if key in metadata:
+        tags.add(frame_type(encoding=3, text=metadata[key]))
+tags.add(mutagen.id3.TSSE(encoding=3, text="Lavf61.1.100"))
+tags.save(output)
+"""
+
+def install_fake_tools(work_dir, download_latency=0.0, transcode_latency=0.0):
+    """ Point ytd at fake yt-dlp and ffmpeg executables in work_dir, with a thumbnail fetcher and lyrics provider that stay offline. """
+    for name, source in (("fake_yt_dlp.py", FAKE_YT_DLP), ("fake_ffmpeg.py", FAKE_FFMPEG)):
+        with open(os.path.join(work_dir, name), "w") as f:
+            f.write(source)
+    run = ytd.default_run
+    # in the params too, so they survive setup()
+    run.params["yt_dlp_path"] = run.yt_dlp_path = make_shim(os.path.join(work_dir, "yt-dlp"), [sys.executable, os.path.join(work_dir, "fake_yt_dlp.py")])
+    run.params["ffmpeg_path"] = run.ffmpeg_path = make_shim(os.path.join(work_dir, "ffmpeg"), [sys.executable, os.path.join(work_dir, "fake_ffmpeg.py")])
+    run.params["engine"] = "subprocess"
+    run.engine = None
+    os.environ["YTD_FAKE_DOWNLOAD_LATENCY"] = str(download_latency)
+    os.environ["YTD_FAKE_TRANSCODE_LATENCY"] = str(transcode_latency)
+    ytd.art_fetcher = fake_art_fetcher(work_dir, 0.0)
+    ytd.lyrics_provider = lambda artist, title: None # no lyrics searches on the network
+
+def fake_art_fetcher(work_dir, latency):
+    """ art_fetcher stand-in: one JPEG per album URL after a delay, counts its calls in .calls. """
+    def fetch(url):
+        fetch.calls += 1
+        time.sleep(latency)
+        name = hashlib.sha1(url.encode()).hexdigest()[:8]
+        path = os.path.join(work_dir, f"thumbnail_{name}.jpg")
+        if not os.path.exists(path):
+            make_jpeg(path, (480 + int(name, 16) % 64, 360))
+        with open(path, "rb") as f:
+            return f.read()
+    fetch.calls = 0
+    return fetch
+
+def use_directories(work_dir):
+    """ Point ytd's Songs, Temp and cache directories into work_dir. """
+    run = ytd.default_run
+    run.songs_path = os.path.join(work_dir, "Songs")
+    run.temp_path = os.path.join(work_dir, "temp")
+    run.cache_path = os.path.join(work_dir, "cache")
+    for path in (run.songs_path, run.temp_path, run.cache_path):
+        os.makedirs(path, exist_ok=True)
+
+class quiet:
+    """ Silence the console output of ytd and metadata_renamer. """
+    def __enter__(self):
+        ytd.print = metadata_renamer.print = lambda *a, **k: None
+        return self
+
+    def __exit__(self, *exc):
+        del ytd.print, metadata_renamer.print
+
+
+
+
+
+
+
+
+
+# MEASURING ================================================
+class CountingFile:
+    """ Wraps a file object and counts the bytes written through it. """
+    def __init__(self, fileobj, counter):
+        self._fileobj = fileobj
+        self._counter = counter
+
+    def write(self, data):
+        self._counter.bytes_written += len(data)
+        return self._fileobj.write(data)
+
+    def __enter__(self):
+        self._fileobj.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._fileobj.__exit__(*exc)
+
+    def __iter__(self):
+        return iter(self._fileobj)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class IOCounter:
+    """ Counts open() calls and bytes written for one path while active. """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.opens = 0
+        self.bytes_written = 0
+        self._open = builtins.open
+
+    def _counting_open(self, file, *args, **kwargs):
+        fileobj = self._open(file, *args, **kwargs)
+        if isinstance(file, (str, bytes, os.PathLike)) and os.path.abspath(file) == self.path:
+            self.opens += 1
+            return CountingFile(fileobj, self)
+        return fileobj
+
+    def __enter__(self):
+        builtins.open = self._counting_open
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self._open
+
+
+class SlowFile:
+    """ A file of a SlowShare: every read and write waits a tenth of the share's latency. """
+    def __init__(self, fileobj, share):
+        self._fileobj = fileobj
+        self._share = share
+
+    def read(self, *args):
+        time.sleep(self._share.latency / 10)
+        return self._fileobj.read(*args)
+
+    def readinto(self, buffer):
+        time.sleep(self._share.latency / 10)
+        return self._fileobj.readinto(buffer)
+
+    def write(self, data):
+        time.sleep(self._share.latency / 10)
+        return self._fileobj.write(data)
+
+    def __enter__(self):
+        self._fileobj.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._fileobj.__exit__(*exc)
+
+    def __iter__(self):
+        return iter(self._fileobj)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class SlowShare:
+    """
+    Makes the files in a directory about as slow as on a network share while active: every open()
+    waits latency seconds. Counts the opens for reading and for writing.
+    """
+    def __init__(self, path, latency):
+        self.path = os.path.abspath(path) + os.sep
+        self.latency = latency
+        self.reads = 0
+        self.writes = 0
+        self._open = builtins.open
+
+    def _slow_open(self, file, mode="r", *args, **kwargs):
+        fileobj = self._open(file, mode, *args, **kwargs)
+        if isinstance(file, (str, os.PathLike)) and os.path.abspath(file).startswith(self.path):
+            time.sleep(self.latency)
+            if any(flag in mode for flag in "wax+"):
+                self.writes += 1
+            else:
+                self.reads += 1
+            return SlowFile(fileobj, self)
+        return fileobj
+
+    def __enter__(self):
+        builtins.open = self._slow_open
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self._open
+
+
+def make_shim(path, command):
+    """ Write a small executable that runs command followed by its own arguments. """
+    if os.name == "nt":
+        path += ".bat"
+        with open(path, "w") as f:
+            f.write("@" + " ".join(f'"{part}"' for part in command) + " %*\n")
+    else:
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec " + " ".join(f"'{part}'" for part in command) + ' "$@"\n')
+        os.chmod(path, 0o755)
+    return path
+
+
+def report(name, timings, **values):
+    """ Print one benchmark result line. """
+    timings = sorted(timings)
+    per_item = sum(timings) / len(timings) * 1000
+    extra = "  ".join(f"{key}={value}" for key, value in values.items())
+    print(f"{name:<28} {per_item:9.2f} ms/item  (n={len(timings)})  {extra}")
+
+def timed(function, *args):
+    """ Run function once, returns (seconds, result). """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+
+
+
+
+
+
+
+# BENCHMARKS ================================================
+def legacy_tag_chain(path, url):
+    """ The post-download chain as it used to be: every helper opens the file on its own. """
+    # delete_unwanted_metadata()
+    audio = mutagen.File(path, easy=True)
+    for tag in [tag for tag in audio.keys() if tag not in ('artist', 'title', 'album', 'date')]:
+        del audio[tag]
+    audio.save()
+    # fix_title(), which read the tags twice before writing the title
+    title = mutagen.File(path, easy=True).tags.get('title', ['Unknown Title'])[0]
+    artist = mutagen.File(path, easy=True).tags.get('artist', ['Unknown Artist'])[0]
+    audio = mutagen.File(path, easy=True)
+    audio['title'] = legacy_clean_title(title, artist)
+    audio.save()
+    # read_metadata()
+    mutagen.File(path, easy=True)
+    # fetch_lyrics(), with the lyrics provider bench_tags sets up instead of syncedlyrics.search()
+    tags = mutagen.File(path, easy=True).tags
+    lyrics = ytd.lyrics_provider(tags.get('artist', ['Unknown Artist'])[0], tags.get('title', ['Unknown Title'])[0])
+    tags = mutagen.id3.ID3(path)
+    tags.add(mutagen.id3.USLT(encoding=3, lang='eng', desc='Lyrics', text=lyrics))
+    tags.save()
+    # write_url_metadata() and read_url_metadata()
+    tags = mutagen.id3.ID3(path)
+    tags.add(mutagen.id3.WXXX(encoding=3, desc="MusicVideoURL", url=url))
+    tags.save()
+    next((tag.url for tag in mutagen.id3.ID3(path).getall("WXXX") if tag.desc == "MusicVideoURL"), None)
+
+def session_tag_chain(path, url, lyrics_cache):
+    """ The post-download chain as it runs now: one TagSession, then the lyrics stage. """
+    session = ytd.TagSession(path)
+    session.delete_unwanted()
+    session.set("title", ytd.clean_title(session.title, session.artist))
+    session.metadata()
+    session.set_url(url)
+    session.save()
+    session.get_url()
+    ytd.embed_lyrics(path, lyrics_cache)
+
+def bench_tags(args):
+    ytd.lyrics_provider = lambda artist, title: "[00:01.00] la la la\n" * 40 # no network
+    ytd.print = lambda *a, **k: None # keep the output readable
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    lyrics_cache = ytd.LyricsCache(os.path.join(work_dir, "lyrics.sqlite"), 0)
+    chains = (("separate helpers", legacy_tag_chain),
+              ("tag session + lyrics", lambda path, url: session_tag_chain(path, url, lyrics_cache)))
+    try:
+        for name, chain in chains:
+            timings, opens, written = [], 0, 0
+            for i in range(args.tracks):
+                path = make_mp3(os.path.join(work_dir, f"{i}.mp3"), "Artist", f"Artist - Song {i} (Official Video)", extra_tags=True)
+                with IOCounter(path) as counter:
+                    start = time.perf_counter()
+                    chain(path, f"https://www.youtube.com/watch?v=video{i}")
+                    timings.append(time.perf_counter() - start)
+                opens += counter.opens
+                written += counter.bytes_written
+            report(name, timings, opens_per_track=f"{opens / args.tracks:.1f}", kb_written_per_track=f"{written / args.tracks / 1024:.0f}")
+    finally:
+        del ytd.print
+        lyrics_cache.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+
+
+
+
+
+
+def bench_engine(args):
+    yt_dlp = args.yt_dlp or (ytd.default_run.yt_dlp_path if os.path.exists(ytd.default_run.yt_dlp_path) else shutil.which("yt-dlp"))
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    ytd.default_run.temp_path = os.path.join(work_dir, "temp")
+    os.makedirs(ytd.default_run.temp_path)
+    # local files are only allowed with --enable-file-urls
+    ytd.default_run.yt_dlp_path = make_shim(os.path.join(work_dir, "yt-dlp"), [yt_dlp, "--enable-file-urls"])
+    youtube_dl_options = ytd.youtube_dl_options
+    ytd.youtube_dl_options = lambda flat=False: dict(youtube_dl_options(flat), enable_file_urls=True)
+    try:
+        sources = [make_mp3(os.path.join(work_dir, f"source{i}.mp3"), frames=2000) for i in range(args.tracks)]
+        for engine in ("subprocess", "inprocess"):
+            ytd.default_run.params["engine"] = engine
+            ytd.default_run.engine = None
+            timings = []
+            for source in sources:
+                start = time.perf_counter()
+                job = ytd.fetch_audio(pathlib.Path(source).as_uri())
+                timings.append(time.perf_counter() - start)
+                if job is None:
+                    sys.exit(f"{engine} engine failed, see the error above")
+                os.remove(job['audio'])
+            report(f"{ytd.get_engine()} engine", timings, first_track_ms=f"{timings[0] * 1000:.0f}")
+        check("one YoutubeDL of the Run's pool downloads every track", len(ytd.default_run.youtube_dls.instances) == 1, failures)
+    finally:
+        ytd.default_run.youtube_dls.close()
+        ytd.youtube_dl_options = youtube_dl_options
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} engine checks failed")
+
+
+
+
+
+
+
+
+
+def mutagen_entry(path):
+    """ read_entry() as it was before the header-only reader: every file fully parsed by mutagen. """
+    session = ytd.TagSession(path)
+    return dict(url=session.get_url(), **{key: session.get(key) for key in ("artist", "title", "album", "date")})
+
+def make_unusual_mp3s(path):
+    """ MP3s the header-only reader has to get right or hand over to mutagen. """
+    os.makedirs(path, exist_ok=True)
+    files = []
+    def tagged(name, encoding=3, **options):
+        file = make_mp3(os.path.join(path, name), "Ünusual Ärtist", "Tïtle", url=ytd.video_url(f"odd{len(files):05d}"), art_size=5000)
+        tags = mutagen.id3.ID3(file)
+        if encoding != 3:
+            for frame_type in (mutagen.id3.TPE1, mutagen.id3.TIT2):
+                tags.setall(frame_type.__name__, [frame_type(encoding=encoding, text=[tags[frame_type.__name__].text[0], "second value"])])
+            tags.setall("WXXX", [mutagen.id3.WXXX(encoding=encoding, desc="MusicVideoURL", url=tags.getall("WXXX")[0].url)])
+        tags.save(file, **options)
+        files.append(file)
+        return file
+    tagged("id3v23.mp3", v2_version=3)
+    tagged("latin1.mp3", encoding=0)
+    tagged("utf16.mp3", encoding=1)
+    tagged("utf16be.mp3", encoding=2)
+    file = tagged("id3v1.mp3", v1=2)
+    tags = mutagen.id3.ID3(file)
+    tags.delall("TALB")
+    tags.save(file, v1=1) # the album only left in the ID3v1 tag
+    file = tagged("slashed_date.mp3")
+    tags = mutagen.id3.ID3(file)
+    tags.setall("TDRC", [mutagen.id3.TDRC(encoding=3, text="2024-03-01")])
+    tags.save(file)
+    with open(file, "r+b") as f: # mutagen reads 2024/03/01 back as 2024-03-01
+        data = f.read()
+        f.seek(0)
+        f.write(data.replace(b"2024-03-01", b"2024/03/01", 1))
+    file = make_mp3(os.path.join(path, "untagged.mp3"), art_size=0)
+    mutagen.id3.ID3(file).delete()
+    files.append(file)
+    return files
+
+def bench_library(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    try:
+        songs = make_library(os.path.join(work_dir, "Songs"), args.files)
+        paths = [os.path.join(songs, file) for file in os.listdir(songs)]
+        with quiet():
+            seconds, slow = timed(lambda: [mutagen_entry(path) for path in paths])
+            report("mutagen tag scan", [seconds / args.files] * args.files)
+            seconds, fast = timed(lambda: [ytd.read_id3_fast(path) for path in paths])
+            report("header-only tag scan", [seconds / args.files] * args.files)
+            check("the header-only reader agrees with mutagen on every file", fast == slow, failures)
+            check("upload dates (YYYYMMDD) are read without mutagen", any(entry["date"] == "20240301" for entry in fast), failures)
+            odd = make_unusual_mp3s(os.path.join(work_dir, "odd"))
+            check("unusual files read the same as with mutagen", [library.read_entry(path) for path in odd] == [mutagen_entry(path) for path in odd], failures)
+            check("ID3v2.3, ID3v1 and dates mutagen rewrites are handed to mutagen",
+                  ytd.read_id3_fast(odd[0]) is None and ytd.read_id3_fast(odd[4]) is None and ytd.read_id3_fast(odd[5]) is None, failures)
+            index = ytd.LibraryIndex(songs)
+            seconds, _ = timed(index.refresh)
+            report("index refresh, cold", [seconds / args.files] * args.files)
+            seconds, _ = timed(index.refresh)
+            report("index refresh, warm", [seconds / args.files] * args.files)
+            index.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} library checks failed")
+
+def bench_postprocess(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    use_directories(work_dir)
+    ytd.lyrics_provider = lambda artist, title: "[00:01.00] la la la\n" * 40
+    ytd.default_run.library_index = ytd.LibraryIndex(ytd.default_run.songs_path)
+    cache = ytd.LyricsCache(os.path.join(ytd.default_run.cache_path, "lyrics.sqlite"), 0)
+    try:
+        timings = []
+        with quiet():
+            for i in range(args.tracks):
+                # a file as the transcode stage leaves it in Temp
+                path = make_mp3(os.path.join(ytd.default_run.temp_path, f"vid{i:08d}.mp3"), "Artist", f"Artist - Song {i} (Official Video)", extra_tags=True)
+                job = {"url": ytd.video_url(f"vid{i:08d}"), "stage": "transcoded", "file": path}
+                seconds, output_file = timed(ytd.process_audio, job)
+                lyrics_seconds, _ = timed(ytd.embed_lyrics, output_file, cache)
+                timings.append(seconds + lyrics_seconds)
+        report("post-processing per track", timings)
+    finally:
+        cache.close()
+        ytd.default_run.library_index.close()
+        ytd.default_run.library_index = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def legacy_renamer(songs_path):
+    """ metadata_renamer.main() as it used to be: one file after the other, every file read and rewritten. """
+    index = ytd.LibraryIndex(songs_path)
+    for file in os.listdir(songs_path):
+        if ytd.is_audio_file(file):
+            file_path = os.path.join(songs_path, file)
+            audio = mutagen.File(file_path, easy=True)
+            artist, title = audio.get('artist', [None])[0], audio.get('title', [None])[0]
+            metadata_renamer.delete_metadata(file_path)
+            if artist and title:
+                base_name, extension = metadata_renamer.target_name(artist, title, os.path.splitext(file_path)[1])
+                new_file_path = os.path.join(songs_path, f"{base_name}{extension}")
+                counter = 1
+                while file_path != new_file_path and os.path.exists(new_file_path):
+                    new_file_path = os.path.join(songs_path, f"AAAWARNING_REPEATED_({counter}){base_name}{extension}")
+                    counter += 1
+                if new_file_path != file_path:
+                    os.rename(file_path, new_file_path)
+                    index.remove(file_path)
+                index.update(new_file_path)
+            else:
+                index.update(file_path)
+    index.close()
+
+def check(name, condition, failures):
+    """ Print one behavior check, remember the failed ones. """
+    print(f"{'ok' if condition else 'FAILED':<8} {name}")
+    if not condition:
+        failures.append(name)
+
+def bench_lyrics(args):
+    """ Lyrics stage against a local fake provider: timings plus checks of the cache behavior. """
+    calls = {}
+    def provider(artist, title):
+        calls[title] = calls.get(title, 0) + 1
+        time.sleep(args.provider_latency)
+        if title.startswith("Broken"):
+            raise ConnectionError("network is down")
+        return None if title.startswith("Miss") else "[00:01.00] la la la\n"
+    ytd.lyrics_provider = provider
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    ytd.default_run.cache_path = work_dir
+    failures = []
+    try:
+        kinds = ("Hit", "Miss", "Broken")
+        files = [make_mp3(os.path.join(work_dir, f"{i}.mp3"), "Artist", f"{kinds[i % 3]} {i}") for i in range(args.tracks)]
+        def run_stage(miss_ttl, threads=4):
+            # returns (seconds, largest number of files waiting in the stage at any submit)
+            stage = ytd.LyricsStage(threads, miss_ttl)
+            finished = []
+            embed_lyrics = ytd.embed_lyrics
+            ytd.embed_lyrics = lambda *a: finished.append(embed_lyrics(*a)) or finished[-1]
+            largest = 0
+            start = time.perf_counter()
+            with quiet():
+                for file in files:
+                    stage.submit(file)
+                    largest = max(largest, len(stage.futures) - len(finished))
+                stage.close()
+            ytd.embed_lyrics = embed_lyrics
+            return time.perf_counter() - start, largest
+
+        seconds, largest = run_stage(miss_ttl=3600, threads=1)
+        report("lyrics, cold cache", [seconds / len(files)] * len(files))
+        check("every song is looked up once", all(count == 1 for count in calls.values()) and len(calls) == len(files), failures)
+        check(f"submit() blocks with at most {1 * 4} files waiting (saw {largest})", largest <= 1 * 4 + 1, failures)
+
+        calls.clear()
+        seconds, _ = run_stage(miss_ttl=3600)
+        report("lyrics, warm cache", [seconds / len(files)] * len(files))
+        check("found lyrics come from the cache", not any(title.startswith("Hit") for title in calls), failures)
+        check("misses are cached while fresh", not any(title.startswith("Miss") for title in calls), failures)
+        check("failed searches are not cached", all(calls.get(f"Broken {i}") == 1 for i in range(2, args.tracks, 3)), failures)
+
+        calls.clear()
+        run_stage(miss_ttl=0)
+        check("expired misses are searched again", all(calls.get(f"Miss {i}") == 1 for i in range(1, args.tracks, 3)), failures)
+        check("songs with lyrics are not searched again", not any(title.startswith("Hit") for title in calls), failures)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} lyrics checks failed")
+
+def bench_renamer(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    try:
+        # the same library for every run, with a name the renamer has to fix on every file and a few collisions
+        template = make_library(os.path.join(work_dir, "template"), args.files)
+        for i, file in enumerate(sorted(os.listdir(template))):
+            os.rename(os.path.join(template, file), os.path.join(template, f"{i}.mp3"))
+        for i in range(0, args.files, 50):
+            shutil.copy(os.path.join(template, f"{i}.mp3"), os.path.join(template, f"{i}b.mp3"))
+        runs = (("legacy renamer", legacy_renamer),
+                ("renamer, dry run", lambda path: metadata_renamer.main(args.threads, dry_run=True)),
+                (f"renamer, {args.threads or 'default'} threads", lambda path: metadata_renamer.main(args.threads)))
+        for name, run in runs:
+            songs = os.path.join(work_dir, "Songs")
+            shutil.rmtree(songs, ignore_errors=True)
+            shutil.copytree(template, songs)
+            metadata_renamer.songs_path = songs
+            with quiet():
+                seconds, _ = timed(run, songs)
+            report(name, [seconds / args.files] * args.files, total_s=f"{seconds:.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_pipeline(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    try:
+        install_fake_tools(work_dir, args.download_latency, args.transcode_latency)
+        for threads in (int(value) for value in args.threads.split(",")):
+            run_dir = os.path.join(work_dir, f"run{threads}")
+            use_directories(run_dir)
+            ytd.default_run.library_index = ytd.LibraryIndex(ytd.default_run.songs_path)
+            ytd.default_run.art_cache = ytd.ArtCache(os.path.join(ytd.default_run.cache_path, "art"), 64, 200e6)
+            urls = [ytd.video_url(f"t{threads}v{i:06d}") for i in range(args.tracks)]
+            with quiet():
+                seconds, results = timed(ytd.run_pipeline, urls, threads, min(threads, os.cpu_count() or 4))
+            ytd.default_run.library_index.close()
+            ytd.default_run.art_cache.close()
+            ytd.default_run.library_index = ytd.default_run.art_cache = None
+            done = sum(1 for _, file_path in results if file_path)
+            print(f"pipeline, {threads:>3} threads      {done / seconds * 60:9.1f} tracks/min  ({done}/{len(urls)} tracks in {seconds:.1f} s)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_art(args):
+    ffmpeg = args.ffmpeg or (ytd.default_run.ffmpeg_path if os.path.exists(ytd.default_run.ffmpeg_path) else shutil.which("ffmpeg"))
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    ytd.default_run.cache_path = os.path.join(work_dir, "cache")
+    # every album has its own thumbnail URL, shared by all of its tracks
+    thumbnails = [f"https://example.invalid/album{i % args.albums}.jpg" for i in range(args.tracks)]
+    try:
+        if ffmpeg:
+            # before the art cache: every track fetched its own thumbnail and ffmpeg cropped it
+            ytd.default_run.ffmpeg_path = ffmpeg
+            fetch = fake_art_fetcher(work_dir, args.fetch_latency)
+            timings = [timed(lambda: ytd.crop_cover_ffmpeg(fetch(thumbnail)))[0] for thumbnail in thumbnails]
+            report("fetch + ffmpeg crop per track", timings, fetches=fetch.calls, ffmpeg_spawns=len(thumbnails))
+        else:
+            print("no ffmpeg found, skipping the per-track crop (use --ffmpeg PATH)")
+
+        ytd.art_fetcher = fetch = fake_art_fetcher(work_dir, args.fetch_latency)
+        cache = ytd.ArtCache(os.path.join(ytd.default_run.cache_path, "art"), 64, 200e6)
+        timings = [timed(lambda: cache.load(cache.get(thumbnail)[0]))[0] for thumbnail in thumbnails]
+        report("art cache, cold", timings, fetches=fetch.calls, ffmpeg_spawns=0)
+        cache.close()
+        # next run: the covers are on disk, nothing in memory
+        cache = ytd.ArtCache(os.path.join(ytd.default_run.cache_path, "art"), 64, 200e6)
+        timings = [timed(lambda: cache.load(cache.get(thumbnail)[0]))[0] for thumbnail in thumbnails]
+        report("art cache, next run", timings, fetches=fetch.calls - args.albums)
+        cache.close()
+
+        # a disk cache with room for about two covers keeps the most recently used ones
+        failures = []
+        small_dir = os.path.join(ytd.default_run.cache_path, "small")
+        art_dir = os.path.join(ytd.default_run.cache_path, "art")
+        cover_size = max(os.path.getsize(os.path.join(art_dir, file)) for file in os.listdir(art_dir) if file.endswith(".jpg"))
+        cache = ytd.ArtCache(small_dir, 1, cover_size * 2.5)
+        for thumbnail in thumbnails:
+            cache.get(thumbnail)
+        covers = [file for file in os.listdir(small_dir) if file.endswith(".jpg")]
+        check(f"disk cache stays bounded ({len(covers)} covers on disk)", len(covers) <= 2, failures)
+        last = cache.get(thumbnails[-1])
+        check("the most recently used cover is still cached", last[1], failures)
+        check("no per-URL locks are left behind", not cache.url_locks, failures)
+        cache.close()
+        if failures:
+            sys.exit(f"{len(failures)} art cache checks failed")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def limiter_trace(speed, throttle_every=0, events=400):
+    """ Feed a limiter starting at 4 workers and 6 fragments with downloads of speed(fragments) bytes per second, every throttle_every-th one a 429. """
+    limiter = ytd.AdaptiveLimiter(4, (2, 16), 6, (1, 16), cooldown=0)
+    limiter.slow_ratio = 0 # the events come in faster than any real round, their throughput means nothing
+    trace = []
+    with quiet():
+        for i in range(1, events + 1):
+            if throttle_every and i % throttle_every == 0:
+                limiter.record({"ok": False, "throttled": True})
+            else:
+                limiter.record({"ok": True, "bytes": 1_000_000, "seconds": 1_000_000 / speed(limiter.fragments)})
+            trace.append((limiter.limit, limiter.fragments))
+    return trace
+
+def bench_adaptive(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    totals = {"fixed": [0, 0.0], "adaptive": [0, 0.0]} # tracks done and seconds of all repeats
+    try:
+        install_fake_tools(work_dir, args.download_latency, 0.0)
+        os.environ["YTD_FAKE_ACTIVE_DIR"] = os.path.join(work_dir, "active")
+        os.environ["YTD_FAKE_THROTTLE_ABOVE"] = str(args.throttle_above)
+        os.makedirs(os.environ["YTD_FAKE_ACTIVE_DIR"])
+        limiters = {
+            f"fixed, {args.threads} threads": lambda: ytd.AdaptiveLimiter(args.threads, (args.threads, args.threads), 6, (6, 6)),
+            f"adaptive, from {args.threads}": lambda: ytd.AdaptiveLimiter(args.threads, (2, args.threads * 2), 6, (1, 16), cooldown=args.download_latency * 2),
+        }
+        # the two take turns, so a machine that gets busier or quieter over time does not favor one of them
+        for repeat in range(args.repeats):
+            for name, new_limiter in limiters.items():
+                limiter = new_limiter()
+                use_directories(os.path.join(work_dir, name.replace(",", "").replace(" ", "_") + str(repeat)))
+                ytd.default_run.download_limiter = limiter
+                ytd.default_run.run_metrics = ytd.RunMetrics(os.path.join(ytd.default_run.cache_path, "events.jsonl"))
+                urls = [ytd.video_url(f"{len(name)}r{repeat}v{i:05d}") for i in range(args.tracks)]
+                with quiet():
+                    seconds, results = timed(ytd.run_pipeline, urls, limiter.workers_max, os.cpu_count() or 4)
+                ytd.default_run.run_metrics.close()
+                done = sum(1 for _, file_path in results if file_path)
+                throttled = sum(1 for event in ytd.default_run.run_metrics.events if event.get('throttled'))
+                print(f"{name:<28} {done / seconds * 60:9.1f} tracks/min  ({done}/{len(urls)} tracks in {seconds:.1f} s, "
+                      f"{throttled} x 429, ended at {limiter.limit} downloads, -N {limiter.fragments})")
+                totals[name.split(",")[0]][0] += done
+                totals[name.split(",")[0]][1] += seconds
+    finally:
+        ytd.default_run.download_limiter = ytd.default_run.run_metrics = None
+        for name in ("YTD_FAKE_ACTIVE_DIR", "YTD_FAKE_THROTTLE_ABOVE"):
+            os.environ.pop(name, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rates = {kind: done / seconds * 60 for kind, (done, seconds) in totals.items()}
+    # single runs still vary by a few percent on a busy machine
+    check(f"the adaptive limit keeps up with the fixed pool ({rates['adaptive']:.0f} vs {rates['fixed']:.0f} tracks/min)",
+          rates["adaptive"] >= rates["fixed"] * 0.9, failures)
+    flat = limiter_trace(lambda fragments: 1e6, throttle_every=25)
+    check("-N does not follow the workers when fragments do not help", max(limit for limit, _ in flat) > 4 and all(fragments <= 7 for _, fragments in flat), failures)
+    check("-N does not rise while throttled", all(after <= before for (_, before), (_, after) in zip(flat[23::25], flat[24::25])), failures)
+    check("-N rises when it makes single downloads faster", limiter_trace(lambda fragments: fragments * 1e6)[-1][1] > 6, failures)
+    if failures:
+        sys.exit(f"{len(failures)} adaptive checks failed")
+
+def legacy_clean_title(title, artist):
+    """ clean_title() as it used to be: one str.replace per pattern and a new artist regex on every call. """
+    for substring in ["(Official Video)", "(Official Audio)", "(Official Version)", "(Video)", "(Official Lyric Video)",
+                      "(Official Music Video)", "(Official Visualizer)", "(Soundtrack Version)", "Official_Video",
+                      "(4K Remaster)", "?", "’"]:
+        title = title.replace(substring, "")
+    title = re.sub(rf"(?i)\b{re.escape(artist)}\b|\b{re.escape(artist.replace(' ', '_'))}\b", "", title)
+    if title in {"★★★★★": "5 Stars"}:
+        title = "5 Stars"
+    return title.strip(' -')
+
+def bench_titles(args):
+    rng = random.Random(0)
+    titles = []
+    for i in range(args.titles):
+        artist, title = random_title(rng, i)
+        if i % 7 == 0:
+            title = title.replace(artist, artist.replace(" ", "_"))
+        if i % 11 == 0:
+            title = title.replace(" - ", " - ¿Qué? ’") + " (Official Music Video)"
+        titles.append((title, artist))
+    rules = ytd.TitleRules()
+    for name, clean in (("legacy clean_title", legacy_clean_title), ("compiled title rules", rules.clean)):
+        seconds, results = timed(lambda: [clean(title, artist) for title, artist in titles])
+        report(name, [seconds / len(titles)] * len(titles), us_per_title=f"{seconds / len(titles) * 1e6:.1f}", total_s=f"{seconds:.2f}")
+    differences = sum(1 for title, artist in titles if legacy_clean_title(title, artist) != rules.clean(title, artist))
+    print(f"{differences} of {len(titles)} titles cleaned differently")
+
+STARTUP_DRIVER = """
+import os, sys, json, time, subprocess
+legacy = sys.argv[1] == "legacy"
+if legacy:
+    import mutagen, mutagen.id3, mutagen.mp4, syncedlyrics # what ytd.py and library.py imported at the top
+sys.path.insert(0, sys.argv[2])
+import ytd
+ytd.default_run.params.update(yt_dlp_path=sys.argv[3], ffmpeg_path=sys.argv[4])
+ytd.print = lambda *a, **k: None
+if legacy:
+    subprocess.run([sys.argv[3], "-U"], check=True)
+    ytd.start_update_check = lambda: None
+ytd.setup()
+ytd.main()
+seconds = time.time() - float(sys.argv[5]) # until the console would say "Press Enter to exit..."
+ytd.wait_for_update()
+print(json.dumps({"seconds": seconds, "modules": {name: name in sys.modules for name in ("mutagen", "syncedlyrics")}}))
+"""
+
+def bench_startup(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    try:
+        install_fake_tools(work_dir)
+        os.environ["YTD_FAKE_UPDATE_LATENCY"] = str(args.update_latency)
+        make_library(os.path.join(work_dir, "Songs"), args.files)
+        with open(os.path.join(work_dir, "_Input.txt"), "w") as f:
+            f.write("\n".join(ytd.video_url(f"vid{i:08d}") for i in range(args.files)))
+        with open(os.path.join(work_dir, "_Params.txt"), "w") as f:
+            f.write("output=Songs\n")
+        with open(os.path.join(work_dir, "startup_driver.py"), "w") as f:
+            f.write(STARTUP_DRIVER)
+        repo = os.path.dirname(os.path.abspath(__file__))
+        def run(mode):
+            # returns (seconds from the process start to the end of main(), modules imported by the run)
+            result = subprocess.run([sys.executable, "startup_driver.py", mode, repo, ytd.default_run.yt_dlp_path, ytd.default_run.ffmpeg_path, str(time.time())],
+                                    cwd=work_dir, capture_output=True, text=True)
+            if result.returncode != 0:
+                sys.exit(f"startup run failed:\n{result.stderr}")
+            run_result = json.loads(result.stdout.splitlines()[-1])
+            return run_result["seconds"], run_result["modules"]
+
+        run("new") # first run builds the library index, not part of the startup time
+        os.remove(os.path.join(work_dir, "cache", "yt-dlp-update.json"))
+        for name, mode in (("legacy, -U on every run", "legacy"), ("update check due", "new"), ("within update TTL", "new")):
+            seconds, modules = run(mode)
+            imported = ", ".join(module for module, loaded in modules.items() if loaded) or "none"
+            print(f"{name:<28} {seconds * 1000:9.0f} ms  (no-op run over {args.files} files, heavy modules: {imported})")
+        check("a no-op run within the update TTL takes under a second", seconds < 1.0, failures)
+        check("a no-op run imports neither mutagen nor syncedlyrics", not any(modules.values()), failures)
+        check("the update check is recorded", os.path.exists(os.path.join(work_dir, "cache", "yt-dlp-update.json")), failures)
+    finally:
+        os.environ.pop("YTD_FAKE_UPDATE_LATENCY", None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} startup checks failed")
+
+def legacy_orphans(songs_path, expected_files):
+    """ The old lookup in main(): every file checked against the expected_files list. """
+    orphans = []
+    for file in os.listdir(songs_path):
+        file_path = os.path.abspath(os.path.join(songs_path, file))
+        if os.path.isfile(file_path) and not ytd.is_index_file(file):
+            if file_path not in expected_files:
+                orphans.append(file_path)
+    return orphans
+
+def bench_orphans(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    try:
+        use_directories(work_dir)
+        files = [os.path.join(ytd.default_run.songs_path, f"Artist - Song {i}.mp3") for i in range(args.files)]
+        for file in files:
+            open(file, "w").close()
+        expected = files[args.orphans:]
+        seconds, orphans = timed(legacy_orphans, ytd.default_run.songs_path, expected)
+        report("list lookups", [seconds / args.files] * args.files, orphans=len(orphans), total_s=f"{seconds:.2f}")
+        seconds, orphans = timed(ytd.find_orphans, set(expected))
+        report("set difference", [seconds / args.files] * args.files, orphans=len(orphans), total_s=f"{seconds:.2f}")
+        for file in files:
+            os.remove(file)
+
+        # a small tagged library, the first two files are not in the input
+        make_library(ytd.default_run.songs_path, 6)
+        ytd.default_run.library_index = ytd.LibraryIndex(ytd.default_run.songs_path)
+        ytd.default_run.library_index.refresh()
+        paths = sorted(entry['path'] for entry in ytd.default_run.library_index.entries())
+        result = {"expected_files": set(paths[2:]), "failed_listings": []}
+        def run(policy, failed_listings=()):
+            ytd.default_run.params["orphan_policy"] = policy
+            ytd.default_run.params["quarantine_path"] = os.path.join(work_dir, "Quarantine")
+            with quiet():
+                return ytd.reconcile(dict(result, failed_listings=list(failed_listings)))
+
+        kept = run("keep")
+        check("keep leaves the orphans in place", all(os.path.exists(path) for path in paths) and len(kept) == 2, failures)
+        with open(os.path.join(ytd.default_run.cache_path, "orphans.json")) as f:
+            check("the report lists every orphan", sorted(item["path"] for item in json.load(f)["orphans"]) == paths[:2], failures)
+        run("delete", failed_listings=["https://www.youtube.com/playlist?list=PLbroken"])
+        check("nothing is removed when a playlist could not be listed", all(os.path.exists(path) for path in paths), failures)
+        os.makedirs(os.path.join(work_dir, "Quarantine"))
+        shutil.copy(paths[0], os.path.join(work_dir, "Quarantine", os.path.basename(paths[0])))
+        moved = run("quarantine")
+        check("quarantine moves the orphans out of Songs", not any(os.path.exists(path) for path in paths[:2]), failures)
+        check("quarantine does not overwrite earlier files", len(os.listdir(os.path.join(work_dir, "Quarantine"))) == 3
+              and all(os.path.exists(item["moved_to"]) for item in moved), failures)
+        check("the other files stay", all(os.path.exists(path) for path in paths[2:]), failures)
+        check("the index forgets the quarantined files", {entry['path'] for entry in ytd.default_run.library_index.entries()} == set(paths[2:]), failures)
+        shutil.copy(moved[0]["moved_to"], paths[0])
+        run("delete")
+        check("delete removes the orphans", not os.path.exists(paths[0]) and os.path.exists(paths[2]), failures)
+        ytd.default_run.library_index.close()
+        ytd.default_run.library_index = None
+    finally:
+        for name in ("orphan_policy", "quarantine_path"):
+            ytd.default_run.params.pop(name, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} orphan checks failed")
+
+def bench_failures(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    try:
+        install_fake_tools(work_dir, args.download_latency, 0.0)
+        use_directories(work_dir)
+        lines = [ytd.video_url(f"{kind}{i:06d}") for kind in ("okv", "private", "removed", "flaky")
+                 for i in range(args.tracks if kind == "okv" else args.failing)]
+        def run():
+            # returns (seconds, video IDs yt-dlp was started for)
+            ytd.open_run()
+            with quiet():
+                seconds, _ = timed(ytd.sync, lines)
+            downloads = [event['video_id'] for event in ytd.default_run.run_metrics.events if event['stage'] == "download"]
+            ytd.close_run()
+            os.makedirs(ytd.default_run.temp_path, exist_ok=True)
+            return seconds, downloads
+
+        seconds, downloads = run()
+        print(f"{'first sync':<28} {seconds:9.2f} s  ({len(downloads)} yt-dlp runs)")
+        seconds, downloads = run()
+        print(f"{'second sync':<28} {seconds:9.2f} s  ({len(downloads)} yt-dlp runs)")
+        check("nothing is tried again while the failures are cached", not downloads, failures)
+        cache = ytd.FailureCache(os.path.join(ytd.default_run.cache_path, "failures.sqlite"))
+        classes = {video_id[:7]: entry['class'] for video_id, entry in cache.entries.items()}
+        cache.close()
+        check(f"failures are classified ({classes})", classes == {"private": "private", "removed": "removed", "flaky00": "transient"}, failures)
+        check("the TTL doubles with every failure in a row", ytd.failure_ttl("private", 3) == 4 * ytd.failure_ttl("private", 1), failures)
+
+        ytd.default_run.params["failure_ttl_hours_transient"] = "0"
+        _, downloads = run()
+        check("expired transient failures are tried again", sorted(downloads) == [f"flaky{i:06d}" for i in range(args.failing)], failures)
+        cache = ytd.FailureCache(os.path.join(ytd.default_run.cache_path, "failures.sqlite"))
+        check("failing again backs off", all(entry['failures'] == 2 for video_id, entry in cache.entries.items() if video_id.startswith("flaky")), failures)
+        cache.close()
+        os.environ["YTD_FAKE_FLAKY_OK"] = "1"
+        run()
+        with quiet():
+            ytd.clear_failures(["removed"])
+        _, downloads = run()
+        cache = ytd.FailureCache(os.path.join(ytd.default_run.cache_path, "failures.sqlite"))
+        check("a successful download drops the entry", not any(video_id.startswith("flaky") for video_id in cache.entries), failures)
+        check("cleared entries are tried on the next run", sorted(downloads) == [f"removed{i:06d}" for i in range(args.failing)], failures)
+        cache.close()
+    finally:
+        ytd.default_run.params.pop("failure_ttl_hours_transient", None)
+        os.environ.pop("YTD_FAKE_FLAKY_OK", None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} failure cache checks failed")
+
+def bench_duplicates(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    os.environ["YTD_FAKE_PLAYLIST_SIZE"] = str(args.tracks)
+    os.environ["YTD_FAKE_DUPLICATE_EVERY"] = str(args.duplicate_every)
+    try:
+        install_fake_tools(work_dir, args.download_latency, 0.0)
+        lines = ["https://www.youtube.com/playlist?list=PLdup"]
+        runs = {}
+        for policy in ("off", "skip"):
+            use_directories(os.path.join(work_dir, policy))
+            if policy == "skip":
+                # a song the library already has from another upload
+                n = int("0002", 36)
+                make_mp3(os.path.join(ytd.default_run.songs_path, "old upload.mp3"), f"Fake Artist {n % 50}", "Song PLdup000002",
+                         url=ytd.video_url("oldupload01"), art_size=0)
+            ytd.default_run.params["duplicate_policy"] = policy
+            ytd.open_run()
+            with quiet():
+                seconds, result = timed(ytd.sync, lines)
+            downloads = sum(1 for event in ytd.default_run.run_metrics.events if event['stage'] == "download")
+            ytd.close_run()
+            songs = sorted(file for file in os.listdir(ytd.default_run.songs_path) if ytd.is_audio_file(file))
+            runs[policy] = (result, songs)
+            print(f"duplicate_policy={policy:<11} {seconds:9.2f} s  ({downloads} downloads, {len(songs)} songs, {len(result['duplicates'])} duplicates found)")
+
+        result, songs = runs["skip"]
+        duplicates = args.tracks // args.duplicate_every
+        check("every duplicate upload is skipped before its download", result["new"] == args.tracks - duplicates - 1, failures)
+        check("the library copy of a song counts as present", any("path" in match for match in result["duplicates"].values())
+              and os.path.join(work_dir, "skip", "Songs", "old upload.mp3") in result["expected_files"], failures)
+        check("no song is lost", set(songs) - {"old upload.mp3"} <= set(runs["off"][1]) and len(songs) == len(runs["off"][1]), failures)
+
+        index = ytd.DuplicateIndex([], tolerance=15)
+        check("YouTube Music and video uploads of a song share a key",
+              ytd.song_key(*ytd.listed_artist_title({"title": "Queen - Bohemian Rhapsody (Official Video)", "uploader": "QueenVEVO"}))
+              == ytd.song_key(*ytd.listed_artist_title({"title": "Bohemian Rhapsody", "uploader": "Queen - Topic"})), failures)
+        index.check("a", {"title": "Queen - Bohemian Rhapsody", "duration": 355})
+        check("a much longer upload with the same name is not a duplicate", index.check("b", {"title": "Queen - Bohemian Rhapsody", "duration": 600}) is None, failures)
+        check("the same song within the tolerance is", index.check("c", {"title": "Queen - Bohemian Rhapsody (Official Audio)", "duration": 358}) is not None, failures)
+    finally:
+        ytd.default_run.params.pop("duplicate_policy", None)
+        for name in ("YTD_FAKE_PLAYLIST_SIZE", "YTD_FAKE_DUPLICATE_EVERY"):
+            os.environ.pop(name, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} duplicate checks failed")
+
+QUEUE_DRIVER = """
+import os, sys
+os.chdir(sys.argv[2]) # ytd.py keeps its Temp and cache next to the working directory
+sys.path.insert(0, sys.argv[1])
+import ytd, benchmark
+benchmark.install_fake_tools(sys.argv[2], float(sys.argv[4]))
+ytd.print = lambda *a, **k: None
+ytd.setup()
+ytd.coordinate() if sys.argv[3] == "coordinator" else ytd.work()
+ytd.wait_for_update()
+"""
+
+def bench_queue(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    os.environ["YTD_FAKE_PLAYLIST_SIZE"] = str(args.tracks)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    small_sizes = "queue_batch=2\ndownload_threads=2\ndownload_threads_max=2\ntranscode_threads=2\n"
+    def start(run_dir, role, sizes=small_sizes):
+        # one process with its own working directory, sharing Songs and the queue in it
+        os.makedirs(run_dir, exist_ok=True)
+        with open(os.path.join(run_dir, "_Params.txt"), "w") as f:
+            f.write(f"output={songs}\nqueue_lease_seconds={args.lease}\nqueue_poll_seconds=0.2\n" + sizes)
+        with open(os.path.join(run_dir, "_Input.txt"), "w") as f:
+            f.write("https://www.youtube.com/playlist?list=PLqueue\n")
+        with open(os.path.join(run_dir, "queue_driver.py"), "w") as f:
+            f.write(QUEUE_DRIVER)
+        return subprocess.Popen([sys.executable, "queue_driver.py", repo, run_dir, role, str(args.download_latency)],
+                                cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        for workers in (1, args.workers):
+            run_path = os.path.join(work_dir, f"{workers} workers")
+            songs = os.path.join(run_path, "Songs")
+            os.makedirs(songs)
+            queue_path = os.path.join(songs, ytd.QUEUE_FILENAME)
+            started = time.time()
+            coordinator = start(os.path.join(run_path, "coordinator"), "coordinator")
+            processes = [start(os.path.join(run_path, f"worker{i}"), "worker") for i in range(workers)]
+            killed = None
+            if workers > 1:
+                # kill a worker in the middle of its downloads, its jobs have to go to the others
+                victim = processes[0]
+                while killed is None and time.time() - started < 60:
+                    time.sleep(0.1)
+                    if not os.path.exists(queue_path):
+                        continue
+                    job_queue = ytd.JobQueue(queue_path)
+                    held = [video_id for video_id, job in job_queue.results().items()
+                            if job['state'] == "leased" and job['worker'].endswith(f"-{victim.pid}")]
+                    job_queue.close()
+                    if held:
+                        victim.kill()
+                        victim.wait()
+                        killed = (victim.pid, held)
+            try:
+                coordinator.wait(timeout=120)
+            except subprocess.TimeoutExpired:
+                coordinator.kill()
+            seconds = time.time() - started
+            for process in processes:
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if coordinator.returncode != 0:
+                sys.exit(f"coordinator failed:\n{coordinator.stderr.read()}")
+            for process in processes:
+                process.stderr.close()
+            coordinator.stderr.close()
+
+            job_queue = ytd.JobQueue(queue_path)
+            jobs = job_queue.results()
+            stats = job_queue.stats()
+            job_queue.close()
+            audio = [file for file in os.listdir(songs) if ytd.is_audio_file(file)]
+            per_worker = {}
+            for job in jobs.values():
+                per_worker[job['worker']] = per_worker.get(job['worker'], 0) + 1
+            print(f"{workers} worker(s){' (1 killed)' if killed else '':<11} {seconds:9.2f} s  "
+                  f"({len(audio)} songs, jobs per worker: {sorted(per_worker.values(), reverse=True)})")
+            check(f"{workers} worker(s): every job is done", len(jobs) == args.tracks and all(job['state'] == "done" for job in jobs.values()), failures)
+            check(f"{workers} worker(s): every song is in Songs exactly once", len(audio) == args.tracks, failures)
+            check(f"{workers} worker(s): no job is left leased", stats['leased'] == 0 and stats['pending'] == 0, failures)
+            if workers > 1:
+                check("a worker was killed while holding jobs", killed is not None, failures)
+                if killed is not None:
+                    pid, held = killed
+                    check("the killed worker's jobs were finished by the others",
+                          all(jobs[video_id]['state'] == "done" and not jobs[video_id]['worker'].endswith(f"-{pid}") for video_id in held), failures)
+
+        # the default queue_batch and download sizes: a worker only holds a batch more than it is downloading
+        batch, downloads = 4, 20 # queue_batch and the download_threads a worker starts with
+        os.environ["YTD_FAKE_PLAYLIST_SIZE"] = str(3 * (batch + downloads))
+        run_path = os.path.join(work_dir, "defaults")
+        songs = os.path.join(run_path, "Songs")
+        os.makedirs(songs)
+        queue_path = os.path.join(songs, ytd.QUEUE_FILENAME)
+        processes = [start(os.path.join(run_path, "coordinator"), "coordinator", "")]
+        processes += [start(os.path.join(run_path, f"worker{i}"), "worker", "") for i in range(2)]
+        most_held = 0
+        while processes[0].poll() is None:
+            time.sleep(0.1)
+            if os.path.exists(queue_path):
+                job_queue = ytd.JobQueue(queue_path)
+                held = collections.Counter(job['worker'] for job in job_queue.results().values() if job['state'] == "leased")
+                job_queue.close()
+                most_held = max([most_held, *held.values()])
+        for process in processes:
+            process.wait(timeout=60)
+            process.stderr.close()
+        job_queue = ytd.JobQueue(queue_path)
+        per_worker = collections.Counter(job['worker'] for job in job_queue.results().values())
+        job_queue.close()
+        print(f"{'default sizes':<28} at most {most_held} jobs held by a worker, jobs per worker: {sorted(per_worker.values(), reverse=True)}")
+        # + 2: the download limit can grow a step or two during the run
+        check(f"a worker holds at most queue_batch + its downloads ({most_held} <= {batch + downloads} + 2)", 0 < most_held <= batch + downloads + 2, failures)
+        check("both workers get jobs", len(per_worker) == 2, failures)
+    finally:
+        os.environ.pop("YTD_FAKE_PLAYLIST_SIZE", None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} queue checks failed")
+
+def bench_api(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    os.environ["YTD_FAKE_PLAYLIST_SIZE"] = str(args.tracks)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        install_fake_tools(work_dir, args.download_latency, 0.0)
+        def config(name, **values):
+            # a library of its own, and the fake tools from install_fake_tools()
+            return dict(ytd.default_run.params, output=os.path.join(work_dir, name, "Songs"), temp_path=os.path.join(work_dir, name, "temp"),
+                        cache_path=os.path.join(work_dir, name, "cache"), **values)
+        async def collect(downloader, urls, **kwargs):
+            return [track async for track in downloader.sync(urls, **kwargs)]
+        def downloads(downloader):
+            return [event['video_id'] for event in downloader.run.run_metrics.events if event['stage'] == "download"]
+        def playlist(name):
+            return f"https://www.youtube.com/playlist?list={name}"
+
+        # the same no-op request (everything in the library) with an exe start per request vs one warm Downloader
+        make_library(os.path.join(work_dir, "Songs"), args.files)
+        lines = [ytd.video_url(f"vid{i:08d}") for i in range(args.files)]
+        with open(os.path.join(work_dir, "_Input.txt"), "w") as f:
+            f.write("\n".join(lines))
+        with open(os.path.join(work_dir, "_Params.txt"), "w") as f:
+            f.write("output=Songs\n")
+        with open(os.path.join(work_dir, "startup_driver.py"), "w") as f:
+            f.write(STARTUP_DRIVER)
+        def exe_request():
+            subprocess.run([sys.executable, "startup_driver.py", "new", repo, ytd.default_run.yt_dlp_path, ytd.default_run.ffmpeg_path, str(time.time())],
+                           cwd=work_dir, capture_output=True, check=True)
+        exe_request() # builds the library index and records the update check
+        report("exe start per request", [timed(exe_request)[0] for _ in range(args.requests)], files=args.files)
+        async def warm_requests():
+            async with ytd.Downloader(dict(config("."), output=os.path.join(work_dir, "Songs"))) as downloader:
+                await collect(downloader, lines)
+                timings = []
+                for _ in range(args.requests):
+                    started = time.perf_counter()
+                    tracks = await collect(downloader, lines)
+                    timings.append(time.perf_counter() - started)
+                return timings, tracks
+        with quiet():
+            timings, tracks = asyncio.run(warm_requests())
+        report("warm Downloader", timings, files=args.files)
+        check("a no-op sync yields every video as present", len(tracks) == args.files and all(track.status == "present" for track in tracks), failures)
+
+        async def checks():
+            async with ytd.Downloader(config("a")) as a, ytd.Downloader(config("b")) as b:
+                # two libraries and two overlapping syncs of one library at the same time
+                started = time.perf_counter()
+                first, other_library, overlapping = await asyncio.gather(
+                    collect(a, [playlist("PLa")]), collect(b, [playlist("PLb")]),
+                    collect(a, [playlist("PLa"), ytd.video_url("private000001")]))
+                print(f"3 concurrent syncs, 2 libraries  {time.perf_counter() - started:9.2f} s  "
+                      f"({len(first) + len(other_library) + len(overlapping)} track results, {len(downloads(a)) + len(downloads(b))} downloads)")
+                songs = {name: [file for file in os.listdir(downloader.run.songs_path) if ytd.is_audio_file(file)] for name, downloader in (("a", a), ("b", b))}
+                check("each Downloader fills its own library", len(songs["a"]) == len(songs["b"]) == args.tracks
+                      and all("PLa" in file for file in songs["a"]) and all("PLb" in file for file in songs["b"]), failures)
+                check("a video two syncs want is downloaded once", sorted(downloads(a)) == sorted(set(downloads(a))), failures)
+                check("both syncs get every one of their videos", len(first) == args.tracks and len(overlapping) == args.tracks + 1
+                      and {track.path for track in first} == {track.path for track in overlapping if track.status == "downloaded"}, failures)
+                private = [track for track in overlapping if track.video_id == "private000001"]
+                check("a failed video comes with its error", private and private[0].status == "failed" and "private" in private[0].error.lower(), failures)
+                check("the command line's Run is not touched", ytd.default_run.songs_path == default_songs and ytd.default_run.library_index is None, failures)
+
+                # backpressure: the caller stops reading, the pipeline stops finishing tracks
+                c = ytd.Downloader(config("c", transcode_threads=1, download_threads=2, download_threads_max=2))
+                async with contextlib.aclosing(c.sync([playlist("PLc")], max_pending=2)) as tracks:
+                    await anext(tracks)
+                    await asyncio.sleep(1.0)
+                    finished = sum(1 for event in c.run.run_metrics.events if event['stage'] == "rename")
+                    await asyncio.sleep(1.0)
+                    still = sum(1 for event in c.run.run_metrics.events if event['stage'] == "rename")
+                    rest = [track async for track in tracks]
+                check(f"a caller that stops reading pauses the pipeline ({finished} of {args.tracks} tracks done)",
+                      finished == still and finished <= 4 and len(rest) == args.tracks - 1, failures)
+
+                # cancellation: nothing new starts once the caller is gone
+                metrics = c.run.run_metrics
+                async with contextlib.aclosing(c.sync([playlist("PLd")], max_pending=1)) as tracks:
+                    await anext(tracks)
+                await c.close() # waits for the downloads in progress
+                return sum(1 for event in metrics.events if event['stage'] == "download" and event['video_id'].startswith("PLd"))
+        default_songs = ytd.default_run.songs_path
+        with quiet():
+            started = asyncio.run(checks())
+        check(f"closing a sync early stops new downloads ({started} of {args.tracks} started)", started < args.tracks, failures)
+    finally:
+        os.environ.pop("YTD_FAKE_PLAYLIST_SIZE", None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} api checks failed")
+
+def damage_library(songs_path, frames):
+    """
+    Break three files of a library made by make_library() the ways a download goes wrong and
+    rename a fourth. Returns their paths: cut in a frame, cut after a frame, corrupt, misnamed.
+    """
+    paths = sorted(os.path.join(songs_path, name) for name in os.listdir(songs_path) if name.endswith(".mp3"))
+    cut_in_frame, cut_after_frame, corrupt, misnamed = paths[:4]
+    with open(cut_in_frame, "r+b") as f:
+        f.truncate(os.path.getsize(cut_in_frame) - 100)
+    tags = mutagen.id3.ID3(cut_after_frame)
+    tags.add(mutagen.id3.TLEN(encoding=3, text=str(round(frames * 1152 / 44.1))))
+    tags.save(cut_after_frame)
+    with open(cut_after_frame, "r+b") as f:
+        f.truncate(os.path.getsize(cut_after_frame) - frames * 3 // 4 * 417)
+    with open(corrupt, "r+b") as f:
+        f.seek(-frames * 417 // 2, os.SEEK_END)
+        f.write(bytes(8192))
+    renamed = os.path.join(songs_path, "Somebody Else - Something Else.mp3")
+    os.rename(misnamed, renamed)
+    return cut_in_frame, cut_after_frame, corrupt, renamed
+
+def bench_verify(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    run = ytd.default_run
+    check_audio_file = ytd.check_audio_file
+    try:
+        install_fake_tools(work_dir)
+        use_directories(work_dir)
+        os.environ["YTD_FAKE_FRAMES"] = str(args.frames)
+        make_library(run.songs_path, args.files, art_size=30_000, frames=args.frames)
+        damaged = damage_library(run.songs_path, args.frames)
+        run.params["quarantine_path"] = quarantine_path = os.path.join(work_dir, "Quarantine")
+        run.params["verify_duration_tolerance"] = "1"
+        cache_file = os.path.join(run.cache_path, "verify.sqlite")
+        checked = []
+        def counting_check(path, tolerance):
+            checked.append(path)
+            return check_audio_file(path, tolerance)
+        def verify(processes, policy="report", fresh=False):
+            # returns (seconds, {path: status}, files checked in this process)
+            if fresh and os.path.exists(cache_file):
+                os.remove(cache_file)
+            run.params["verify_processes"] = str(processes)
+            run.params["verify_policy"] = policy
+            checked.clear()
+            with quiet():
+                seconds, report_items = timed(ytd.verify_library)
+            return seconds, {item["path"]: item for item in report_items}, len(checked)
+
+        ytd.check_audio_file = counting_check # only counts in the process running --verify, i.e. with 1 process
+        seconds, serial, count = verify(1, fresh=True)
+        report("1 process", [seconds / args.files] * args.files, checked=count, total_s=f"{seconds:.2f}")
+        ytd.check_audio_file = check_audio_file
+        seconds, pooled, _ = verify(args.processes, fresh=True)
+        report(f"pool of {args.processes} processes", [seconds / args.files] * args.files, total_s=f"{seconds:.2f}")
+        ytd.check_audio_file = counting_check
+        seconds, cached, count = verify(1)
+        report("cached", [seconds / args.files] * args.files, checked=count, total_s=f"{seconds:.2f}")
+        check("only unchanged files, none is checked again", count == 0 and cached.keys() == serial.keys(), failures)
+
+        statuses = {path: item["status"] for path, item in serial.items()}
+        check(f"the damaged files are broken and the renamed one has a tag problem ({sorted(statuses.values())})",
+              statuses == dict(zip(damaged, ("broken", "broken", "broken", "warning"))), failures)
+        problems = [serial[path]["problems"][0] for path in damaged]
+        check(f"what is wrong is found ({problems})", problems[0].startswith("truncated, the last frame")
+              and problems[1].startswith("truncated, ") and " of " in problems[1] and problems[2].startswith("corrupt"), failures)
+        check("the pool finds the same", {path: item["problems"] for path, item in pooled.items()}
+              == {path: item["problems"] for path, item in serial.items()}, failures)
+        os.utime(damaged[3], ns=(time.time_ns(), time.time_ns() + 10**9))
+        _, _, count = verify(1)
+        check("a changed file is checked again", count == 1, failures)
+
+        _, requeued, _ = verify(1, policy="requeue")
+        check("the broken files are moved to the quarantine", sorted(os.listdir(quarantine_path)) == sorted(os.path.basename(path) for path in damaged[:3])
+              and all(requeued[path]["action"] == "requeued" for path in damaged[:3]), failures)
+        check("tag problems are only reported", os.path.exists(damaged[3]) and requeued[damaged[3]]["action"] == "reported", failures)
+        urls = {library.read_entry(os.path.join(quarantine_path, name))["url"] for name in os.listdir(quarantine_path)}
+        index = ytd.LibraryIndex(run.songs_path)
+        index.refresh()
+        downloaded = [entry for entry in index.entries() if entry["url"] in urls]
+        index.close()
+        check(f"the broken songs are downloaded again ({len(downloaded)} of 3)", len(downloaded) == 3, failures)
+        check("the new files have the video's length", all(mutagen.id3.ID3(entry["path"]).get("TLEN") is not None for entry in downloaded), failures)
+        _, after, count = verify(1)
+        check(f"the new files verify ({count} checked)", count == 3 and set(after) == {damaged[3]}, failures)
+
+        page = lambda flags, body: b"OggS" + bytes([0, flags]) + bytes(20) + bytes([1, len(body)]) + body
+        check("an OGG stream has to end", integrity.check_ogg(page(2, b"OpusHead") + page(4, bytes(50)))[0] is None
+              and integrity.check_ogg(page(2, b"OpusHead") + page(0, bytes(50)))[0].startswith("truncated")
+              and integrity.check_ogg(page(2, b"OpusHead") + page(4, bytes(50))[:-10])[0].startswith("truncated"), failures)
+        atom = lambda kind, size: (size + 8).to_bytes(4, "big") + kind + bytes(size)
+        m4a = atom(b"ftyp", 16) + atom(b"moov", 100) + atom(b"mdat", 1000)
+        check("M4A atoms have to fill the file", integrity.check_mp4(m4a)[0] is None
+              and integrity.check_mp4(m4a[:-1])[0].startswith("truncated")
+              and integrity.check_mp4(atom(b"ftyp", 16) + atom(b"mdat", 10))[0] == "corrupt, no moov atom", failures)
+    finally:
+        ytd.check_audio_file = check_audio_file
+        for name in ("quarantine_path", "verify_processes", "verify_policy", "verify_duration_tolerance"):
+            run.params.pop(name, None)
+        os.environ.pop("YTD_FAKE_FRAMES", None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} verify checks failed")
+
+def bench_staging(args):
+    work_dir = tempfile.mkdtemp(prefix="ytd_bench_")
+    failures = []
+    run = ytd.default_run
+    lyrics_provider = ytd.lyrics_provider
+    copyfile = ytd.shutil.copyfile
+    transfer = ytd.TransferStage.transfer
+    lines = [ytd.video_url(f"stg{i:06d}") for i in range(args.tracks)]
+    try:
+        install_fake_tools(work_dir, args.download_latency, 0.0)
+        ytd.lyrics_provider = lambda artist, title: "[00:01.00] la la la\n" * 20
+        def sync(name, staging, lines=lines):
+            # returns (seconds, SlowShare, result) of a sync into work_dir/name
+            run.params.update(output=os.path.join(work_dir, name), temp_path=os.path.join(work_dir, f"{name}-temp"),
+                              cache_path=os.path.join(work_dir, f"{name}-cache"), staging=staging)
+            run.configure()
+            with SlowShare(run.songs_path, args.latency) as share:
+                ytd.open_run()
+                with quiet():
+                    seconds, result = timed(ytd.sync, lines)
+                    ytd.close_run()
+            return seconds, share, result
+
+        def journal_stages():
+            # video ID -> stage in the job journal of the last sync, close_run() removes an empty Temp
+            if not os.path.exists(run.temp_path):
+                return {}
+            journal = ytd.JobJournal(os.path.join(run.temp_path, "journal.jsonl"))
+            journal.close()
+            return {video_id: job['stage'] for video_id, job in journal.jobs.items()}
+        copy_threads = set()
+        def traced_transfer(self, batch):
+            copy_threads.add(threading.current_thread().name)
+            return transfer(self, batch)
+        ytd.TransferStage.transfer = traced_transfer
+
+        seconds, share, _ = sync("Direct", "off")
+        report("direct to the share", [seconds / args.tracks] * args.tracks, share_reads=share.reads, share_writes=share.writes, total_s=f"{seconds:.2f}")
+        seconds, share, result = sync("Staged", "on")
+        report("staged, copied in batches", [seconds / args.tracks] * args.tracks, share_reads=share.reads, share_writes=share.writes, total_s=f"{seconds:.2f}")
+        songs = sorted(os.listdir(run.songs_path))
+        audio = [os.path.join(run.songs_path, name) for name in songs if library.is_audio_file(name)]
+        check(f"every song is written to the share once and never read ({share.writes} writes, {share.reads} reads)",
+              share.writes == args.tracks and share.reads == 0 and len(audio) == args.tracks, failures)
+        check("the results point at the songs on the share", result["downloaded"] == args.tracks
+              and result["expected_files"] == set(audio), failures)
+        check("the songs got their lyrics before the copy", all(library.TagSession(path).has_lyrics() for path in audio), failures)
+        check("no part files or index on the share", not any(name.startswith(ytd.PART_PREFIX) for name in songs)
+              and library.INDEX_FILENAME not in songs and os.path.exists(run.index_path), failures)
+        check("nothing stays staged", not os.path.exists(run.staging_path), failures)
+        check("batches are copied on the transfer thread, not by the lyrics workers",
+              copy_threads and all(name.startswith("transfer") for name in copy_threads), failures)
+        seconds, share, result = sync("Staged", "on")
+        report("staged, nothing new", [seconds / args.tracks] * args.tracks, share_reads=share.reads, share_writes=share.writes, total_s=f"{seconds:.2f}")
+        check("the index mirror knows every song without reading the share", share.reads == 0 and result["downloaded"] == 0
+              and len(result["expected_files"]) == args.tracks, failures)
+
+        def failing_copy(source, target, *args, **kwargs):
+            if os.path.basename(target).startswith(ytd.PART_PREFIX):
+                with open(target, "wb") as f:
+                    f.write(b"half a song")
+                raise OSError("The specified network name is no longer available")
+            return copyfile(source, target, *args, **kwargs)
+        ytd.shutil.copyfile = failing_copy
+        extra = [ytd.video_url(f"stgnew{i:03d}") for i in range(3)]
+        _, _, result = sync("Staged", "on", lines + extra)
+        ytd.shutil.copyfile = copyfile
+        check("a failed copy leaves nothing on the share", len(os.listdir(run.songs_path)) == args.tracks
+              and len(result["failed"]) == 3 and len(os.listdir(run.staging_path)) == 3, failures)
+        check("songs that did not reach the share stay staged in the journal",
+              journal_stages() == {ytd.video_id_from_url(url): "staged" for url in extra}, failures)
+        with quiet():
+            ytd.open_run()
+            ytd.close_run()
+        index = ytd.LibraryIndex(run.songs_path, run.index_path)
+        urls = {entry["url"] for entry in index.entries()}
+        index.close()
+        check("the next run copies what was left staged", len(os.listdir(run.songs_path)) == args.tracks + 3
+              and set(extra) <= urls and not os.path.exists(run.staging_path), failures)
+        check("the journal is done with them once they are copied", not journal_stages(), failures)
+
+        check("UNC paths are network paths", ytd.is_network_path("\\\\Server\\Songs") and ytd.is_network_path("\\\\?\\UNC\\Server\\Songs")
+              and not ytd.is_network_path(work_dir) and not ytd.is_network_path("\\\\?\\C:\\Songs"), failures)
+        run.params["staging"] = "auto"
+        run.configure()
+        check("staging=auto stays off for a local Songs directory", not run.staging and run.index_path is None, failures)
+    finally:
+        ytd.lyrics_provider = lyrics_provider
+        ytd.shutil.copyfile = copyfile
+        ytd.TransferStage.transfer = transfer
+        for name in ("output", "temp_path", "cache_path", "staging"):
+            run.params.pop(name, None)
+        run.configure()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} staging checks failed")
+
+def bench_all(args):
+    for function, values in ((bench_tags, {"tracks": 20}),
+                             (bench_library, {"files": 1000}),
+                             (bench_postprocess, {"tracks": 50}),
+                             (bench_renamer, {"files": 1000, "threads": None}),
+                             (bench_lyrics, {"tracks": 30, "provider_latency": 0.01}),
+                             (bench_adaptive, {"tracks": 100, "threads": 20, "throttle_above": 8, "download_latency": 0.3, "repeats": 2}),
+                             (bench_titles, {"titles": 10_000}),
+                             (bench_startup, {"files": 200, "update_latency": 1.0}),
+                             (bench_orphans, {"files": 5000, "orphans": 300}),
+                             (bench_failures, {"tracks": 10, "failing": 5, "download_latency": 0.1}),
+                             (bench_duplicates, {"tracks": 30, "duplicate_every": 5, "download_latency": 0.1}),
+                             (bench_api, {"files": 200, "requests": 5, "tracks": 12, "download_latency": 0.2}),
+                             (bench_verify, {"files": 200, "frames": 200, "processes": 4}),
+                             (bench_staging, {"tracks": 20, "latency": 0.02, "download_latency": 0.1}),
+                             (bench_queue, {"tracks": 24, "workers": 3, "lease": 2.0, "download_latency": 0.5}),
+                             (bench_art, {"tracks": 50, "albums": 5, "fetch_latency": 0.05, "ffmpeg": None}),
+                             (bench_pipeline, {"tracks": 40, "threads": "1,4,8", "download_latency": 0.2, "transcode_latency": 0.1})):
+        function(argparse.Namespace(**values))
+
+
+
+
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for ytd.py")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    tags_parser = subparsers.add_parser("tags", help="file opens and bytes written by the tag chain")
+    tags_parser.add_argument("--tracks", type=int, default=50)
+    tags_parser.set_defaults(func=bench_tags)
+
+    engine_parser = subparsers.add_parser("engine", help="per-track overhead of the yt-dlp engines")
+    engine_parser.add_argument("--tracks", type=int, default=10)
+    engine_parser.add_argument("--yt-dlp", help="yt-dlp executable for the subprocess engine")
+    engine_parser.set_defaults(func=bench_engine)
+
+    library_parser = subparsers.add_parser("library", help="library scan on a synthetic library")
+    library_parser.add_argument("--files", type=int, default=10_000)
+    library_parser.set_defaults(func=bench_library)
+
+    postprocess_parser = subparsers.add_parser("postprocess", help="per-track post-processing after ffmpeg")
+    postprocess_parser.add_argument("--tracks", type=int, default=200)
+    postprocess_parser.set_defaults(func=bench_postprocess)
+
+    lyrics_parser = subparsers.add_parser("lyrics", help="lyrics stage and cache against a local fake provider, with behavior checks")
+    lyrics_parser.add_argument("--tracks", type=int, default=60)
+    lyrics_parser.add_argument("--provider-latency", type=float, default=0.02, help="seconds per fake lyrics search")
+    lyrics_parser.set_defaults(func=bench_lyrics)
+
+    renamer_parser = subparsers.add_parser("renamer", help="metadata_renamer.main() on a synthetic library")
+    renamer_parser.add_argument("--files", type=int, default=20_000)
+    renamer_parser.add_argument("--threads", type=int, help="renamer worker threads")
+    renamer_parser.set_defaults(func=bench_renamer)
+
+    titles_parser = subparsers.add_parser("titles", help="title cleanup, legacy vs compiled rules")
+    titles_parser.add_argument("--titles", type=int, default=100_000)
+    titles_parser.set_defaults(func=bench_titles)
+
+    art_parser = subparsers.add_parser("art", help="thumbnail fetch and cover crop per track")
+    art_parser.add_argument("--tracks", type=int, default=200)
+    art_parser.add_argument("--albums", type=int, default=20)
+    art_parser.add_argument("--fetch-latency", type=float, default=0.1, help="seconds per fake thumbnail download")
+    art_parser.add_argument("--ffmpeg", help="ffmpeg executable for the per-track crop")
+    art_parser.set_defaults(func=bench_art)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="end-to-end throughput with fake yt-dlp and ffmpeg")
+    pipeline_parser.add_argument("--tracks", type=int, default=100)
+    pipeline_parser.add_argument("--threads", default="1,4,8,16", help="comma separated download thread counts")
+    pipeline_parser.add_argument("--download-latency", type=float, default=0.5, help="seconds per fake download")
+    pipeline_parser.add_argument("--transcode-latency", type=float, default=0.2, help="seconds per fake transcode")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    adaptive_parser = subparsers.add_parser("adaptive", help="fixed vs adaptive download concurrency against a throttling fake")
+    adaptive_parser.add_argument("--tracks", type=int, default=200)
+    adaptive_parser.add_argument("--threads", type=int, default=20, help="fixed download threads, and the adaptive starting point")
+    adaptive_parser.add_argument("--throttle-above", type=int, default=8, help="concurrent downloads the fake yt-dlp answers with 429")
+    adaptive_parser.add_argument("--download-latency", type=float, default=0.5, help="seconds per fake download")
+    adaptive_parser.add_argument("--repeats", type=int, default=2, help="runs of each, taking turns")
+    adaptive_parser.set_defaults(func=bench_adaptive)
+
+    startup_parser = subparsers.add_parser("startup", help="wall-clock time of a run with nothing to download, with checks")
+    startup_parser.add_argument("--files", type=int, default=1000)
+    startup_parser.add_argument("--update-latency", type=float, default=3.0, help="seconds the fake yt-dlp -U takes")
+    startup_parser.set_defaults(func=bench_startup)
+
+    orphans_parser = subparsers.add_parser("orphans", help="orphan lookup, list vs set, with orphan_policy checks")
+    orphans_parser.add_argument("--files", type=int, default=20_000)
+    orphans_parser.add_argument("--orphans", type=int, default=300, help="files in Songs that are not in the input")
+    orphans_parser.set_defaults(func=bench_orphans)
+
+    failures_parser = subparsers.add_parser("failures", help="failure cache: repeated syncs with failing videos, with checks")
+    failures_parser.add_argument("--tracks", type=int, default=20, help="videos that download fine")
+    failures_parser.add_argument("--failing", type=int, default=10, help="private, removed and flaky videos each")
+    failures_parser.add_argument("--download-latency", type=float, default=0.3, help="seconds per fake download")
+    failures_parser.set_defaults(func=bench_failures)
+
+    duplicates_parser = subparsers.add_parser("duplicates", help="duplicate uploads in a playlist, policy off vs skip, with checks")
+    duplicates_parser.add_argument("--tracks", type=int, default=100)
+    duplicates_parser.add_argument("--duplicate-every", type=int, default=4, help="every Nth video repeats the song before it")
+    duplicates_parser.add_argument("--download-latency", type=float, default=0.3, help="seconds per fake download")
+    duplicates_parser.set_defaults(func=bench_duplicates)
+
+    queue_parser = subparsers.add_parser("queue", help="coordinator and worker processes on a shared job queue, with checks")
+    queue_parser.add_argument("--tracks", type=int, default=40)
+    queue_parser.add_argument("--workers", type=int, default=4)
+    queue_parser.add_argument("--lease", type=float, default=2.0, help="queue_lease_seconds of the workers")
+    queue_parser.add_argument("--download-latency", type=float, default=0.5, help="seconds per fake download")
+    queue_parser.set_defaults(func=bench_queue)
+
+    api_parser = subparsers.add_parser("api", help="Downloader requests vs an exe start per request, with checks of the async API")
+    api_parser.add_argument("--files", type=int, default=1000, help="songs in the library of the no-op requests")
+    api_parser.add_argument("--requests", type=int, default=10)
+    api_parser.add_argument("--tracks", type=int, default=20, help="videos per fake playlist in the checks")
+    api_parser.add_argument("--download-latency", type=float, default=0.2, help="seconds per fake download")
+    api_parser.set_defaults(func=bench_api)
+
+    verify_parser = subparsers.add_parser("verify", help="library verification, one process vs a pool vs cached, with checks")
+    verify_parser.add_argument("--files", type=int, default=500)
+    verify_parser.add_argument("--frames", type=int, default=400, help="MPEG frames per song, 26 ms each")
+    verify_parser.add_argument("--processes", type=int, default=os.cpu_count() or 4, help="verify_processes of the pool")
+    verify_parser.set_defaults(func=bench_verify)
+
+    staging_parser = subparsers.add_parser("staging", help="syncs into a slow share, direct vs staged, with checks")
+    staging_parser.add_argument("--tracks", type=int, default=40)
+    staging_parser.add_argument("--latency", type=float, default=0.02, help="seconds per open() on the share, a tenth of it per read and write")
+    staging_parser.add_argument("--download-latency", type=float, default=0.1, help="seconds per fake download")
+    staging_parser.set_defaults(func=bench_staging)
+
+    all_parser = subparsers.add_parser("all", help="every offline benchmark with small sizes")
+    all_parser.set_defaults(func=bench_all)
+
+    args = parser.parse_args()
+    args.func(args)
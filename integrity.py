@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import sqlite3
+import unicodedata
+from library import TagSession, syncsafe, video_id_from_url
+
+"""
+Integrity checks of the audio files in Songs, for ytd.py --verify.
+
+check_audio_file() reads a whole file and walks its container: the MPEG frame
+headers of an MP3, the pages of an Opus/OGG file or the top-level atoms of an
+M4A. A download that was cut short ends in the middle of a frame, page or atom.
+An MP3 can also be cut at a frame boundary, so its frames are added up and
+compared with the frame count of its Xing header and with its TLEN tag (the
+video's duration, written by ytd.py when the file was tagged).
+
+The tags are checked too: artist, title and the video URL have to be there and
+the file name has to match "artist - title". Files with broken audio are the
+ones ytd.py downloads again, tag problems are only reported.
+
+check_audio_file() is a plain function of a path so ytd.py can run it in a
+process pool, VerifyCache keeps its results by size and mtime so only new and
+changed files are checked again.
+"""
+
+# Layer III bitrates in kbit/s by bitrate index, and sample rates by the
+# version bits of the frame header (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+MPEG1_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MPEG2_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# MP3s with more bytes than this outside of frames (and more than 1% of the audio) are corrupt
+MAX_JUNK_BYTES = 4096
+
+
+def mpeg_frame(header):
+    """ Length in bytes, samples and sample rate of the layer III frame starting with these 4 bytes, or None if they are not a frame header. """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (header[1] >> 3) & 3, (header[1] >> 1) & 3
+    bitrate_index, rate_index = header[2] >> 4, (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None # reserved values, another layer or a free format bitrate
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    if version == 3:
+        return 144_000 * MPEG1_BITRATES[bitrate_index] // sample_rate + padding, 1152, sample_rate
+    return 72_000 * MPEG2_BITRATES[bitrate_index] // sample_rate + padding, 576, sample_rate
+
+def info_frame(data, position):
+    """
+    Frame count of the Xing/Info (LAME) or VBRI header in the frame at position.
+
+    Returns:
+        int: The number of audio frames after it, 0 if the header has no count, None if the frame is audio.
+    """
+    mpeg1 = (data[position + 1] >> 3) & 3 == 3
+    mono = data[position + 3] >> 6 == 3
+    offset = position + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17)) # after the side information
+    if data[offset:offset + 4] in (b"Xing", b"Info"):
+        has_frames = int.from_bytes(data[offset + 4:offset + 8], "big") & 1
+        return int.from_bytes(data[offset + 8:offset + 12], "big") if has_frames else 0
+    if data[position + 36:position + 40] == b"VBRI":
+        return int.from_bytes(data[position + 50:position + 54], "big")
+    return None
+
+def check_mp3(data):
+    """
+    Walk the MPEG frames of an MP3 in memory, after its ID3v2 tag and up to its ID3v1 or APEv2 tag.
+
+    Returns:
+        tuple: The problem (str, None if the audio is fine) and the duration of the frames in seconds.
+    """
+    start = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        start = 10 + syncsafe(data[6:10]) + (10 if data[5] & 0x10 else 0) # the footer flag adds 10 bytes
+    end = len(data)
+    if data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    if data[end - 32:end - 24] == b"APETAGEX":
+        # the tag size in the footer counts the footer but not the optional header
+        end -= int.from_bytes(data[end - 20:end - 16], "little") + (32 if data[end - 9] & 0x80 else 0)
+
+    position = start
+    frames = junk = 0
+    duration = 0.0
+    expected_frames = None
+    while position + 4 <= end:
+        frame = mpeg_frame(data[position:position + 4])
+        if frame is None:
+            # lost sync, skip to the next byte that could start a frame
+            next_sync = data.find(b"\xff", position + 1, end)
+            next_sync = end if next_sync == -1 else next_sync
+            junk += next_sync - position
+            position = next_sync
+            continue
+        length, samples, sample_rate = frame
+        if position + length > end:
+            return f"truncated, the last frame is missing {position + length - end} bytes", duration
+        if frames == 0 and expected_frames is None:
+            expected_frames = info_frame(data, position)
+            if expected_frames is not None:
+                position += length
+                continue
+        frames += 1
+        duration += samples / sample_rate
+        position += length
+
+    if frames == 0:
+        return "no MPEG audio frames", 0.0
+    if junk > max(MAX_JUNK_BYTES, (end - start) // 100):
+        return f"corrupt, {junk} bytes of the audio are not MPEG frames", duration
+    if expected_frames and frames < expected_frames - 1:
+        return f"truncated, {frames} of the {expected_frames} frames in its Xing header", duration
+    return None, duration
+
+def check_ogg(data):
+    """ Walk the pages of an Opus/OGG file in memory, the last one has to end the stream. Returns (problem or None, None). """
+    position = 0
+    flags = 0
+    while position < len(data):
+        header = data[position:position + 27]
+        if header[:4] != b"OggS" and len(header) == 27:
+            return f"corrupt, no OGG page at byte {position}", None
+        if len(header) < 27 or position + 27 + header[26] > len(data):
+            return "truncated, the last page is cut off", None
+        body = position + 27 + header[26]
+        size = sum(data[position + 27:body])
+        if body + size > len(data):
+            return f"truncated, the last page is missing {body + size - len(data)} bytes", None
+        flags = header[5]
+        position = body + size
+    if position == 0:
+        return "no OGG pages", None
+    if not flags & 4:
+        return "truncated, the stream has no end page", None
+    return None, None
+
+def check_mp4(data):
+    """ Walk the top-level atoms of an M4A in memory, they have to fill the file and include moov and mdat. Returns (problem or None, None). """
+    position = 0
+    atoms = set()
+    while position + 8 <= len(data):
+        size, kind = int.from_bytes(data[position:position + 4], "big"), data[position + 4:position + 8]
+        header = 8
+        if size == 1: # 64-bit size after the type
+            size, header = int.from_bytes(data[position + 8:position + 16], "big"), 16
+        elif size == 0: # up to the end of the file
+            size = len(data) - position
+        if size < header:
+            return f"corrupt, bad atom size at byte {position}", None
+        if position + size > len(data):
+            return f"truncated, the {kind.decode('latin-1')} atom is missing {position + size - len(data)} bytes", None
+        atoms.add(kind)
+        position += size
+    if position != len(data):
+        return f"corrupt, {len(data) - position} bytes after the last atom", None
+    for kind in (b"moov", b"mdat"):
+        if kind not in atoms:
+            return f"corrupt, no {kind.decode('latin-1')} atom", None
+    return None, None
+
+CONTAINER_CHECKS = {".mp3": check_mp3, ".opus": check_ogg, ".ogg": check_ogg, ".m4a": check_mp4}
+
+def name_key(text):
+    """ A file name as metadata_renamer.py would write it (ASCII, no characters Windows forbids), for comparing names. """
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    return "".join(char for char in text if char not in '/\\:*?"<>|').casefold().strip()
+
+def check_audio_file(file_path, duration_tolerance=3.0):
+    """
+    Check the audio and the tags of one file.
+
+    Args:
+        file_path (str): An MP3, Opus/OGG or M4A file.
+        duration_tolerance (float): Seconds an MP3 may be shorter than its TLEN tag.
+
+    Returns:
+        dict: status ("ok", "warning" for tag problems, "broken" for audio that is cut off or
+        corrupt, "error" if the file could not be read), problems (list of str), url (from the
+        tags), duration (seconds of MPEG frames, MP3 only) and expected (seconds, from TLEN).
+    """
+    result = {"status": "ok", "problems": [], "url": None, "duration": None, "expected": None}
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return dict(result, status="error", problems=[f"unreadable: {e}"])
+
+    problem, result["duration"] = CONTAINER_CHECKS[os.path.splitext(file_path)[1].lower()](data)
+    if problem is not None:
+        result["status"] = "broken"
+        result["problems"].append(problem)
+
+    try:
+        session = TagSession(file_path)
+    except Exception as e:
+        result["status"] = "broken"
+        result["problems"].append(f"unreadable tags: {e}")
+        return result
+    result["url"] = session.get_url()
+    artist, title = session.get("artist"), session.get("title")
+    if not artist or not title:
+        result["problems"].append("no artist or title tag")
+    elif not name_key(os.path.splitext(os.path.basename(file_path))[0]).startswith(name_key(f"{artist} - {title}")):
+        result["problems"].append(f'the file name does not match "{artist} - {title}"')
+    if video_id_from_url(result["url"]) is None:
+        result["problems"].append("no video URL tag")
+
+    length = session.get("length")
+    if length and length.isdigit():
+        result["expected"] = int(length) / 1000
+    if (problem is None and result["expected"] is not None and result["duration"] is not None
+            and result["duration"] < result["expected"] - duration_tolerance):
+        result["status"] = "broken"
+        result["problems"].insert(0, f"truncated, {result['duration']:.0f} of {result['expected']:.0f} seconds")
+    if result["status"] == "ok" and result["problems"]:
+        result["status"] = "warning"
+    return result
+
+
+class VerifyCache:
+    """ Results of check_audio_file() by path, valid as long as the size and mtime of the file stay the same. """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                result TEXT,
+                checked_at REAL
+            )""")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def results(self):
+        """ Map path -> (size, mtime_ns, result) of every cached result. """
+        rows = self.db.execute("SELECT path, size, mtime_ns, result FROM results").fetchall()
+        return {path: (size, mtime_ns, json.loads(result)) for path, size, mtime_ns, result in rows}
+
+    def store(self, rows):
+        """ Save (path, size, mtime_ns, result) tuples in one transaction. """
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                            [(path, size, mtime_ns, json.dumps(result), now) for path, size, mtime_ns, result in rows])
+        self.db.commit()
+
+    def prune(self, paths):
+        """ Drop the results of files that are not in paths any more. """
+        stale = [(path,) for path in set(self.results()) - set(paths)]
+        self.db.executemany("DELETE FROM results WHERE path = ?", stale)
+        self.db.commit()
+        return len(stale)
@@ -0,0 +1,176 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+import contextlib
+from library import video_id_from_url
+
+"""
+Shared download queue for running ytd.py on several hosts against one library.
+
+The coordinator (ytd.py --coordinator) lists the input, skips what the library
+already has and puts every remaining video in a SQLite file on the shared storage
+next to the library. Workers (ytd.py --worker) claim a few jobs at a time, each
+claim is a lease that the worker's heartbeat keeps extending while it downloads.
+When a worker dies its heartbeats stop, the leases run out and the next claim by
+any worker puts those jobs back in the queue. Finished and failed jobs stay in
+the file as the record of who did what.
+
+Every change is one short IMMEDIATE transaction, so the file only needs the
+byte-range locks SQLite uses on any local disk or SMB share. WAL is not used
+since it does not work over network file systems.
+
+job states: pending -> leased -> done, or back to pending when the download
+failed or the lease expired, failed once a job ran out of attempts.
+"""
+
+QUEUE_FILENAME = ".ytd_queue.sqlite"
+
+
+def worker_name():
+    """ Name of this worker process in the queue: host and process ID. """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """ Video download jobs shared by several processes through one SQLite file. Safe to use from several threads. """
+
+    def __init__(self, path, worker=None, lease_seconds=120, max_attempts=3):
+        self.path = path
+        self.worker = worker or worker_name()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # autocommit mode, every change runs in its own explicit transaction
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.transaction():
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    video_id TEXT PRIMARY KEY,
+                    url TEXT,
+                    state TEXT,
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER,
+                    file TEXT,
+                    error TEXT,
+                    updated_at REAL
+                )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, started_at REAL, heartbeat_at REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Hold the write lock of the file for the duration of the block. """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def start_listing(self):
+        """ A new round: workers keep waiting for jobs until finish_listing(). """
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('listing_done', '0')")
+
+    def enqueue(self, urls):
+        """ Add video URLs as pending jobs. Jobs that finished or failed in an earlier round start over. """
+        now = time.time()
+        rows = [(video_id_from_url(url), url, now) for url in urls]
+        with self.transaction():
+            self.db.executemany("""
+                INSERT INTO jobs VALUES (?, ?, 'pending', NULL, NULL, 0, NULL, NULL, ?)
+                ON CONFLICT(video_id) DO UPDATE SET state = 'pending', worker = NULL, attempts = 0, error = NULL,
+                    updated_at = excluded.updated_at
+                WHERE state IN ('done', 'failed')""", rows)
+        return len(rows)
+
+    def finish_listing(self):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('listing_done', '1')")
+
+    def stats(self):
+        """ Number of jobs in every state, and the workers heard from within a lease. """
+        with self.lock:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            alive = [row[0] for row in self.db.execute("SELECT worker FROM workers WHERE heartbeat_at > ?", (time.time() - self.lease_seconds,))]
+        counts = {state: counts.get(state, 0) for state in ("pending", "leased", "done", "failed")}
+        counts["workers"] = alive
+        return counts
+
+    def results(self):
+        """ Map video ID -> state, worker, file and error of every job, including the ones of earlier rounds. """
+        with self.lock:
+            rows = self.db.execute("SELECT video_id, state, worker, file, error FROM jobs").fetchall()
+        return {row[0]: dict(zip(("state", "worker", "file", "error"), row[1:])) for row in rows}
+
+    def drained(self):
+        """ True once the listing is finished and every job is done or failed. """
+        with self.lock:
+            listing_done = self.db.execute("SELECT value FROM meta WHERE key = 'listing_done'").fetchone()
+            open_jobs = self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')").fetchone()[0]
+        return listing_done is not None and listing_done[0] == "1" and open_jobs == 0
+
+    def claim(self, count):
+        """
+        Lease up to count pending jobs to this worker, after putting expired leases back in the queue.
+
+        Returns:
+            list: The URLs of the claimed jobs.
+        """
+        now = time.time()
+        with self.transaction():
+            # leases of workers that stopped sending heartbeats
+            self.db.execute("""
+                UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    error = 'lease of ' || worker || ' expired', worker = NULL, updated_at = ?
+                WHERE state = 'leased' AND lease_until < ?""", (self.max_attempts, now, now))
+            rows = self.db.execute("SELECT video_id, url FROM jobs WHERE state = 'pending' ORDER BY rowid LIMIT ?", (count,)).fetchall()
+            self.db.executemany("""
+                UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+                WHERE video_id = ?""", [(self.worker, now + self.lease_seconds, now, video_id) for video_id, _ in rows])
+        return [url for _, url in rows]
+
+    def heartbeat(self):
+        """ Tell the queue this worker is alive and extend the leases of its jobs. """
+        now = time.time()
+        with self.transaction():
+            self.db.execute("INSERT INTO workers VALUES (?, ?, ?) ON CONFLICT(worker) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                            (self.worker, now, now))
+            self.db.execute("UPDATE jobs SET lease_until = ? WHERE state = 'leased' AND worker = ?", (now + self.lease_seconds, self.worker))
+
+    def complete(self, url, file_path):
+        """ Record a finished job. Returns False if the lease was lost to another worker in the meantime. """
+        with self.transaction():
+            cursor = self.db.execute("""
+                UPDATE jobs SET state = 'done', file = ?, error = NULL, updated_at = ?
+                WHERE video_id = ? AND state = 'leased' AND worker = ?""", (file_path, time.time(), video_id_from_url(url), self.worker))
+        return cursor.rowcount == 1
+
+    def fail(self, url, error, retry=True):
+        """
+        Record a failed job. It goes back in the queue for another worker until it ran out of attempts,
+        or fails right away without retry, e.g. for a private video.
+        """
+        with self.transaction():
+            cursor = self.db.execute("""
+                UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, worker = NULL, updated_at = ?
+                WHERE video_id = ? AND state = 'leased' AND worker = ?""",
+                (self.max_attempts if retry else 0, error, time.time(), video_id_from_url(url), self.worker))
+        return cursor.rowcount == 1
+
+    def release(self):
+        """ Put the jobs this worker still holds back in the queue, e.g. when it is stopped with Ctrl+C. """
+        with self.transaction():
+            self.db.execute("""
+                UPDATE jobs SET state = 'pending', worker = NULL, attempts = attempts - 1, updated_at = ?
+                WHERE state = 'leased' AND worker = ?""", (time.time(), self.worker))
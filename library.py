@@ -0,0 +1,576 @@
+import os
+import re
+import sqlite3
+import base64
+import functools
+import threading
+from urllib.parse import urlparse, parse_qs
+
+"""
+Shared helpers for ytd.py and metadata_renamer.py.
+
+LibraryIndex keeps a small SQLite database inside the Songs directory that maps
+every file to its size, mtime, tags and the video URL stored in its WXXX frame.
+On startup only files whose size or mtime changed are read again, so a big
+library does not have to be fully rescanned on every run. For a Songs directory
+on a network share ytd.py keeps the database on the local disk instead, a mirror
+filled from the local copies of the files it copies to the share.
+
+read_id3_fast() reads the few tags the index needs from an MP3 by walking the
+ID3 frame headers, so covers and lyrics are never read during a scan.
+
+TagSession reads and writes the tags ytd.py uses (artist, title, album, date,
+cover, lyrics and the video URL) the same way for MP3 (ID3), Opus/OGG (Vorbis
+comments) and M4A (MP4 atoms) files. mutagen is only imported once a file
+actually has to be read, so a run where nothing changed doesn't pay for it.
+
+TitleRules cleans YouTube titles ("Artist - Song (Official Video)" -> "Song")
+with the rules in _TitleRules.txt, for the tags ytd.py writes and the file
+names metadata_renamer.py picks.
+"""
+
+INDEX_FILENAME = ".ytd_index.sqlite"
+AUDIO_EXTENSIONS = (".mp3", ".opus", ".ogg", ".m4a")
+
+
+def is_audio_file(filename):
+    """ True for the audio formats ytd.py writes. """
+    return filename.lower().endswith(AUDIO_EXTENSIONS)
+
+
+def is_index_file(filename):
+    """ True for ytd.py's own databases in Songs (the index, the shared job queue) and their SQLite side files. """
+    return os.path.basename(filename).startswith(".ytd_")
+
+
+YOUTUBE_HOSTS = ["youtube.com", "youtu.be", "music.youtube.com", "m.youtube.com"]
+VIDEO_PATHS = ["shorts", "embed", "live", "v"] # youtube.com/<path>/<video id>
+ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def youtube_host(parsed_url):
+    """ The YouTube host of a parsed URL without 'www.', or None for other hosts. """
+    netloc = parsed_url.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return netloc if netloc in YOUTUBE_HOSTS else None
+
+
+def video_id_from_url(url):
+    """
+    Get the video ID of any YouTube or YouTube Music video URL.
+
+    youtu.be/ID, watch?v=ID (also with &list=...), shorts/ID, embed/ID and live/ID
+    all give the same ID, so the same video is recognized whatever form it was pasted in.
+
+    Returns:
+        str: The video ID, or None if the URL is not a video URL.
+    """
+    if not url:
+        return None
+    parsed_url = urlparse(url.strip())
+    host = youtube_host(parsed_url)
+    if host is None:
+        return None
+    path = [part for part in parsed_url.path.split("/") if part]
+    if host == "youtu.be":
+        video_id = path[0] if path else None
+    elif len(path) >= 2 and path[0] in VIDEO_PATHS:
+        video_id = path[1]
+    else:
+        video_id = parse_qs(parsed_url.query).get("v", [None])[0]
+    if video_id and ID_PATTERN.match(video_id):
+        return video_id
+    return None
+
+
+def playlist_id_from_url(url):
+    """ Get the playlist ID (list=...) of a YouTube or YouTube Music URL, or None. """
+    parsed_url = urlparse(url.strip())
+    if youtube_host(parsed_url) is None:
+        return None
+    playlist_id = parse_qs(parsed_url.query).get("list", [None])[0]
+    if playlist_id and ID_PATTERN.match(playlist_id):
+        return playlist_id
+    return None
+
+
+def video_url(video_id):
+    """ The canonical URL of a video, the one written to the MusicVideoURL frame. """
+    return "https://www.youtube.com/watch?v=" + video_id
+
+
+DEFAULT_TITLE_RULES = """\
+# Title cleanup rules for ytd.py and metadata_renamer.py, one rule per line:
+#   remove=TEXT            remove TEXT wherever it appears in a title
+#   remove_regex=REGEX     remove every match of a regular expression
+#   title=TITLE => NEW     rename a whole title after the cleanup
+#   artist_space=CHAR      the artist name is also removed with its spaces written as CHAR
+remove=(Official Video)
+remove=(Official Audio)
+remove=(Official Version)
+remove=(Video)
+remove=(Official Lyric Video)
+remove=(Official Music Video)
+remove=(Official Visualizer)
+remove=(Soundtrack Version)
+remove=Official_Video
+remove=(4K Remaster)
+remove=?
+remove=’
+title=★★★★★ => 5 Stars
+artist_space=_
+"""
+
+
+@functools.lru_cache(maxsize=4096)
+def artist_pattern(artist, spaces):
+    """ Compiled pattern matching an artist name as a whole word, with its spaces written as any of spaces. """
+    forms = sorted({re.escape(artist.replace(" ", space)) for space in (" ",) + spaces}, key=len, reverse=True)
+    return re.compile(r"(?i)\b(?:" + "|".join(forms) + r")\b")
+
+
+class TitleRules:
+    """
+    Title cleanup rules compiled once: every remove and remove_regex rule is
+    merged into a single regular expression, so a title is scanned once no
+    matter how many rules there are.
+
+    Raises:
+        ValueError: If a rule line can't be parsed or a regular expression is invalid.
+    """
+
+    def __init__(self, text=DEFAULT_TITLE_RULES):
+        parts = []
+        self.titles = {}
+        self.artist_spaces = ()
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, separator, value = line.partition("=")
+            kind = kind.strip()
+            if not separator or not value:
+                raise ValueError(f"line {number}: expected kind=value, got '{line}'")
+            if kind == "remove":
+                parts.append(re.escape(value))
+            elif kind == "remove_regex":
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    raise ValueError(f"line {number}: invalid regular expression '{value}': {e}")
+                parts.append(f"(?:{value})")
+            elif kind == "title":
+                title, arrow, new_title = value.partition("=>")
+                if not arrow:
+                    raise ValueError(f"line {number}: expected title=TITLE => NEW, got '{line}'")
+                self.titles[title.strip()] = new_title.strip()
+            elif kind == "artist_space":
+                self.artist_spaces += (value,)
+            else:
+                raise ValueError(f"line {number}: unknown rule '{kind}'")
+        # longest literals first, so "(Official Video)" wins over "(Video)"
+        self.clutter = re.compile("|".join(sorted(parts, key=len, reverse=True))) if parts else None
+
+    @classmethod
+    def load(cls, path):
+        """ The rules in a file, or the default rules if it doesn't exist. """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(f.read())
+
+    def clean(self, title, artist=None):
+        """ Remove the clutter and the artist name from a title and apply the title mappings. """
+        if self.clutter is not None:
+            title = self.clutter.sub("", title)
+        if artist:
+            title = artist_pattern(artist, self.artist_spaces).sub("", title)
+        title = title.strip(' -')
+        return self.titles.get(title, title)
+
+
+class TagSession:
+    """
+    Loads the tags of an audio file once so several changes (cleanup, title fix,
+    lyrics, cover and URL) can be applied in memory and written back with a single save.
+
+    Raises:
+        ValueError: If the file is not an MP3, Opus/OGG or M4A file.
+    """
+
+    # where every field lives in each tag format, the length (TLEN, in milliseconds)
+    # is only kept in MP3s where integrity.py compares it with the frames
+    KEYS = {
+        "id3": {"artist": "TPE1", "title": "TIT2", "album": "TALB", "date": "TDRC",
+                "lyrics": "USLT", "url": "WXXX", "cover": "APIC", "length": "TLEN"},
+        "vorbis": {"artist": "artist", "title": "title", "album": "album", "date": "date",
+                   "lyrics": "lyrics", "url": "musicvideourl", "cover": "metadata_block_picture"},
+        "mp4": {"artist": "\xa9ART", "title": "\xa9nam", "album": "\xa9alb", "date": "\xa9day",
+                "lyrics": "\xa9lyr", "url": "----:com.apple.iTunes:MusicVideoURL", "cover": "covr"},
+    }
+
+    def __init__(self, filename):
+        import mutagen, mutagen.id3, mutagen.mp4, mutagen.oggopus, mutagen.oggvorbis
+        self.filename = filename
+        self.audio = mutagen.File(filename)
+        if self.audio is None:
+            raise ValueError(f"unsupported file type: {filename}")
+        if self.audio.tags is None:
+            self.audio.add_tags()
+        self.tags = self.audio.tags
+        if isinstance(self.tags, mutagen.id3.ID3):
+            self.kind = "id3"
+        elif isinstance(self.tags, mutagen.mp4.MP4Tags):
+            self.kind = "mp4"
+        elif isinstance(self.audio, (mutagen.oggopus.OggOpus, mutagen.oggvorbis.OggVorbis)):
+            self.kind = "vorbis"
+        else:
+            raise ValueError(f"unsupported tag format: {filename}")
+        self.keys = self.KEYS[self.kind]
+
+    def get(self, field, default=None):
+        """ Text value of artist, title, album, date, lyrics or length. """
+        key = self.keys.get(field)
+        if key is None:
+            return default
+        if self.kind == "id3":
+            frames = self.tags.getall(key)
+            if not frames:
+                return default
+            value = frames[0].text if key == "USLT" else (frames[0].text or [None])[0]
+        else:
+            value = (self.tags.get(key) or [None])[0]
+        return str(value) if value else default
+
+    def set(self, field, value):
+        """ Replace artist, title, album, date or length, a length is ignored outside of MP3s. """
+        key = self.keys.get(field)
+        if key is None:
+            return
+        if self.kind == "id3":
+            import mutagen.id3
+            self.tags.setall(key, [mutagen.id3.Frames[key](encoding=3, text=value)])
+        else:
+            self.tags[key] = [value]
+
+    @property
+    def artist(self):
+        return self.get("artist", "Unknown Artist")
+
+    @property
+    def title(self):
+        return self.get("title", "Unknown Title")
+
+    def metadata(self):
+        """ Artist, title, album and date in the same shape as the easy mutagen tags. """
+        return {field: [self.get(field)] for field in ("artist", "title", "album", "date") if self.get(field) is not None}
+
+    def delete_unwanted(self):
+        """ Deletes everything except artist, title, album, date, cover art, lyrics and the video URL. Returns the deleted keys. """
+        allowed = set(self.keys.values())
+        deleted = []
+        for key in list(self.tags.keys()):
+            if self.kind == "id3":
+                key_name = key[:4] # "APIC:Cover" -> "APIC"
+            elif self.kind == "vorbis":
+                key_name = key.lower()
+            else:
+                key_name = key
+            if key_name not in allowed:
+                del self.tags[key]
+                deleted.append(key)
+        return deleted
+
+    def has_lyrics(self):
+        return self.get("lyrics") is not None
+
+    def set_lyrics(self, lyrics):
+        if self.kind == "id3":
+            import mutagen.id3
+            self.tags.add(mutagen.id3.USLT(encoding=3, lang='eng', desc='Lyrics', text=lyrics))
+        else:
+            self.tags[self.keys["lyrics"]] = [lyrics]
+
+    def set_url(self, video_url):
+        import mutagen.id3, mutagen.mp4
+        if self.kind == "id3":
+            self.tags.add(mutagen.id3.WXXX(encoding=3, desc="MusicVideoURL", url=video_url))
+        elif self.kind == "vorbis":
+            self.tags[self.keys["url"]] = [video_url]
+        else:
+            self.tags[self.keys["url"]] = [mutagen.mp4.MP4FreeForm(video_url.encode("utf-8"))]
+
+    def get_url(self):
+        if self.kind == "id3":
+            for tag in self.tags.getall("WXXX"):
+                if tag.desc == "MusicVideoURL":
+                    return tag.url
+            return None
+        values = self.tags.get(self.keys["url"]) or [None]
+        if self.kind == "mp4" and values[0] is not None:
+            return bytes(values[0]).decode("utf-8")
+        return values[0]
+
+    def set_cover(self, jpeg):
+        """ Embed JPEG bytes as the front cover, replacing any existing cover. """
+        import mutagen.id3, mutagen.flac, mutagen.mp4
+        if self.kind == "id3":
+            self.tags.setall("APIC", [mutagen.id3.APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=jpeg)])
+        elif self.kind == "vorbis":
+            picture = mutagen.flac.Picture()
+            picture.type = 3
+            picture.mime = "image/jpeg"
+            picture.data = jpeg
+            self.tags[self.keys["cover"]] = [base64.b64encode(picture.write()).decode("ascii")]
+        else:
+            self.tags[self.keys["cover"]] = [mutagen.mp4.MP4Cover(jpeg, imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
+
+    def save(self, filename=None):
+        """ Write all pending changes, optionally to a file that was renamed after loading. """
+        if filename is not None:
+            self.filename = filename
+        if self.kind == "id3":
+            self.tags.save(self.filename)
+        else:
+            self.audio.save(self.filename)
+
+
+ID3_FIELDS = {b"TPE1": "artist", b"TIT2": "title", b"TALB": "album", b"TDRC": "date"}
+ID3_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+FRAME_ID_PATTERN = re.compile(rb"^[A-Z0-9]{4}$")
+# the dates mutagen reads back as they are: a year of 4 or more digits (yt-dlp's upload_date
+# YYYYMMDD too), then month, day, hour, minute and second of 2 digits each
+TIMESTAMP_PATTERN = re.compile(r"(\d{4}|[1-9]\d{4,})(-\d\d(-\d\d( \d\d(:\d\d(:\d\d)?)?)?)?)?")
+
+def syncsafe(data):
+    """ 28-bit integer stored in 4 bytes of 7 bits each. """
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def id3_text(data):
+    """ First value of an ID3 text frame body, or None. """
+    if not data or data[0] > 3:
+        raise ValueError("bad text encoding")
+    encoding = ID3_ENCODINGS[data[0]]
+    text = data[1:].decode(encoding)
+    return text.split("\x00")[0] or None
+
+def read_id3_fast(file_path):
+    """
+    Read the URL and basic tags of an MP3 by walking the ID3v2.4 frame headers, the frames
+    that are not needed (cover, lyrics) are seeked past without being read.
+
+    Returns None for anything unusual (ID3v2.3, unsynchronisation, extended headers, compressed
+    or encrypted frames, dates mutagen would rewrite, an ID3v1 tag to merge), the caller then reads the file with mutagen instead.
+    """
+    if not file_path.lower().endswith(".mp3"):
+        return None
+    entry = {"url": None, "artist": None, "title": None, "album": None, "date": None}
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(10)
+            if len(header) < 10 or header[:3] != b"ID3" or header[3] != 4 or header[5] & 0xC0:
+                return None
+            end = 10 + syncsafe(header[6:10])
+            position = 10
+            seen = set()
+            while position + 10 <= end:
+                frame_header = f.read(10)
+                if len(frame_header) < 10:
+                    return None
+                frame_id, size, flags = frame_header[:4], syncsafe(frame_header[4:8]), frame_header[9]
+                if frame_id == b"\x00\x00\x00\x00":
+                    break # padding
+                if not FRAME_ID_PATTERN.match(frame_id) or position + 10 + size > end:
+                    return None
+                position += 10 + size
+                wanted = frame_id == b"WXXX" or (frame_id in ID3_FIELDS and frame_id not in seen)
+                if not wanted:
+                    f.seek(size, os.SEEK_CUR)
+                    continue
+                if flags & 0x4F: # grouped, compressed, encrypted, unsynchronised or with a data length indicator
+                    return None
+                body = f.read(size)
+                if frame_id == b"WXXX":
+                    if entry["url"] is None and body and body[0] <= 3:
+                        # encoding, description terminated by a null of the encoding's width, then the latin-1 URL
+                        terminator = b"\x00\x00" if body[0] in (1, 2) else b"\x00"
+                        split = body.find(terminator, 1)
+                        while terminator == b"\x00\x00" and split != -1 and (split - 1) % 2:
+                            split = body.find(terminator, split + 1)
+                        if split == -1:
+                            return None
+                        if body[1:split].decode(ID3_ENCODINGS[body[0]]) == "MusicVideoURL":
+                            entry["url"] = body[split + len(terminator):].decode("latin-1").split("\x00")[0]
+                    continue
+                seen.add(frame_id)
+                value = id3_text(body)
+                if frame_id == b"TDRC" and value is not None and not TIMESTAMP_PATTERN.fullmatch(value):
+                    return None
+                entry[ID3_FIELDS[frame_id]] = value
+            if None in (entry["artist"], entry["title"], entry["album"], entry["date"]):
+                # mutagen fills missing fields from an ID3v1 tag at the end of the file
+                f.seek(max(f.seek(0, os.SEEK_END) - 128, 0))
+                if f.read(3) == b"TAG":
+                    return None
+    except ValueError: # text that does not decode
+        return None
+    return entry
+
+def read_entry(file_path):
+    """
+    Read the URL and basic tags of a file. Files that are not audio files get empty values.
+
+    MP3s go through read_id3_fast() first, mutagen only reads the files it can't handle.
+    """
+    try:
+        entry = read_id3_fast(file_path)
+    except OSError:
+        entry = None
+    if entry is not None:
+        return entry
+    entry = {"url": None, "artist": None, "title": None, "album": None, "date": None}
+    try:
+        session = TagSession(file_path)
+    except Exception:
+        return entry
+    entry["url"] = session.get_url()
+    for key in ("artist", "title", "album", "date"):
+        entry[key] = session.get(key)
+    return entry
+
+
+class LibraryIndex:
+    """ On-disk index of the files in the Songs directory. Safe to use from several threads. """
+
+    COLUMNS = ("path", "size", "mtime_ns", "url", "video_id", "artist", "title", "album", "date")
+
+    def __init__(self, songs_path, db_path=None):
+        self.songs_path = songs_path
+        self.db_path = db_path or os.path.join(songs_path, INDEX_FILENAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False) # workers on other hosts may write too
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                url TEXT,
+                video_id TEXT,
+                artist TEXT,
+                title TEXT,
+                album TEXT,
+                date TEXT
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_video_id ON files(video_id)")
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _scan_directory(self):
+        """ Map absolute path -> os.stat_result for every file in the Songs directory. """
+        files = {}
+        with os.scandir(self.songs_path) as it:
+            for entry in it:
+                if entry.is_file() and not is_index_file(entry.name):
+                    files[os.path.abspath(entry.path)] = entry.stat()
+        return files
+
+    def _row(self, file_path, stat, entry=None):
+        if entry is None:
+            entry = read_entry(file_path)
+        return (file_path, stat.st_size, stat.st_mtime_ns, entry["url"], video_id_from_url(entry["url"]),
+                entry["artist"], entry["title"], entry["album"], entry["date"])
+
+    def _store(self, rows):
+        with self.lock:
+            self.db.executemany(f"INSERT OR REPLACE INTO files VALUES ({','.join('?' * len(self.COLUMNS))})", rows)
+            self.db.commit()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the Songs directory.
+
+        Only new files and files whose size or mtime changed are read again;
+        rows for files that no longer exist are dropped.
+
+        Returns:
+            dict: Counts of 'files', 'updated' and 'removed' entries.
+        """
+        files = self._scan_directory()
+        with self.lock:
+            known = {path: (size, mtime_ns) for path, size, mtime_ns in self.db.execute("SELECT path, size, mtime_ns FROM files")}
+
+        changed = [path for path, stat in files.items() if known.get(path) != (stat.st_size, stat.st_mtime_ns)]
+        removed = [path for path in known if path not in files]
+
+        self._store([self._row(path, files[path]) for path in changed])
+        with self.lock:
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            self.db.commit()
+        return {"files": len(files), "updated": len(changed), "removed": len(removed)}
+
+    def rebuild(self):
+        """ Drop every entry and read all files again. """
+        with self.lock:
+            self.db.execute("DELETE FROM files")
+            self.db.commit()
+        return self.refresh()
+
+    def verify(self):
+        """
+        Re-read every file and compare it with its index entry.
+
+        Mismatching entries are fixed in place.
+
+        Returns:
+            list: (path, problem) tuples for every entry that was wrong.
+        """
+        files = self._scan_directory()
+        entries = {entry["path"]: entry for entry in self.entries()}
+        problems = []
+        rows = []
+        for path, stat in files.items():
+            row = self._row(path, stat)
+            entry = entries.get(path)
+            if entry is None:
+                problems.append((path, "missing from index"))
+                rows.append(row)
+            elif tuple(entry[column] for column in self.COLUMNS) != row:
+                problems.append((path, "stale entry"))
+                rows.append(row)
+        for path in entries:
+            if path not in files:
+                problems.append((path, "file no longer exists"))
+                self.remove(path)
+        self._store(rows)
+        return problems
+
+    def update(self, file_path):
+        """ Re-read a single file, e.g. after it was downloaded or its tags were rewritten. Files outside of Songs are ignored. """
+        file_path = os.path.abspath(file_path)
+        if os.path.normcase(os.path.dirname(file_path)) != os.path.normcase(os.path.abspath(self.songs_path)):
+            return
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self.remove(file_path)
+            return
+        self._store([self._row(file_path, stat)])
+
+    def add(self, files):
+        """ Store (path, os.stat_result, entry) of files whose tags were read from a copy, without reading the files. """
+        self._store([self._row(os.path.abspath(path), stat, entry) for path, stat, entry in files])
+
+    def remove(self, file_path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(file_path),))
+            self.db.commit()
+
+    def entries(self):
+        """ Return every index entry as a dict. """
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM files").fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
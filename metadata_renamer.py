@@ -1,8 +1,12 @@
-import mutagen
 import os
+import argparse
 import unicodedata
+import concurrent.futures
+from library import LibraryIndex, TagSession, TitleRules, is_audio_file
 
 songs_path = os.path.join(os.getcwd(), "Songs")
+title_rules_path = os.path.join(os.getcwd(), "_TitleRules.txt")
+title_rules = TitleRules() # rules from _TitleRules.txt, read by setup()
 
 def colortxt(color, text):
     colors = {
@@ -16,37 +20,40 @@ def colortxt(color, text):
     }
     return colors.get(color, '\033[0m') + text + colors['W']
 
-def read_metadata(file_path):
-    #reads artist, title
+def read_metadata(file_path, normalize_titles=False):
+    #reads artist, title and the tags delete_metadata() would remove, the file is opened once and not written
     try:
-        audio = mutagen.File(file_path, easy=True)
-        if audio is None:
-            print(colortxt("R", f"Error reading {file_path}"))
-            return None
-        return  {
-                    'artist': audio.get('artist', [None])[0],
-                    'title': audio.get('title', [None])[0],
+        session = TagSession(file_path)
+        metadata = {
+                    'path': file_path,
+                    'artist': session.get("artist"),
+                    'title': session.get("title"),
+                    'unwanted': session.delete_unwanted(),
+                    'new_title': None,
                 }
+        if normalize_titles and metadata['title']:
+            title = title_rules.clean(metadata['title'], metadata['artist'])
+            if title and title != metadata['title']:
+                metadata['new_title'] = metadata['title'] = title
+        return metadata
     except Exception as e:
         print(colortxt("R", f"Error reading {file_path}: {e}"))
         return None
     
-def delete_metadata(file_path):
-    #deletes all metadata except artist, title, album
+def delete_metadata(file_path, new_title=None):
+    #deletes all metadata except artist, title, album, date, cover, lyrics and the video URL, and writes a normalized title
     try:
-        audio = mutagen.File(file_path, easy=True)
-        if audio is None:
-            print(colortxt("R", f"Error reading {file_path}"))
-            return None
-        for key in list(audio.keys()):
-            if key not in ['artist', 'title', 'album', 'date']:
-                print(colortxt("B", f"Deleting {key} from {file_path}"))
-                del audio[key]
-        audio.save()
+        session = TagSession(file_path)
+        for key in session.delete_unwanted():
+            print(colortxt("B", f"Deleting {key} from {file_path}"))
+        if new_title:
+            print(colortxt("B", f"Title of {file_path}: {session.title} -> {new_title}"))
+            session.set("title", new_title)
+        session.save()
     except Exception as e:
         print(colortxt("R", f"Error deleting metadata from {file_path}: {e}"))
 
-def rename_file(file_path, artist, title):
+def target_name(artist, title, extension):
     # Normalize and sanitize artist and title
     artist = unicodedata.normalize('NFKD', artist).encode('ascii', 'ignore').decode('ascii')
     title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii')
@@ -56,54 +63,126 @@ def rename_file(file_path, artist, title):
     base_name = f"{artist} - {title}"
     for char in invalid_chars:
         base_name = base_name.replace(char, "")
+    return base_name, extension.lower()
 
-    # Create initial filename and path
-    new_file_name = f"{base_name}.mp3"
-    new_file_path = os.path.join(songs_path, new_file_name)
-
-    # Handle name collisions
-    if (file_path == new_file_path):
-        #print(colortxt("B", f"File {file_path} already has the correct name."))
-        return
-    counter = 1
-    while os.path.exists(new_file_path):
-        new_file_name = f"AAAWARNING_REPEATED_({counter}){base_name}.mp3"
-        print(colortxt("Y", f"File name collision: {new_file_name} already exists."))
-        if len(new_file_name) > 255:
-            new_file_name = new_file_name[:255]
-        new_file_path = os.path.join(songs_path, new_file_name)
-        counter += 1
+def plan_renames(files, entries):
+    """
+    Pick the new name of every file in one pass over the metadata, without touching the disk.
 
-    try:
-        os.rename(file_path, new_file_path)
-        print(colortxt("B", f"Renamed {file_path} to {new_file_name}"))
-    except Exception as e:
-        print(colortxt("R", f"Error renaming {file_path}: {e}"))
+    Files are handled in sorted order, so the same folder always gets the same plan. A name is free
+    if no other file has it now (case-insensitively on Windows) and no earlier file was planned to it;
+    a file that already has its name keeps it.
+
+    Args:
+        files (list): Every file name in the Songs folder.
+        entries (list): read_metadata() results of the audio files to rename.
+
+    Returns:
+        dict: Current path -> new path of the files whose name changes.
+    """
+    taken = {os.path.normcase(file) for file in files}
+    renames = {}
+    for entry in sorted(entries, key=lambda entry: entry['path']):
+        current = os.path.basename(entry['path'])
+        base_name, extension = target_name(entry['artist'], entry['title'], os.path.splitext(current)[1])
+        new_file_name = f"{base_name}{extension}"
+        if new_file_name == current:
+            continue
+        # Handle name collisions
+        counter = 1
+        while os.path.normcase(new_file_name) in taken and os.path.normcase(new_file_name) != os.path.normcase(current):
+            new_file_name = f"AAAWARNING_REPEATED_({counter}){base_name}{extension}"
+            if len(new_file_name) > 255:
+                new_file_name = new_file_name[:255]
+            counter += 1
+        if new_file_name == current:
+            continue # already renamed around the same collision by an earlier run
+        if counter > 1:
+            print(colortxt("Y", f"File name collision: {base_name}{extension} already exists, using {new_file_name}."))
+        taken.add(os.path.normcase(new_file_name))
+        renames[entry['path']] = os.path.join(songs_path, new_file_name)
+    return renames
+
+def apply_file(entry, new_file_path):
+    # rewrite the tags only if something has to go or the title changes, then rename
+    file_path = entry['path']
+    if entry['unwanted'] or entry['new_title']:
+        delete_metadata(file_path, entry['new_title'])
+    if new_file_path is not None:
+        try:
+            os.rename(file_path, new_file_path)
+            print(colortxt("B", f"Renamed {file_path} to {os.path.basename(new_file_path)}"))
+        except Exception as e:
+            print(colortxt("R", f"Error renaming {file_path}: {e}"))
 
 def setup():
+    global title_rules
     if not os.path.exists(songs_path):
         print(colortxt("Y", "Songs directory not found, creating it..."))
         os.makedirs(songs_path)
+    try:
+        title_rules = TitleRules.load(title_rules_path)
+    except ValueError as e:
+        print(colortxt("R", f"Error in {title_rules_path}, using the default title rules: {e}"))
+
+
+def main(threads=None, dry_run=False, normalize_titles=False):
+    """
+    Read the tags of every song with a pool of workers, plan every rename in memory,
+    then rewrite tags and rename files in parallel.
+
+    Args:
+        threads (int): Worker threads, defaults to a few per CPU since the work is mostly file I/O.
+        dry_run (bool): Only print the plan.
+        normalize_titles (bool): Clean every title again with the current _TitleRules.txt, in the tags and the file names.
+    """
+    threads = threads or min(32, (os.cpu_count() or 1) * 4)
+    files = os.listdir(songs_path)
+    paths = [os.path.join(songs_path, file) for file in files if is_audio_file(file)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda path: read_metadata(path, normalize_titles), paths))
+
+    entries = []
+    for file_path, metadata in zip(paths, results):
+        if metadata is None:
+            print(colortxt("Y", f"Skipping {file_path} due to read error."))
+        elif metadata['artist'] and metadata['title']:
+            entries.append(metadata)
+        else:
+            print(colortxt("Y", f"Missing artist or title in {file_path}, skipping..."))
+            print(colortxt("Y", f"Artist: {metadata['artist']}, Title: {metadata['title']}"))
+            entries.append(dict(metadata, artist=None))
+    renames = plan_renames(files, [entry for entry in entries if entry['artist']])
+
+    if dry_run:
+        for entry in entries:
+            if entry['path'] in renames:
+                print(colortxt("B", f"Would rename {entry['path']} to {os.path.basename(renames[entry['path']])}"))
+            for key in entry['unwanted']:
+                print(colortxt("B", f"Would delete {key} from {entry['path']}"))
+            if entry['new_title']:
+                print(colortxt("B", f"Would change the title of {entry['path']} to {entry['new_title']}"))
+        cleaned = sum(1 for entry in entries if entry['unwanted'] or entry['new_title'])
+        print(colortxt("B", f"{len(renames)} files to rename, {cleaned} files to clean up."))
+        return renames
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(apply_file, entry, renames.get(entry['path'])) for entry in entries]
+        for future in futures:
+            future.result()
 
-def main():
-    for file in os.listdir(songs_path):
-        if file.lower().endswith(".mp3"):
-            file_path = os.path.join(songs_path, file)
-            metadata = read_metadata(file_path)
-            if metadata:
-                artist = metadata['artist']
-                title = metadata['title']
-                delete_metadata(file_path)
-                if artist and title:
-                    rename_file(file_path, artist, title)
-                else:
-                    print(colortxt("Y", f"Missing artist or title in {file_path}, skipping..."))
-                    print(colortxt("Y", f"Artist: {artist}, Title: {title}"))
-            else:
-                print(colortxt("Y", f"Skipping {file_path} due to read error."))
+    # keep the ytd.py library index in sync with the renames and tag rewrites, in one transaction
+    index = LibraryIndex(songs_path)
+    index.refresh()
+    index.close()
+    return renames
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean up the tags of the songs and rename them to 'artist - title'")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be renamed and cleaned up")
+    parser.add_argument("--threads", type=int, help="worker threads (default: 4 per CPU, at most 32)")
+    parser.add_argument("--normalize-titles", action="store_true", help="clean every title again with the rules in _TitleRules.txt")
+    args = parser.parse_args()
     setup()
-    main()
+    main(args.threads, args.dry_run, args.normalize_titles)
     input(colortxt("B", "Press Enter to exit..."))
\ No newline at end of file
@@ -1,26 +1,69 @@
 import subprocess
 import os
+import io
 import re
 import sys
+import glob
+import json
+import time
+import hashlib
+import queue
+import shutil
+import tempfile
+import sqlite3
+import argparse
+import importlib
+import threading
+import contextlib
+import contextvars
+import collections
+import unicodedata
+import asyncio
+import statistics
+import multiprocessing
 import concurrent.futures
-from urllib.parse import urlparse, parse_qs
-import mutagen
-import mutagen.id3
-import syncedlyrics
+from job_queue import JobQueue, QUEUE_FILENAME
+from integrity import VerifyCache, check_audio_file
+from library import LibraryIndex, TagSession, TitleRules, read_id3_fast, read_entry, DEFAULT_TITLE_RULES, INDEX_FILENAME, is_index_file, is_audio_file, video_id_from_url, playlist_id_from_url, video_url
 
 """
 how main works:
 setup():
     creates txt files
-    creates Songs and Temp directories
-    updates yt-dlp
+    creates Songs, Temp and cache directories
+    updates yt-dlp in the background, at most once per update_check_hours (cache/yt-dlp-update.json)
 main():
-    reads input urls from _Input.txt
+    reads input urls from _Input.txt, playlists are listed concurrently and streamed into the downloads
     reads params from _Params.txt
-    checks which videos are already downloaded by reading the metadata of the files in Songs
-    downloads the videos that are not already downloaded using yt-dlp and ffmpeg
-    asks the user if they want to delete files in Songs that are not in the expected files list
-    cleans up the Temp directory
+    checks which videos are already downloaded using the library index (.ytd_index.sqlite in Songs),
+    only files that changed since the last run have their metadata read again
+    downloads the videos that are not already downloaded with yt-dlp, the number of concurrent
+    downloads adapts to throughput and throttling (see ADAPTIVE CONCURRENCY)
+    and converts them to mp3 with ffmpeg (transcode_threads at a time)
+    embeds lyrics in a separate pool of lyrics workers, cached in cache/lyrics.sqlite
+    skips videos whose listed artist and title match a song in Songs or earlier in the input
+    (duplicate_policy, see DUPLICATE DETECTION)
+    skips videos that failed before (private, removed, blocked...) until their entry in
+    cache/failures.sqlite expires, see FAILURE CACHE
+    with Songs on a network share, tags and lyrics are written in temp and the finished songs copied
+    to the share in batches, the library index is a local mirror in the cache (staging, see STAGING)
+    keeps, quarantines or deletes the files in Songs that are not in the input (orphan_policy),
+    without prompts, and lists them in cache/orphans.json
+    cleans up the Temp directory, keeping the files of unfinished videos (see JobJournal)
+watch() (--watch):
+    same as main() without prompts, stays running and syncs again when _Input.txt changes
+    or every watch_interval_minutes, only looking at videos that are new since the last check
+Downloader (see EMBEDDING API):
+    the same sync as main() for programs that import ytd.py, as an asyncio API that yields a
+    TrackResult per video; main() is a Downloader of the params in _Params.txt
+coordinate() (--coordinator) and work() (--worker):
+    several hosts sharing one Songs directory: the coordinator lists the input and puts the
+    videos to download in a job queue (.ytd_queue.sqlite in Songs, see job_queue.py), workers
+    lease a few jobs at a time and download them, jobs of a dead worker go back to the queue
+verify_library() (--verify):
+    checks the audio and tags of every file in Songs in a process pool (see integrity.py),
+    only files that changed since they were last checked (cache/verify.sqlite), and downloads
+    the truncated or corrupt ones again (verify_policy)
 
 TODO:
     - Custom output directory
@@ -63,6 +106,18 @@ def normalize_path(path):
     else:
         return os.path.abspath(os.path.join(os.getcwd(), path))
 
+def is_network_path(path):
+    """ True for a UNC path ("\\\\Server\\Songs") and, on Windows, for a drive letter mapped to a network share. """
+    if path.startswith("\\\\?\\"): # long path prefix
+        path = "\\\\" + path[8:] if path[4:8].upper() == "UNC\\" else path[4:]
+    if path.startswith(("\\\\", "//")):
+        return True
+    if os.name == "nt":
+        import ctypes
+        drive = os.path.splitdrive(path)[0]
+        return bool(drive) and ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") == 4 # DRIVE_REMOTE
+    return False
+
 
 
 
@@ -74,10 +129,15 @@ def normalize_path(path):
 input_file_path = os.path.join(os.getcwd(), "_Input.txt")
 instructions_file_path = os.path.join(os.getcwd(), "_Instructions.txt")
 params_file_path = os.path.join(os.getcwd(), "_Params.txt")
-global songs_path
-temp_path = os.path.join(os.getcwd(), "temp")
-yt_dlp_path = get_resource_path("src", "yt-dlp.exe")
-ffmpeg_path = get_resource_path("src", "ffmpeg.exe")
+title_rules_path = os.path.join(os.getcwd(), "_TitleRules.txt")
+update_thread = None # background yt-dlp -U started by setup(), see start_update_check()
+current_run = contextvars.ContextVar("current_run") # Run of the sync this code is part of, see this_run()
+listing_fields = ("id", "title", "uploader", "channel", "artist", "track", "duration") # flat playlist metadata, see DUPLICATE DETECTION
+info_fields = ("id", "filepath", "ext", "acodec", "thumbnail", "title", "track", "artist", "creator", "uploader", "album", "upload_date", "duration") # yt-dlp metadata used after the download
+
+
+
+
 
 
 
@@ -86,6 +146,105 @@ ffmpeg_path = get_resource_path("src", "ffmpeg.exe")
 
 
 
+# RUN STATE ================================================
+# Everything a sync works with lives in a Run: the params, the directories and
+# tools, and the state open_run() keeps warm. The command line works with
+# default_run, set up from _Params.txt by setup(). A Downloader (see EMBEDDING
+# API) has a Run of its own and makes it the current_run of its threads, so
+# several of them can sync into different libraries in one process.
+# Threads started with start_thread() keep the Run of the thread that started them.
+
+class YoutubeDLPool:
+    """ Idle YoutubeDL instances of a Run's inprocess engine (see YT-DLP ENGINES), lent to one thread at a time and created when none is idle. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {False: [], True: []} # flat -> instances nobody is using
+        self.instances = []
+        self.finished = {} # YoutubeDL -> info_dict of the file its last download moved into place
+
+    @contextlib.contextmanager
+    def lend(self, flat=False):
+        """ A YoutubeDL for flat playlist listing or for downloads, only for the current thread until the block ends. """
+        with self.lock:
+            ydl = self.idle[flat].pop() if self.idle[flat] else None
+        if ydl is None:
+            ydl = self.new_youtube_dl(flat)
+        try:
+            yield ydl
+        finally:
+            with self.lock:
+                if ydl in self.instances: # not closed in the meantime
+                    self.idle[flat].append(ydl)
+
+    def new_youtube_dl(self, flat):
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(youtube_dl_options(flat))
+        def on_postprocessor(d):
+            # MoveFiles always runs last, its info_dict has the final file path
+            if d['status'] == 'finished' and d['postprocessor'] == 'MoveFiles':
+                self.finished[ydl] = d['info_dict']
+        ydl.add_postprocessor_hook(on_postprocessor)
+        with self.lock:
+            self.instances.append(ydl)
+        return ydl
+
+    def close(self):
+        """ Close every instance, the next download creates new ones. """
+        with self.lock:
+            instances, self.instances = self.instances, []
+            self.idle = {False: [], True: []}
+            self.finished.clear()
+        for ydl in instances:
+            ydl.close()
+
+class Run:
+    """ The params, directories and open state of one library. Directories come from the params output, temp_path and cache_path. """
+
+    def __init__(self, params=None):
+        self.params = dict(params or {}) # key=value pairs from _Params.txt or a Downloader config
+        self.title_rules = TitleRules() # rules from _TitleRules.txt, read by setup()
+        self.engine = None # "subprocess" or "inprocess", see get_engine()
+        self.library_index = None # LibraryIndex of songs_path, opened by open_run()
+        self.job_journal = None # JobJournal in temp_path, opened by open_run()
+        self.art_cache = None # ArtCache in cache_path, opened by open_run()
+        self.download_limiter = None # AdaptiveLimiter of the current run, opened by open_run()
+        self.failure_cache = None # FailureCache in cache_path, opened by open_run()
+        self.run_metrics = None # RunMetrics of the current run, opened by open_run()
+        self.youtube_dls = YoutubeDLPool() # YoutubeDL instances of the inprocess engine, closed by close_run()
+        self.configure()
+
+    def configure(self):
+        """ Set the directories and tools from the params. """
+        self.songs_path = normalize_path(str(self.params.get("output", "Songs")))
+        self.temp_path = normalize_path(str(self.params.get("temp_path", "temp")))
+        self.cache_path = normalize_path(str(self.params.get("cache_path", "cache")))
+        self.yt_dlp_path = normalize_path(str(self.params["yt_dlp_path"])) if "yt_dlp_path" in self.params else get_resource_path("src", "yt-dlp.exe")
+        self.ffmpeg_path = normalize_path(str(self.params["ffmpeg_path"])) if "ffmpeg_path" in self.params else get_resource_path("src", "ffmpeg.exe")
+        # staging=on, off or auto (on for a Songs directory on a network share), see STAGING
+        staging = str(self.params.get("staging", "auto")).lower()
+        self.staging = staging == "on" or (staging == "auto" and is_network_path(self.songs_path))
+        self.staging_path = os.path.join(self.temp_path, "staged")
+        # a staged library's index is a mirror in the cache, one per Songs directory
+        songs_key = hashlib.sha1(os.path.normcase(self.songs_path).encode("utf-8")).hexdigest()[:12]
+        self.index_path = os.path.join(self.cache_path, f"index-{songs_key}.sqlite") if self.staging else None
+
+default_run = Run()
+
+def this_run():
+    """ The Run of the current thread: the one of its Downloader, or default_run. """
+    return current_run.get(default_run)
+
+def start_thread(target, *args):
+    """ Start a daemon thread that runs target with the Run of the current thread. """
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target, *args), daemon=True)
+    thread.start()
+    return thread
+
+
+
+
+
 
 
 
@@ -104,21 +263,116 @@ def colortxt(color, text):
     }
     return colors.get(color, '\033[0m') + text + colors['W']
 
-def clean_directory(path):
-    """ Delete all files in a directory. """
-    # Delete all files in the directory
-    for filename in os.listdir(path):
-        file_path = os.path.join(path, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            print(colortxt("R", f"Error deleting file {file_path}: {e}"))
+def get_param(name, default, cast=str):
+    """ Get a value from _Params.txt, falling back to the default if it is missing or invalid. """
+    try:
+        return cast(this_run().params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+
+
+
 
 
 
 
+# METRICS ================================================
+# Every pipeline stage of every track is timed and written as one JSON line to
+# events_file (default cache/events.jsonl):
+#   {"run": ..., "stage": "download", "video_id": ..., "seconds": 4.2, "ok": true, "bytes": 3481920}
+# Stages: library_scan, playlist_listing, download, art (thumbnail fetch and
+# crop), transcode (ffmpeg), tagging, rename and lyrics. main() prints a summary at the end of
+# the run and metrics_hook=module:function in _Params.txt forwards every event
+# to another metrics system.
 
+class RunMetrics:
+    """ Collects the timing events of one run, writes them to a JSON lines file and forwards them to hooks. """
+
+    def __init__(self, path, hooks=()):
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        self.start = time.time()
+        self.events = []
+        self.hooks = list(hooks)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def emit(self, event):
+        event = dict(event, run=self.run_id, time=time.time())
+        with self.lock:
+            self.events.append(event)
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                print(colortxt("R", f"Error in metrics hook {hook}: {e}"))
+
+    def reset(self):
+        """ Start counting a new cycle of watch mode, the events file keeps everything. """
+        with self.lock:
+            self.events = []
+            self.start = time.time()
+
+    def summary(self):
+        """ Print p50/p95/max per stage, downloaded bytes and tracks per minute. """
+        minutes = (time.time() - self.start) / 60
+        tracks = sum(1 for event in self.events if event['stage'] == "rename" and event['ok'])
+        downloaded = sum(event.get('bytes', 0) for event in self.events if event['stage'] == "download")
+        print(colortxt("C", f"{'stage':<18}{'count':>7}{'p50 s':>9}{'p95 s':>9}{'max s':>9}{'failed':>8}"))
+        stages = {}
+        for event in self.events:
+            stages.setdefault(event['stage'], []).append(event)
+        for stage, events in stages.items():
+            seconds = sorted(event['seconds'] for event in events)
+            failed = sum(1 for event in events if not event['ok'])
+            print(colortxt("C", f"{stage:<18}{len(seconds):>7}{percentile(seconds, 50):>9.2f}{percentile(seconds, 95):>9.2f}{seconds[-1]:>9.2f}{failed:>8}"))
+        print(colortxt("C", f"{tracks} tracks in {minutes:.1f} min ({tracks / max(minutes, 1e-9):.1f} tracks/min), {downloaded / 1e6:.1f} MB downloaded"))
+
+    def close(self):
+        self.file.close()
+
+def percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list. """
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[int(index)]
+
+def load_metrics_hook(spec):
+    """ Import a "module:function" metrics hook from _Params.txt, returns None if it can't be loaded. """
+    try:
+        module_name, function_name = spec.split(":", 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    except Exception as e:
+        print(colortxt("R", f"Error loading metrics hook {spec}: {e}"))
+        return None
+
+@contextlib.contextmanager
+def stage_timer(stage, url=None, **fields):
+    """
+    Time a pipeline stage and emit it to run_metrics.
+
+    The caller can set event['ok'] = False for failures that don't raise, or add fields like event['bytes'].
+    """
+    run = this_run()
+    event = dict(fields, stage=stage, video_id=video_id_from_url(url), ok=True)
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException:
+        event['ok'] = False
+        raise
+    finally:
+        event['seconds'] = time.perf_counter() - start
+        if run.run_metrics is not None:
+            run.run_metrics.emit(event)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
 
 
 
@@ -131,78 +385,174 @@ def clean_directory(path):
 # YT-DLP FUNCTIONS ================================================
 
 def is_playlist(url):
-    # Parse the URL
-    parsed_url = urlparse(url)
-    query_params = parse_qs(parsed_url.query)
-    valid_hosts = ["youtube.com", "youtu.be", "music.youtube.com", "www.youtube.com", "m.youtube.com"]
-    
-    # Normalize the domain by removing 'www.' if present
-    netloc = parsed_url.netloc.lower()
-    if netloc.startswith("www."):
-        netloc = netloc[4:]
-    
-    # Check if the host is a valid YouTube domain
-    if netloc in valid_hosts:
-        # Check if the URL path contains 'playlist' or if the query contains 'list'
-        if 'list' in query_params:
-            return True
-    return False
+    """ Returns the playlist ID of a YouTube playlist URL (any URL with list=...), or None. """
+    return playlist_id_from_url(url)
 
 
 def is_video(url):
-    # Parse the URL
-    parsed_url = urlparse(url)
-    valid_hosts = ["youtube.com", "youtu.be", "music.youtube.com", "www.youtube.com", "m.youtube.com"]
-    
-    # Normalize the domain by removing 'www.' if present
-    netloc = parsed_url.netloc.lower()
-    if netloc.startswith("www."):
-        netloc = netloc[4:]
-    
-    # Check if the host is a valid YouTube domain
-    if netloc in valid_hosts:
-        # For youtu.be, the video ID is in the path
-        if netloc == "youtu.be":
-            return True
-        # For other YouTube domains, check if the URL path contains 'watch'
-        if 'watch' in parsed_url.path or 'v=' in parsed_url.query:
-            return True
-    return False
+    """
+    Returns the video ID of a YouTube video URL, or None.
+
+    music.youtube.com, youtu.be, shorts and watch?v=...&list=... forms of the same video give the same ID.
+    """
+    return video_id_from_url(url)
+
+def stream_playlist_videos(url, on_video_id, on_info=None):
+    """
+    Call on_video_id with every video ID of a YouTube playlist URL as soon as yt-dlp lists it.
+
+    on_video_id may block, which pauses the listing until the caller catches up.
+    on_info, if given, gets the listing_fields of every video just before its ID.
+    Returns False if the listing failed, the IDs passed so far may be only part of the playlist.
+    """
+    with stage_timer("playlist_listing", playlist=url) as event:
+        event['videos'] = 0
+        def count(video_id):
+            event['videos'] += 1
+            on_video_id(video_id)
+        if get_engine() == "inprocess":
+            listed = stream_playlist_videos_inprocess(url, count, on_info)
+        else:
+            listed = stream_playlist_videos_subprocess(url, count, on_info)
+        event['ok'] = listed and event['videos'] > 0
+    return listed
 
-def get_playlist_videos(url):
-    """ Get video IDs from a YouTube playlist URL. """
+def stream_playlist_videos_subprocess(url, on_video_id, on_info=None):
+    """ Same as stream_playlist_videos() using yt-dlp.exe. """
+    wait_for_update()
     command = [
-        yt_dlp_path,
+        this_run().yt_dlp_path,
         "--flat-playlist",
-        "--get-id",
+        "--print", "%(.{" + ",".join(listing_fields) + "})j",
         url
     ]
 
-    # Run yt-dlp command
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(colortxt("R", f"Error fetching playlist videos: {result.stderr}"))
-        return []
-    return result.stdout
+    # Run yt-dlp command, stderr goes to a file so a chatty yt-dlp can't fill the pipe while we read stdout
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        for line in process.stdout:
+            try:
+                info = json.loads(line)
+            except ValueError:
+                continue
+            if info.get('id'):
+                if on_info is not None:
+                    on_info(info)
+                on_video_id(info['id'])
+        if process.wait() != 0:
+            stderr.seek(0)
+            print(colortxt("R", f"Error fetching playlist videos: {stderr.read()}"))
+            return False
+    return True
 
+def stream_input_urls(lines, failed_listings=None, listed_info=None):
+    """
+    Yield the canonical URL of every video in the input lines, each video only once.
+
+    Single videos come first. All playlists are listed at the same time in their
+    own threads and their videos are yielded as soon as they are listed, so the
+    first downloads can start before the longest playlist is fully listed.
+    Playlists that could not be listed are added to the failed_listings list.
+    The listing_fields of every playlist video go into the listed_info dict by video ID,
+    before the video is yielded (single videos are not listed, they have none).
+    """
+    playlists = []
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):  # Skip empty lines and comments
+            continue
+        video_id = is_video(line)
+        if video_id:
+            if video_id not in seen:
+                seen.add(video_id)
+                yield video_url(video_id)
+        elif is_playlist(line):
+            playlists.append(line)
+        else:
+            print(colortxt("R", f"Invalid URL: {line}"))
 
+    # Bounded, so listings pause while the downloads are busy
+    id_queue = queue.Queue(maxsize=1000)
+    closed = threading.Event() # the caller stopped early, the rest of the listings is dropped
+    def put(video_id):
+        while not closed.is_set():
+            try:
+                return id_queue.put(video_id, timeout=1)
+            except queue.Full:
+                continue
+    def keep_info(info):
+        listed_info[info['id']] = info
+    def list_playlist(url):
+        try:
+            if not stream_playlist_videos(url, put, keep_info if listed_info is not None else None) and failed_listings is not None:
+                failed_listings.append(url)
+        finally:
+            put(None)
+    for playlist in playlists:
+        start_thread(list_playlist, playlist)
+
+    running = len(playlists)
+    try:
+        while running:
+            video_id = id_queue.get()
+            if video_id is None:
+                running -= 1
+            elif video_id not in seen:
+                seen.add(video_id)
+                yield video_url(video_id)
+    finally:
+        closed.set()
+
+def fetch_audio(url):
+    """
+    Network stage: download the best audio stream into Temp, without any post-processing,
+    and look the thumbnail up in the art cache.
 
-def download_video(url):
+    Returns:
+        dict: The job for the transcode stage (url, yt-dlp metadata, raw audio path and cover key), or None on error.
+    """
+    run = this_run()
+    retries = get_param("throttle_retries", 2, int)
+    for attempt in range(retries + 1):
+        with download_slot(), stage_timer("download", url) as event:
+            event['fragments'] = fragment_count()
+            if get_engine() == "inprocess":
+                info, error = fetch_audio_inprocess(url)
+            else:
+                info, error = fetch_audio_subprocess(url)
+            event['ok'] = info is not None
+            if info is None:
+                event['throttled'] = is_throttled(error)
+            else:
+                event['bytes'] = file_size(info['filepath'])
+        if run.download_limiter is not None:
+            run.download_limiter.record(event)
+        if info is not None or not event['throttled'] or attempt == retries:
+            break
+        # wait for the limiter to slow down before trying again
+        print(colortxt("Y", f"Throttled while downloading {url}, retrying..."))
+        time.sleep(2 ** attempt)
+    if info is None:
+        record_failure(url, error)
+        return None
+    if run.failure_cache is not None and run.failure_cache.entries.get(video_id_from_url(url)):
+        run.failure_cache.clear({video_id_from_url(url)})
+    job = {"url": url, "info": info, "audio": info['filepath'], "art": fetch_art(url, info.get('thumbnail'))}
+    record_stage(url, "downloaded", info=info, audio=job['audio'], art=job['art'])
+    return job
+
+def fetch_audio_subprocess(url):
+    """ Download a video with yt-dlp.exe, returns (metadata printed after the download, None) or (None, error message). """
+    run = this_run()
+    wait_for_update()
     command = [
-        yt_dlp_path,
-        "--ffmpeg-location", os.path.dirname(ffmpeg_path),
-        "-P", "home:" + songs_path,
-        "-P", "temp:" + temp_path,
-        "-N", "6",
+        run.yt_dlp_path,
+        "-P", run.temp_path,
+        "-N", str(fragment_count()),
         "--format", "bestaudio",
-        "-x",
-        "--audio-format", "mp3",
-        "--embed-thumbnail",
-        "--embed-metadata",
-        "--restrict-filenames",
-        "--ppa", "EmbedThumbnail+ffmpeg_o:-c:v mjpeg -vf crop=\"'if(gt(ih,iw),iw,ih)':'if(gt(iw,ih),ih,iw)'\"",#crop to square image
-        "--print", "after_move:%(filepath)s",
-        "-o", "%(artist,uploader)s - %(title)s.%(ext)s",
+        "--print", "after_move:%(.{" + ",".join(info_fields) + "})j",
+        "-o", "%(id)s.%(ext)s",
         url
     ]
 
@@ -210,151 +560,1065 @@ def download_video(url):
     result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         print(colortxt("R", f"Error downloading video: {result.stderr}"))
+        return None, result.stderr
+
+    try:
+        return json.loads(result.stdout.strip().splitlines()[-1]), None
+    except (IndexError, ValueError) as e:
+        print(colortxt("R", f"Error reading yt-dlp output for {url}: {e}"))
+        return None, str(e)
+
+def fragment_count():
+    """ yt-dlp's -N for the next download: the download_limiter's current value while one is running. """
+    run = this_run()
+    if run.download_limiter is not None:
+        return run.download_limiter.fragments
+    return get_param("fragments", 6, int)
+
+def start_update_check():
+    """ Start yt-dlp -U in a background thread if the last check is older than update_check_hours. """
+    global update_thread
+    run = this_run()
+    if update_thread is not None and update_thread.is_alive():
+        return # another Run started one
+    state_path = os.path.join(run.cache_path, "yt-dlp-update.json")
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    ttl = get_param("update_check_hours", 24, float) * 3600
+    if not state.get("ok", True):
+        ttl = min(ttl, 3600) # the last check failed (offline?), try again sooner
+    if time.time() - state.get("checked_at", 0) < ttl:
         return
+    update_thread = start_thread(update_yt_dlp, run.yt_dlp_path, state_path)
 
-    # Get the output file path from the command result
-    output_file = result.stdout.strip()
+def update_yt_dlp(yt_dlp_path, state_path):
+    """ Run yt-dlp -U and record when it ran. A failed update only warns, the installed yt-dlp keeps working. """
+    try:
+        result = subprocess.run([yt_dlp_path, "-U"], capture_output=True, text=True, timeout=300)
+        ok = result.returncode == 0
+        message = (result.stdout if ok else result.stderr).strip()
+    except (OSError, subprocess.SubprocessError) as e:
+        ok, message = False, str(e)
+    last_line = message.splitlines()[-1] if message else ""
+    if ok:
+        print(colortxt("B", f"yt-dlp update check: {last_line or 'done'}"))
+    else:
+        print(colortxt("Y", f"Could not update yt-dlp, using the installed version: {last_line}"))
+    try:
+        with open(state_path, 'w') as f:
+            json.dump({"checked_at": time.time(), "ok": ok}, f)
+    except OSError as e:
+        print(colortxt("R", f"Error writing {state_path}: {e}"))
 
-    delete_unwanted_metadata(output_file)
-    fix_title(output_file)
-    metadata = read_metadata(output_file)
+def wait_for_update():
+    """ Block until a running yt-dlp -U is done, so yt-dlp.exe is never started while it replaces itself. """
+    if update_thread is not None:
+        update_thread.join()
 
-    fetch_lyrics(output_file)
 
-    # rename file to "artist - title.mp3"
-    new_filename = f"{metadata.get('artist', ['Unknown Artist'])[0]} - {metadata.get('title', ['Unknown Title'])[0]}.mp3"
-    new_filepath = os.path.join(songs_path, new_filename)
-    try:
-        os.rename(output_file, new_filepath)
-    except Exception as e:
-        print(colortxt("R", f"Error renaming file {output_file} to {new_filepath}: {e}"))
-        print(colortxt("Y", f"The song {new_filename} is probably repeated, skipping..."))
-        return
-    output_file = new_filepath
-
-    if os.path.exists(output_file):
-        write_url_metadata(output_file, url) # Write the URL to the metadata
-        url = read_url_metadata(output_file)
-        print(colortxt("B", f"Downloaded: {output_file}"))
-        print(colortxt("B", f"  Metadata: {metadata}"))
-        print(colortxt("B", f"  URL: {url}"))
-        return output_file
-    else:
-        print(colortxt("R", f"Error: Output file {output_file} does not exist."))
-        return output_file
 
 
 
-        
 
 
 
 
+# YT-DLP ENGINES ================================================
+# engine=subprocess (default) spawns yt-dlp.exe for every URL.
+# engine=inprocess runs the yt_dlp python package inside this process instead:
+# the Run keeps a pool of YoutubeDL instances until close_run(), so extractors
+# and HTTP connections are reused between tracks and syncs and no interpreter
+# has to start per URL. YoutubeDL is not thread safe, which is why a worker
+# thread borrows an instance for each download or listing and no two threads
+# ever use the same one at a time.
 
+def get_engine():
+    """ The yt-dlp engine to use, falls back to subprocess if the yt_dlp package is not available. """
+    run = this_run()
+    if run.engine is None:
+        selected = get_param("engine", "subprocess")
+        if selected == "inprocess":
+            try:
+                import yt_dlp
+            except ImportError:
+                print(colortxt("Y", "The yt_dlp python package is not installed, using yt-dlp.exe instead."))
+                selected = "subprocess"
+        run.engine = selected
+    return run.engine
+
+def youtube_dl_options(flat=False):
+    """ YoutubeDL options equivalent to the yt-dlp.exe command lines. """
+    if flat:
+        return {"extract_flat": "in_playlist", "quiet": True, "no_warnings": True}
+    return {
+        "paths": {"home": this_run().temp_path},
+        "outtmpl": "%(id)s.%(ext)s",
+        "format": "bestaudio",
+        "concurrent_fragment_downloads": fragment_count(),
+        "quiet": True,
+        "no_warnings": True,
+        "noprogress": True,
+    }
+
+def fetch_audio_inprocess(url):
+    """ Download a video with a YoutubeDL of the Run's pool, returns (metadata of the downloaded file, None) or (None, error message). """
+    pool = this_run().youtube_dls
+    with pool.lend() as ydl:
+        ydl.params['concurrent_fragment_downloads'] = fragment_count()
+        pool.finished.pop(ydl, None)
+        try:
+            ydl.extract_info(url, download=True)
+        except Exception as e:
+            print(colortxt("R", f"Error downloading video: {e}"))
+            return None, str(e)
+        finished = pool.finished.pop(ydl, None)
+    if finished is None:
+        print(colortxt("R", f"Error downloading video: yt-dlp did not report a file for {url}"))
+        return None, "no file reported"
+    return {field: finished.get(field) for field in info_fields}, None
+
+def stream_playlist_videos_inprocess(url, on_video_id, on_info=None):
+    """ Same as stream_playlist_videos() using a YoutubeDL of the Run's pool, entries are listed page by page. """
+    with this_run().youtube_dls.lend(flat=True) as ydl:
+        try:
+            # process=False keeps the entries lazy, redirects (e.g. music.youtube.com) are followed by hand
+            info = ydl.extract_info(url, download=False, process=False)
+            while info.get('_type') in ('url', 'url_transparent'):
+                info = ydl.extract_info(info['url'], download=False, process=False)
+            for entry in info.get('entries') or []:
+                if entry and entry.get('id'):
+                    if on_info is not None:
+                        on_info({field: entry.get(field) for field in listing_fields})
+                    on_video_id(entry['id'])
+        except Exception as e:
+            print(colortxt("R", f"Error fetching playlist videos: {e}"))
+            return False
+    return True
 
 
-# METADATA FUNCTIONS ================================================
-def read_metadata(filename):
-    """ Read metadata from an audio file. """
-    try:
-        audio = mutagen.File(filename, easy=True)
-        if audio is None:
-            print(colortxt("R", f"Error reading metadata for {filename}"))
-            return None
-        return audio.tags
-    except Exception as e:
-        print(colortxt("R", f"An error occurred while reading {filename}: {e}"))
+
+
+
+
+
+
+
+# FFMPEG FUNCTIONS ================================================
+def metadata_from_info(info):
+    """ Artist, title, album and date from yt-dlp's metadata, picked the same way --embed-metadata does. """
+    metadata = {
+        "title": info.get("track") or info.get("title"),
+        "artist": info.get("artist") or info.get("creator") or info.get("uploader"),
+        "album": info.get("album"),
+        "date": info.get("upload_date"),
+    }
+    return {key: value for key, value in metadata.items() if value}
+
+# audio_format=passthrough keeps the downloaded stream instead of encoding it to
+# MP3: the audio is only remuxed into the matching container. The cover comes
+# from the art cache and is embedded by the tagging stage in both modes.
+passthrough_containers = {"opus": ".opus", "vorbis": ".ogg", "mp4a": ".m4a", "aac": ".m4a", "mp3": ".mp3"}
+
+def passthrough_extension(info):
+    """ Container to remux a stream into, or None if it has to be encoded to MP3. """
+    if get_param("audio_format", "mp3") != "passthrough":
         return None
-    
-def delete_unwanted_metadata(filename):
-    """ Deletes everything except artist, title, album and date from the audio file's metadata. """
-    try:
-        audio = mutagen.File(filename, easy=True)
-        if audio is None:
-            print(colortxt("R", f"Error reading metadata for {filename}"))
-            return False
-        allowed_tags = ['artist', 'title', 'album', 'date']
-        tags_to_delete = [tag for tag in audio.keys() if tag not in allowed_tags]
-        for tag in tags_to_delete:
-            del audio[tag]
-        audio.save()
-        return True
-    except Exception as e:
-        print(colortxt("R", f"An error occurred while deleting metadata from {filename}: {e}"))
-        return False
-    
+    codec = (info.get("acodec") or info.get("ext") or "").split(".")[0].lower()
+    return passthrough_containers.get(codec)
 
-    
-def fix_title(filename):
-    title=read_metadata(filename).get('title', ['Unknown Title'])[0]
-    artist=read_metadata(filename).get('artist', ['Unknown Artist'])[0]
-
-    # Remove common unwanted substrings from filenames
-    unwanted_substrings = ["(Official Video)",
-                           "(Official Audio)",
-                           "(Official Version)",
-                           "(Video)",
-                           "(Official Lyric Video)",
-                           "(Official Music Video)",
-                           "(Official Visualizer)",
-                           "(Soundtrack Version)",
-                           "Official_Video",
-                           "(4K Remaster)",
-                           "?",
-                           "’",
-    ]
-    for substring in unwanted_substrings:
-        title = title.replace(substring, "")
+def transcode_audio(job):
+    """
+    CPU stage: encode the raw audio to MP3 with the metadata, or remux it without re-encoding in passthrough mode.
+
+    Returns:
+        str: The converted file, or None on error.
+    """
+    run = this_run()
+    extension = passthrough_extension(job['info'])
+    output_file = os.path.join(run.temp_path, f"{job['info']['id']}.converted{extension or '.mp3'}")
+    command = [run.ffmpeg_path, "-y", "-loglevel", "error", "-i", job['audio'], "-map", "0:a"]
+    if extension:
+        command += ["-c:a", "copy"]
+    else:
+        command += ["-c:a", "libmp3lame", "-q:a", "5", "-id3v2_version", "3"]
+    for key, value in metadata_from_info(job['info']).items():
+        command += ["-metadata", f"{key}={value}"]
+    command.append(output_file)
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(colortxt("R", f"Error converting {job['url']}: {result.stderr}"))
+        return None
+    return output_file
 
-    #remove artist name from title if present
-    title = re.sub(rf"(?i)\b{re.escape(artist)}\b|\b{re.escape(artist.replace(' ', '_'))}\b", "", title)
+def process_audio(job):
+    """
+    Transcode a downloaded job, fix its tags and move it into Songs.
 
-    # Special titles
-    special_titles = {"★★★★★": "5 Stars"}
-    if title in special_titles:
-        title = special_titles[title]
+    Jobs resumed from the journal skip the stages that already finished.
 
-    # Remove any stray hyphens at the beginning or end of the string
-    title = title.strip(' -')
+    Returns:
+        str: The final file path, or None.
+    """
+    run = this_run()
+    url = job['url']
+    stage = job.get('stage', "downloaded")
+    output_file = job.get('file')
+
+    if stage == "downloaded":
+        with stage_timer("transcode", url) as event:
+            output_file = transcode_audio(job)
+            event['ok'] = output_file is not None
+            event['bytes'] = file_size(output_file)
+        if output_file is None:
+            record_stage(url, "abandoned")
+            return None
+        record_stage(url, "transcoded", file=output_file)
+        if job['audio'] != output_file and os.path.exists(job['audio']):
+            os.remove(job['audio'])
+        stage = "transcoded"
+
+    if stage == "transcoded":
+        with stage_timer("tagging", url) as event:
+            cover = run.art_cache.load(job['art']) if run.art_cache is not None and job.get('art') else None
+            event['ok'] = tag_file(output_file, url, cover, job.get('info', {}).get('duration'))
+        if not event['ok']:
+            record_stage(url, "abandoned")
+            return None
+        record_stage(url, "tagged", file=output_file)
+
+    if stage == "staged" and run.staging:
+        return output_file # still waiting for the TransferStage
+
+    with stage_timer("rename", url) as event:
+        output_file = move_to_songs(output_file)
+        event['ok'] = output_file is not None
+    if output_file is None:
+        record_stage(url, "abandoned")
+        return None
+    record_stage(url, "staged" if run.staging else "renamed", file=output_file)
+
+    if run.library_index is not None:
+        run.library_index.update(output_file)
+    print(colortxt("B", f"Downloaded: {output_file}"))
+    print(colortxt("B", f"  URL: {url}"))
+    return output_file
 
-    # write the fixed title back to metadata
+def tag_file(output_file, url, cover=None, duration=None):
+    """
+    Clean up the tags of a converted file in Temp, add the video URL, the cover (JPEG bytes) and
+    the video's duration in seconds (TLEN, for --verify). Returns True on success.
+    """
+    # Apply every tag change in memory and save once
     try:
-        audio = mutagen.File(filename, easy=True)
-        if audio is None:
-            print(colortxt("R", f"Error reading metadata for {filename}"))        
-        audio['title'] = title
-        audio.save()
+        session = TagSession(output_file)
+        session.delete_unwanted()
+        session.set("title", clean_title(session.title, session.artist))
+        session.set_url(url) # Write the URL to the metadata
+        if cover:
+            session.set_cover(cover)
+        if duration:
+            session.set("length", str(round(duration * 1000)))
+        session.save()
     except Exception as e:
-        print(colortxt("R", f"An error occurred while writing {filename}: {e}"))
+        print(colortxt("R", f"An error occurred while tagging {output_file}: {e}"))
+        return False
+    print(colortxt("B", f"  Metadata: {session.metadata()}"))
+    return True
+
+def move_to_songs(output_file):
+    """
+    Move a tagged file from Temp to Songs as "artist - title.<ext>", or to temp/staged when staging (see STAGING).
 
-def write_url_metadata(filename, video_url):
-    """ Write the video URL to the audio file's metadata. """
+    Returns:
+        str: The new path, or None.
+    """
     try:
-        audio = mutagen.id3.ID3(filename)
-        audio.add(mutagen.id3.WXXX(
-            encoding=3,
-            desc="MusicVideoURL",
-            url=video_url
-        ))
-        audio.save()
-        return True
+        session = TagSession(output_file)
     except Exception as e:
-        print(colortxt("R", f"An error occurred while writing {filename}: {e}"))
-        return False
+        print(colortxt("R", f"An error occurred while reading {output_file}: {e}"))
+        return None
 
-    
-def read_url_metadata(filename):
-    """ Read the video URL from the audio file's metadata. """
+    # rename file to "artist - title.<ext>"
+    new_filename = f"{session.artist} - {session.title}{os.path.splitext(output_file)[1]}"
+    run = this_run()
+    new_filepath = os.path.join(run.staging_path if run.staging else run.songs_path, new_filename)
+    # claim the name with an exclusive create, so two workers finishing songs with the
+    # same name can't overwrite each other between the check and the move
     try:
-        audio = mutagen.id3.ID3(filename)
-        for tag in audio.getall("WXXX"):
-            if tag.desc == "MusicVideoURL":
-                return tag.url  # Return the URL stored in the WXXX frame
+        os.close(os.open(new_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        print(colortxt("Y", f"The song {new_filename} is probably repeated, skipping..."))
+        os.remove(output_file)
         return None
-    
+    except OSError as e:
+        print(colortxt("R", f"Error creating {new_filepath}: {e}"))
+        return None
+    try:
+        shutil.move(output_file, new_filepath) # replaces the empty placeholder
     except Exception as e:
-        print(colortxt("R", f"An error occurred while reading {filename}: {e}"))
+        print(colortxt("R", f"Error moving file {output_file} to {new_filepath}: {e}"))
+        with contextlib.suppress(OSError):
+            os.remove(new_filepath)
+        return None
+    return new_filepath
+
+
+
+
+
+
+
+
+
+# ALBUM ART FUNCTIONS ================================================
+# Tracks of the same album mostly share their artwork, so every distinct cover
+# is fetched and cropped once: the thumbnail URL yt-dlp reports is looked up in
+# the ArtCache and only unknown URLs are downloaded. Images are stored by the
+# SHA-1 of the downloaded bytes, so the same picture behind different URLs is
+# cropped once too. The square JPEGs are kept in cache/art/<hash>.jpg, up to
+# art_cache_disk_mb, and the most recently used art_cache_items of them in
+# memory for the tagging stage. Both drop the least recently used covers first.
+
+def fetch_thumbnail(url):
+    """ Download a thumbnail, returns its bytes. """
+    import urllib.request
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read()
+
+art_fetcher = fetch_thumbnail # function(url) -> image bytes, replaced by the offline benchmarks
+
+def crop_cover(data):
+    """ Crop an image to a centered square JPEG with Pillow, or with ffmpeg if Pillow is not installed. """
+    try:
+        from PIL import Image
+    except ImportError:
+        return crop_cover_ffmpeg(data)
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    side = min(image.size)
+    left, top = (image.width - side) // 2, (image.height - side) // 2
+    output = io.BytesIO()
+    image.crop((left, top, left + side, top + side)).save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+def crop_cover_ffmpeg(data):
+    """ Same as crop_cover() with an ffmpeg process reading and writing pipes. """
+    crop = "crop='if(gt(ih,iw),iw,ih)':'if(gt(iw,ih),ih,iw)'" #crop to square image
+    command = [this_run().ffmpeg_path, "-loglevel", "error", "-i", "pipe:0", "-vf", crop, "-frames:v", "1",
+               "-c:v", "mjpeg", "-q:v", "2", "-f", "image2pipe", "pipe:1"]
+    result = subprocess.run(command, input=data, capture_output=True)
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(result.stderr.decode(errors="replace").strip() or "ffmpeg wrote no image")
+    return result.stdout
+
+
+class ArtCache:
+    """
+    Square covers by content hash in a directory, with a thumbnail URL -> hash table and an LRU of the JPEG bytes.
+
+    Both caches are bounded: at most memory_items covers in memory, and at most disk_bytes of covers
+    on disk, where the least recently used covers (and the thumbnail URLs pointing to them) are deleted first.
+    """
+
+    def __init__(self, path, memory_items, disk_bytes):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.memory = collections.OrderedDict() # hash -> JPEG bytes, least recently used first
+        self.lock = threading.Lock()
+        self.url_locks = {} # URL -> [lock, threads using it], so tracks of the same album wait for a single fetch
+        self.db = sqlite3.connect(os.path.join(path, "art.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails (url TEXT PRIMARY KEY, hash TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS covers (hash TEXT PRIMARY KEY, size INTEGER, used_at REAL)")
+        # covers written before the disk cache was bounded
+        known = {row[0] for row in self.db.execute("SELECT hash FROM covers")}
+        for file in os.listdir(path):
+            key, extension = os.path.splitext(file)
+            if extension == ".jpg" and key not in known:
+                stat = os.stat(os.path.join(path, file))
+                self.db.execute("INSERT INTO covers VALUES (?, ?, ?)", (key, stat.st_size, stat.st_mtime))
+        self.db.commit()
+        self.evict()
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".jpg")
+
+    def get(self, url):
+        """
+        Key of the cropped cover of a thumbnail URL, fetched and cropped on first use.
+
+        Returns:
+            tuple: (key, cached), cached is False when the thumbnail had to be downloaded.
+        """
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, [threading.Lock(), 0])
+            url_lock[1] += 1
+        try:
+            with url_lock[0]:
+                with self.lock:
+                    row = self.db.execute("SELECT hash FROM thumbnails WHERE url = ?", (url,)).fetchone()
+                if row is not None and os.path.exists(self.file(row[0])):
+                    self.touch(row[0])
+                    return row[0], True
+
+                data = art_fetcher(url)
+                key = hashlib.sha1(data).hexdigest()
+                if os.path.exists(self.file(key)):
+                    self.touch(key)
+                else:
+                    self.store(key, crop_cover(data))
+                with self.lock:
+                    self.db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?)", (url, key))
+                    self.db.commit()
+            return key, False
+        finally:
+            with self.lock:
+                url_lock[1] -= 1
+                if url_lock[1] == 0:
+                    del self.url_locks[url]
+
+    def store(self, key, jpeg):
+        # write next to the final name and rename, a reader never sees half a file
+        partial = f"{self.file(key)}.{threading.get_ident()}.part"
+        with open(partial, 'wb') as f:
+            f.write(jpeg)
+        os.replace(partial, self.file(key))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO covers VALUES (?, ?, ?)", (key, len(jpeg), time.time()))
+            self.db.commit()
+        self.remember(key, jpeg)
+        self.evict()
+
+    def touch(self, key):
+        with self.lock:
+            self.db.execute("UPDATE covers SET used_at = ? WHERE hash = ?", (time.time(), key))
+            self.db.commit()
+
+    def evict(self):
+        """ Delete the least recently used covers until the disk cache fits in disk_bytes. """
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM covers").fetchone()[0]
+            if total <= self.disk_bytes:
+                return
+            for key, size in self.db.execute("SELECT hash, size FROM covers ORDER BY used_at").fetchall():
+                if total <= self.disk_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.remove(self.file(key))
+                self.db.execute("DELETE FROM covers WHERE hash = ?", (key,))
+                self.db.execute("DELETE FROM thumbnails WHERE hash = ?", (key,))
+                self.memory.pop(key, None)
+                total -= size
+            self.db.commit()
+
+    def remember(self, key, jpeg):
+        with self.lock:
+            self.memory[key] = jpeg
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def load(self, key):
+        """ The JPEG bytes of a cover, or None if it is not in the cache anymore. """
+        with self.lock:
+            jpeg = self.memory.get(key)
+            if jpeg is not None:
+                self.memory.move_to_end(key)
+                return jpeg
+        try:
+            with open(self.file(key), 'rb') as f:
+                jpeg = f.read()
+        except OSError:
+            return None
+        self.remember(key, jpeg)
+        return jpeg
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def new_art_cache():
+    """ ArtCache in cache/art sized from _Params.txt. """
+    return ArtCache(os.path.join(this_run().cache_path, "art"), get_param("art_cache_items", 64, int),
+                    get_param("art_cache_disk_mb", 200, float) * 1e6)
+
+def fetch_art(url, thumbnail):
+    """ Cover key of a video's thumbnail for the tagging stage, or None without art cache, thumbnail or on error. """
+    run = this_run()
+    if run.art_cache is None or not thumbnail:
         return None
+    with stage_timer("art", url) as event:
+        try:
+            key, event['cached'] = run.art_cache.get(thumbnail)
+        except Exception as e:
+            event['ok'] = False
+            print(colortxt("Y", f"Could not get the cover of {url}, tagging without it: {e}"))
+            return None
+    return key
+
+
+
+
+
+
+
+
+
+# JOB JOURNAL ================================================
+# temp/journal.jsonl records how far every video got, one JSON line per stage:
+#   queued -> downloaded -> transcoded -> tagged -> renamed (finished)
+# or, when staging, tagged -> staged -> transferred (finished) once the file
+# is on the share, see STAGING.
+# or abandoned when a stage failed for good. After an interrupted run the next
+# run picks every video up at its last stage and yt-dlp resumes the partial
+# downloads left in Temp; only files of finished or abandoned videos are cleaned.
+
+class JobJournal:
+    """ Append-only journal of the pipeline stage of every video ID. """
+
+    finished_stages = ("renamed", "transferred", "abandoned")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {} # video ID -> latest stage and the data recorded along the way
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # half written line from an interrupted run
+                    self.jobs.setdefault(record['id'], {}).update(record)
+        self.file = open(path, 'a')
+
+    def record(self, video_id, stage, **data):
+        record = dict(data, id=video_id, stage=stage, time=time.time())
+        with self.lock:
+            self.jobs.setdefault(video_id, {}).update(record)
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def resume(self, url):
+        """ The job of a video that a previous run got past the download, or None to start from scratch. """
+        job = self.jobs.get(video_id_from_url(url))
+        if job is None or job['stage'] not in ("downloaded", "transcoded", "tagged", "staged"):
+            return None
+        needed = job['audio'] if job['stage'] == "downloaded" else job['file']
+        if not os.path.exists(needed):
+            return None
+        print(colortxt("B", f"Resuming {url} after stage '{job['stage']}'"))
+        return dict(job, url=url)
+
+    def clean(self):
+        """ Delete the Temp files of finished and abandoned videos and drop them from the journal. """
+        with self.lock:
+            finished = [video_id for video_id, job in self.jobs.items() if job['stage'] in self.finished_stages]
+            for video_id in finished:
+                for path in glob.glob(os.path.join(glob.escape(os.path.dirname(self.path)), glob.escape(video_id) + ".*")):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(colortxt("R", f"Error deleting file {path}: {e}"))
+                del self.jobs[video_id]
+
+            # rewrite the journal with only the unfinished videos
+            self.file.close()
+            with open(self.path, 'w') as f:
+                for job in self.jobs.values():
+                    f.write(json.dumps(job) + "\n")
+            self.file = open(self.path, 'a')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            if not self.jobs:
+                os.remove(self.path)
+
+def record_stage(url, stage, **data):
+    """ Record a pipeline stage of a video in the job journal, if there is one. """
+    run = this_run()
+    video_id = video_id_from_url(url)
+    if run.job_journal is not None and video_id is not None:
+        run.job_journal.record(video_id, stage, **data)
+
+
+
+
+
+
+
+
+
+# FAILURE CACHE ================================================
+# Downloads that fail for a reason that won't go away by itself (private, removed,
+# region blocked, age gated or members-only videos) would otherwise cost a yt-dlp
+# spawn and a round trip on every run. Their video IDs are kept in
+# cache/failures.sqlite and skipped until the entry expires; other errors are
+# cached as "transient" for a much shorter time. Every failure in a row doubles the
+# TTL of the video's class (failure_ttl_hours_<class> in _Params.txt) up to
+# failure_ttl_max_days. A successful download drops the entry. Throttling is left to
+# the download_limiter and never cached. List and clear entries with
+# --list-failures and --clear-failures.
+
+failure_classes = ( # class, yt-dlp error pattern, default TTL in hours
+    ("private", re.compile(r"Private video|This video is private", re.IGNORECASE), 7 * 24),
+    ("blocked", re.compile(r"not (made this video )?available in your country|blocked it in your country|geo.?restrict", re.IGNORECASE), 7 * 24),
+    ("age", re.compile(r"confirm your age|age.?restricted|inappropriate for some users", re.IGNORECASE), 7 * 24),
+    ("members", re.compile(r"members.?only|join this channel", re.IGNORECASE), 7 * 24),
+    ("removed", re.compile(r"Video unavailable|has been removed|no longer available|account .* terminated|video does not exist", re.IGNORECASE), 30 * 24),
+) # checked in order, "Video unavailable" comes with most of the other messages too
+transient_failure_ttl_hours = 1
+
+def classify_failure(error):
+    """ Failure class of a yt-dlp error message: one of failure_classes, or "transient" for anything else. """
+    for failure_class, pattern, _ in failure_classes:
+        if error and pattern.search(error):
+            return failure_class
+    return "transient"
+
+def failure_ttl(failure_class, failures):
+    """ Seconds to skip a video after its failures-th failure in a row. """
+    default = dict((name, hours) for name, _, hours in failure_classes).get(failure_class, transient_failure_ttl_hours)
+    hours = get_param(f"failure_ttl_hours_{failure_class}", default, float)
+    return min(hours * 3600 * 2 ** (failures - 1), get_param("failure_ttl_max_days", 90, float) * 24 * 3600)
+
+def retry_time(entry):
+    """ When a failure cache entry expires, with the TTLs currently in _Params.txt. """
+    return entry['failed_at'] + failure_ttl(entry['class'], entry['failures'])
+
+def error_summary(error):
+    """ The line of a yt-dlp error message worth keeping: the last ERROR line, or the last line. """
+    lines = [line.strip() for line in (error or "").splitlines() if line.strip()]
+    errors = [line for line in lines if line.startswith("ERROR")]
+    return ((errors or lines or [""])[-1])[:300]
+
+
+class FailureCache:
+    """ Persistent negative cache of video IDs that failed to download. Safe to use from several threads. """
+
+    COLUMNS = ("video_id", "class", "error", "failures", "failed_at")
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS failures (
+                video_id TEXT PRIMARY KEY,
+                class TEXT,
+                error TEXT,
+                failures INTEGER,
+                failed_at REAL
+            )""")
+        self.db.commit()
+        # kept in memory too, sync() looks up every video of the input
+        self.entries = {row[0]: dict(zip(self.COLUMNS, row)) for row in self.db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM failures")}
+
+    def blocked(self, video_id):
+        """ The cache entry of a video that should not be tried yet, or None. """
+        entry = self.entries.get(video_id)
+        if entry is not None and time.time() < retry_time(entry):
+            return entry
+        return None
+
+    def record(self, video_id, error):
+        """ Remember a failed download, returns the new entry. """
+        failure_class = classify_failure(error)
+        with self.lock:
+            previous = self.entries.get(video_id)
+            # a video that keeps failing the same way backs off, a new kind of failure starts over
+            failures = previous['failures'] + 1 if previous and previous['class'] == failure_class else 1
+            now = time.time()
+            entry = {"video_id": video_id, "class": failure_class, "error": error_summary(error), "failures": failures, "failed_at": now}
+            self.entries[video_id] = entry
+            self.db.execute(f"INSERT OR REPLACE INTO failures VALUES ({','.join('?' * len(self.COLUMNS))})",
+                            tuple(entry[column] for column in self.COLUMNS))
+            self.db.commit()
+        return entry
+
+    def clear(self, keys=()):
+        """ Drop the entries of the given video IDs or failure classes, or every entry. Returns how many were dropped. """
+        with self.lock:
+            dropped = [video_id for video_id, entry in self.entries.items()
+                       if not keys or video_id in keys or entry['class'] in keys]
+            for video_id in dropped:
+                del self.entries[video_id]
+            self.db.executemany("DELETE FROM failures WHERE video_id = ?", [(video_id,) for video_id in dropped])
+            self.db.commit()
+        return len(dropped)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def cached_failure(url):
+    """ The failure cache entry of a video, or None. """
+    failure_cache = this_run().failure_cache
+    return failure_cache.entries.get(video_id_from_url(url)) if failure_cache is not None else None
+
+def record_failure(url, error):
+    """ Put a failed download in the failure cache, if there is one. """
+    run = this_run()
+    video_id = video_id_from_url(url)
+    if run.failure_cache is None or video_id is None or is_throttled(error):
+        return
+    entry = run.failure_cache.record(video_id, error)
+    print(colortxt("Y", f"{url} failed ({entry['class']}), skipped until {time.strftime('%Y-%m-%d %H:%M', time.localtime(retry_time(entry)))}."))
+
+
+
+
+
+
+
+
+
+# ADAPTIVE CONCURRENCY ================================================
+# How many downloads YouTube tolerates changes during a run, so the number of
+# active download workers is adjusted AIMD style, like TCP congestion control:
+#   - every round of `limit` finished downloads, the round's throughput is
+#     compared with the previous round: one more worker if it did not get
+#     worse, half of them if it fell far below the best round
+#   - a 429 / "Sign in to confirm you're not a bot" failure halves the workers
+#     at once, at most once per cooldown so a burst of failures counts as one
+#     signal, and the download is retried (throttle_retries times) once a slot
+#     is free again. The limit that got throttled becomes a ceiling the workers
+#     only grow past after probe_rounds rounds without throttling, so the limit
+#     settles below it instead of running into it again every few rounds.
+# yt-dlp's fragment concurrency (-N) only changes how fast a single download is,
+# so it follows its own signal, the speed of single downloads: every probe_rounds
+# rounds one more fragment is tried for `limit` downloads and kept only if their
+# median speed is fragment_gain times the one with the fragments before. A
+# decrease during the trial goes back to the fragments before it, other than
+# that the workers never move -N.
+# download_threads and fragments in _Params.txt are the starting values, the
+# _min and _max params the floor and ceiling.
+
+throttle_pattern = re.compile(r"HTTP Error 429|Too Many Requests|Sign in to confirm you.re not a bot", re.IGNORECASE)
+
+def is_throttled(error):
+    """ True if a yt-dlp error message means YouTube is rate limiting us. """
+    return bool(error and throttle_pattern.search(error))
+
+
+class AdaptiveLimiter:
+    """ AIMD limit on the active downloads, and the fragment concurrency tuned on the speed of single downloads. """
+
+    increase_ratio = 0.9 # a round at least this fast compared to the previous one allows one more worker
+    slow_ratio = 0.5 # a round this slow compared to the best one counts as throttling
+    probe_rounds = 10 # rounds without throttling before trying past the ceiling or one more fragment
+    fragment_gain = 1.1 # one more fragment has to make single downloads this much faster to be kept
+
+    def __init__(self, workers, workers_range, fragments, fragments_range, cooldown=30):
+        self.workers_min, self.workers_max = workers_range
+        self.fragments_min, self.fragments_max = fragments_range
+        self.limit = min(max(workers, self.workers_min), self.workers_max)
+        self.fragments = min(max(fragments, self.fragments_min), self.fragments_max)
+        self.cooldown = cooldown
+        self.active = 0
+        self.condition = threading.Condition()
+        self.last_decrease = 0
+        self.previous = None # throughput of the previous round, bytes per second
+        self.best = 0
+        self.ceiling = self.workers_max # the workers stop growing here, see ADAPTIVE CONCURRENCY
+        self.calm_rounds = 0 # rounds since the last throttling
+        self.rounds = 0
+        self.fragment_probe = None # fragments before trying one more
+        self.fragment_speeds = {} # fragments -> bytes per second of the latest single downloads with that -N
+        self.new_round()
+
+    def new_round(self):
+        self.round_start = time.perf_counter()
+        self.round_bytes = 0
+        self.round_downloads = 0
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ Hold one of the `limit` download slots, blocks while all of them are taken. """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def record(self, event):
+        """ Feed the limiter with a finished download stage event. """
+        with self.condition:
+            if event.get('throttled'):
+                self.decrease("YouTube is throttling", throttled=True)
+                return
+            if not event['ok']:
+                return # private, removed, ... videos say nothing about the connection
+            self.round_bytes += event.get('bytes', 0)
+            self.round_downloads += 1
+            speeds = self.fragment_speeds.setdefault(event.get('fragments', self.fragments), collections.deque(maxlen=50))
+            speeds.append(event.get('bytes', 0) / max(event.get('seconds', 0), 1e-6))
+            if self.round_downloads < self.limit:
+                return
+            throughput = self.round_bytes / max(time.perf_counter() - self.round_start, 1e-6)
+            self.rounds += 1
+            self.calm_rounds += 1
+            if self.calm_rounds >= self.probe_rounds and self.limit >= self.ceiling:
+                self.ceiling = min(self.ceiling + 1, self.workers_max) # YouTube may allow more by now
+                self.calm_rounds = 0
+            if throughput < self.best * self.slow_ratio:
+                self.decrease(f"throughput dropped to {throughput / 1e6:.1f} MB/s")
+                self.new_round() # also when the cooldown kept the limit
+                return
+            if self.previous is None or throughput >= self.previous * self.increase_ratio:
+                self.limit = min(self.limit + 1, self.ceiling)
+                self.condition.notify_all()
+            self.tune_fragments()
+            if self.previous is not None: # the first round after a decrease still had the downloads started before it
+                self.best = max(throughput, self.best * 0.9) # forget old peaks slowly
+            self.previous = throughput
+            self.new_round()
+
+    def tune_fragments(self):
+        """
+        Try one more fragment every probe_rounds rounds, keep it if single downloads got faster. Called with the condition held.
+
+        Downloads are compared by the -N they ran with (the 'fragments' of their event), so the ones
+        still running when the probe started do not count for it.
+        """
+        if self.fragment_probe is not None:
+            tried = self.fragment_speeds.get(self.fragments, ())
+            if len(tried) < self.limit:
+                return # not enough downloads with the extra fragment yet
+            before = self.fragment_speeds.get(self.fragment_probe, ())
+            if not before or statistics.median(tried) < statistics.median(before) * self.fragment_gain:
+                del self.fragment_speeds[self.fragments] # not worth the extra requests
+                self.fragments = self.fragment_probe
+            self.fragment_probe = None
+            return
+        if (self.rounds % self.probe_rounds == 0 and self.fragments < self.fragments_max
+                and len(self.fragment_speeds.get(self.fragments, ())) >= self.limit):
+            self.fragment_probe = self.fragments
+            self.fragments += 1
+            self.fragment_speeds.pop(self.fragments, None) # measured again from scratch
+
+    def decrease(self, reason, throttled=False):
+        # called with the condition held
+        if time.monotonic() - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = time.monotonic()
+        if throttled:
+            self.ceiling = max(self.limit - 1, self.workers_min)
+            self.calm_rounds = 0
+        if self.fragment_probe is not None:
+            self.fragment_speeds.pop(self.fragments, None)
+            self.fragments = self.fragment_probe # the extra fragment may be what YouTube did not like
+            self.fragment_probe = None
+        self.limit = max(self.limit // 2, self.workers_min)
+        self.previous = None
+        self.best = 0
+        self.new_round()
+        print(colortxt("Y", f"{reason}, down to {self.limit} downloads with {self.fragments} fragments each."))
+
+def download_slot():
+    """ A download_limiter slot for one download, or no limit without a limiter. """
+    run = this_run()
+    if run.download_limiter is None:
+        return contextlib.nullcontext()
+    return run.download_limiter.slot()
+
+def new_download_limiter():
+    """ AdaptiveLimiter sized from _Params.txt. """
+    return AdaptiveLimiter(get_param("download_threads", 20, int),
+                           (get_param("download_threads_min", 2, int), get_param("download_threads_max", 40, int)),
+                           get_param("fragments", 6, int),
+                           (get_param("fragments_min", 1, int), get_param("fragments_max", 16, int)),
+                           get_param("throttle_cooldown", 30, float))
+
+
+
+
+
+
+
+
+
+# DUPLICATE DETECTION ================================================
+# Playlists often hold the same song more than once: the official video, a lyric
+# video and the YouTube Music track all end up as the same "artist - title" file,
+# and move_to_songs() used to notice only after the download and transcode. The
+# flat playlist listing already has every video's title, uploader and duration, so
+# each listed video gets a song key (the normalized artist and cleaned title, the
+# way the file would be named) and is checked against the keys of the library and
+# of the videos already queued in this run before it is downloaded.
+# duplicate_policy in _Params.txt: skip (default), flag (download anyway, only
+# reported) or off. Single video URLs are never skipped, they were added on purpose.
+
+artist_suffix_pattern = re.compile(r"\s*(?:- Topic|VEVO|Official)$", re.IGNORECASE)
+
+def listed_artist_title(info):
+    """ Best guess of (artist, title) of a flat playlist entry, picked like metadata_from_info() does after the download. """
+    title = info.get('track') or info.get('title') or ""
+    artist = info.get('artist') or artist_suffix_pattern.sub("", info.get('uploader') or info.get('channel') or "")
+    if not info.get('track') and " - " in title:
+        # "Artist - Song (Official Video)" uploaded by a label or a VEVO channel
+        artist, title = (part.strip() for part in title.split(" - ", 1))
+    return artist, title
+
+def song_key(artist, title):
+    """ Normalized 'artist - title' two uploads of the same song share, or None if either is unknown. """
+    if not artist or not title:
+        return None
+    title = clean_title(title, artist)
+    return lyrics_key(artist, title) if title else None
+
+
+class DuplicateIndex:
+    """ Song keys of the library and of the videos queued so far, used from sync()'s feeder thread only. """
+
+    def __init__(self, entries, tolerance):
+        self.tolerance = tolerance # seconds two listed videos may differ and still be the same song
+        self.library = {} # song key -> file path
+        self.queued = {} # song key -> (video ID, duration)
+        for entry in entries:
+            key = song_key(entry['artist'], entry['title'])
+            if key is not None:
+                self.library.setdefault(key, entry['path'])
+
+    def check(self, video_id, info):
+        """
+        Look a listed video up before it is downloaded, and claim its key if it is new.
+
+        Returns:
+            dict: None if the video is not a duplicate, otherwise its 'key' and either the library
+            'path' or the queued 'video_id' with the same key.
+        """
+        if not info:
+            return None
+        key = song_key(*listed_artist_title(info))
+        if key is None:
+            return None
+        if key in self.library:
+            return {"key": key, "path": self.library[key]}
+        if key in self.queued:
+            other_id, other_duration = self.queued[key]
+            duration = info.get('duration')
+            if not duration or not other_duration or abs(duration - other_duration) <= self.tolerance:
+                return {"key": key, "video_id": other_id}
+            return None # same name, different length: a live or extended version
+        self.queued[key] = (video_id, info.get('duration'))
+        return None
+
+def new_duplicate_index():
+    """ DuplicateIndex of the current library, or None with duplicate_policy=off. """
+    if get_param("duplicate_policy", "skip").lower() == "off":
+        return None
+    return DuplicateIndex(this_run().library_index.entries(), get_param("duplicate_duration_tolerance", 15, float))
+
+
+
+
+
+
+
+
+
+# PIPELINE FUNCTIONS ================================================
+# Downloads are network bound and transcodes are CPU bound, so they run in two
+# separately sized pools of worker threads connected by bounded queues:
+#
+#   urls -> download_queue -> download workers (yt-dlp) -> transcode_queue -> transcode workers (ffmpeg + tags) -> on_result
+#
+# When the transcode workers fall behind, the full transcode_queue blocks the
+# download workers, which in turn stops the feeder.
+
+def run_pipeline(urls, download_threads, transcode_threads, on_result=None, stop=None):
+    """
+    Download and process every URL.
+
+    Args:
+        urls (iterable): Video URLs, consumed as the download workers need them.
+        download_threads (int): Number of download workers, the download_limiter decides how many are active.
+        transcode_threads (int): Number of concurrent ffmpeg transcodes.
+        on_result (callable): Called from a worker thread with (url, file_path) for each URL,
+            file_path is None if the URL failed.
+        stop (threading.Event): Once set, the URLs that did not start downloading yet are dropped.
+
+    Returns:
+        list: The (url, file_path) result of every URL.
+    """
+    run = this_run()
+    download_queue = queue.Queue(maxsize=download_threads * 2)
+    transcode_queue = queue.Queue(maxsize=transcode_threads * 2)
+    results = []
+
+    def finish(url, file_path):
+        results.append((url, file_path))
+        if on_result is not None:
+            on_result(url, file_path)
+
+    def feeder():
+        for url in urls:
+            download_queue.put(url)
+        for _ in range(download_threads):
+            download_queue.put(None)
+
+    def download_worker():
+        while (url := download_queue.get()) is not None:
+            if stop is not None and stop.is_set():
+                continue
+            try:
+                job = run.job_journal.resume(url) if run.job_journal is not None else None
+                if job is None:
+                    record_stage(url, "queued")
+                    job = fetch_audio(url)
+            except Exception as e:
+                print(colortxt("R", f"Error downloading {url}: {e}"))
+                job = None
+            if job is None:
+                # the download failed for good, only interrupted runs leave videos queued
+                record_stage(url, "abandoned")
+                finish(url, None)
+            else:
+                transcode_queue.put(job)
+
+    def transcode_worker():
+        while (job := transcode_queue.get()) is not None:
+            try:
+                file_path = process_audio(job)
+            except Exception as e:
+                print(colortxt("R", f"Error processing {job['url']}: {e}"))
+                file_path = None
+            finish(job['url'], file_path)
+
+    start_thread(feeder)
+    download_workers = [start_thread(download_worker) for _ in range(download_threads)]
+    transcode_workers = [start_thread(transcode_worker) for _ in range(transcode_threads)]
+
+    for thread in download_workers:
+        thread.join()
+    for _ in range(transcode_threads):
+        transcode_queue.put(None)
+    for thread in transcode_workers:
+        thread.join()
+    return results
+
+
+
+
+
+
+
+
+
+# METADATA FUNCTIONS ================================================
+def clean_title(title, artist):
+    """ Remove common YouTube clutter and the artist name from a title, see _TitleRules.txt. """
+    return this_run().title_rules.clean(title, artist)
 
 
 
@@ -365,28 +1629,494 @@ def read_url_metadata(filename):
 
 
 # LYRICS FUNCTIONS ================================================
-def fetch_lyrics(filename):
-    """ Fetch lyrics for a given audio file """
-    metadata = read_metadata(filename)
-    title=metadata.get('title', ['Unknown Title'])[0]
-    artist=metadata.get('artist', ['Unknown Artist'])[0]
+# Lyrics run as their own stage after the download: fetch_audio() and
+# process_audio() only download and tag, main() hands the finished file to a
+# LyricsStage whose workers look the song up in the LyricsCache and only ask
+# the lyrics providers on a cache miss. Songs without lyrics are cached too and retried after
+# lyrics_miss_ttl_days.
+
+def syncedlyrics_provider(artist, title):
+    """ Default lyrics provider, queries the syncedlyrics providers in sequence. """
+    import syncedlyrics # slow to import, only loaded once a song needs lyrics
+    return syncedlyrics.search(f"{artist} {title}")
+
+lyrics_provider = syncedlyrics_provider # replace with any (artist, title) -> lyrics or None function
+
+def search_lyrics(artist, title):
+    """
+    Search lyrics for a song.
+
+    Returns:
+        tuple: (searched, lyrics). searched is False if the search failed (e.g. a network error),
+        lyrics is None if nothing was found.
+    """
     try:
-        lyrics = syncedlyrics.search(f"{artist} {title}")
+        return True, lyrics_provider(artist, title)
     except Exception as e:
         print(colortxt("R", f"An error occurred while fetching lyrics for {artist} - {title}: {e}"))
-        return
-    
-    # Embed the lyrics into the MP3 metadata
+        return False, None
+
+def lyrics_key(artist, title):
+    """ Normalized 'artist - title' used as the lyrics cache key. """
+    key = unicodedata.normalize('NFKD', f"{artist} - {title}").encode('ascii', 'ignore').decode('ascii')
+    key = re.sub(r"[^\w\s-]", "", key.lower())
+    return re.sub(r"\s+", " ", key).strip()
+
+
+class LyricsCache:
+    """ Persistent lyrics cache in cache/lyrics.sqlite. Misses are stored with an empty value. """
+
+    def __init__(self, path, miss_ttl):
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS lyrics (key TEXT PRIMARY KEY, lyrics TEXT, fetched_at REAL)")
+        self.db.commit()
+
+    def get(self, artist, title):
+        """
+        Look a song up in the cache.
+
+        Returns:
+            tuple: (found, lyrics), lyrics is None for a cached miss.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT lyrics, fetched_at FROM lyrics WHERE key = ?", (lyrics_key(artist, title),)).fetchone()
+        if row is None:
+            return False, None
+        lyrics, fetched_at = row
+        if lyrics is None and time.time() - fetched_at > self.miss_ttl:
+            return False, None # expired miss, ask the providers again
+        return True, lyrics
+
+    def put(self, artist, title, lyrics):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?)", (lyrics_key(artist, title), lyrics or None, time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def embed_lyrics(filename, cache, skip_existing=False):
+    """ Look up lyrics for a downloaded file (cache first) and embed them. Returns True if lyrics were written. """
+    run = this_run()
+    try:
+        session = TagSession(filename)
+    except Exception as e:
+        print(colortxt("R", f"An error occurred while reading {filename}: {e}"))
+        return False
+    if skip_existing and session.has_lyrics():
+        return False
+
+    artist, title = session.artist, session.title
+    with stage_timer("lyrics", session.get_url()) as event:
+        found, lyrics = cache.get(artist, title)
+        event['cached'] = found
+        if not found:
+            searched, lyrics = search_lyrics(artist, title)
+            if searched: # a failed search is not a miss, try again next time
+                cache.put(artist, title, lyrics)
+        event['ok'] = bool(lyrics)
+    if not lyrics:
+        return False
+
     try:
-        # Create a new USLT frame for the lyrics
-        audio = mutagen.id3.ID3(filename)
-        uslt = mutagen.id3.USLT(encoding=3, lang='eng', desc='Lyrics', text=lyrics)
-        audio.add(uslt)
-        audio.save()
-        print(colortxt("B", f"Lyrics embedded for {artist} - {title}"))
+        session.set_lyrics(lyrics)
+        session.save()
     except Exception as e:
         print(colortxt("R", f"An error occurred while embedding lyrics for {artist} - {title}: {e}"))
-    
+        return False
+    if run.library_index is not None:
+        run.library_index.update(filename)
+    print(colortxt("B", f"Lyrics embedded for {artist} - {title}"))
+    return True
+
+
+class LyricsStage:
+    """
+    Bounded pool of lyrics workers fed with finished downloads.
+
+    submit() blocks once max_pending files are waiting, so a slow lyrics
+    provider slows the hand-off instead of piling up work.
+    """
+
+    def __init__(self, threads, miss_ttl, skip_existing=False):
+        self.cache = LyricsCache(os.path.join(this_run().cache_path, "lyrics.sqlite"), miss_ttl)
+        self.skip_existing = skip_existing
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending = threading.BoundedSemaphore(threads * 4)
+        self.futures = []
+
+    def submit(self, filename, on_done=None):
+        """ Queue a file, on_done is called without arguments once its lyrics were looked up. """
+        self.pending.acquire()
+        future = self.executor.submit(contextvars.copy_context().run, embed_lyrics, filename, self.cache, self.skip_existing)
+        future.add_done_callback(lambda _: self.pending.release())
+        if on_done is not None:
+            future.add_done_callback(lambda _: on_done())
+        self.futures.append(future)
+
+    def close(self):
+        """ Wait for every submitted file. Returns how many got lyrics. """
+        self.executor.shutdown(wait=True)
+        self.cache.close()
+        return sum(1 for future in self.futures if future.exception() is None and future.result())
+
+def new_lyrics_stage(skip_existing=False):
+    """ LyricsStage sized from _Params.txt. """
+    return LyricsStage(get_param("lyrics_threads", 4, int),
+                       get_param("lyrics_miss_ttl_days", 7, float) * 24 * 3600,
+                       skip_existing)
+
+
+
+
+
+
+
+
+
+
+# STAGING ================================================
+# With Songs on a network share (output=\\Server\Songs) every tag rewrite,
+# rename and tag read is a round trip over SMB. When staging, all of a track's
+# work stays on the local disk: ffmpeg, tags and lyrics happen in temp, finished
+# tracks wait in temp/staged and a TransferStage copies them to Songs in batches
+# of transfer_batch files, transfer_threads at a time, on a thread of its own so
+# the lyrics workers never wait for the share. Each file is written once, front
+# to back, as a .ytd_part_ file that is renamed into place, so the share never
+# shows half a song and nothing rewrites it afterwards. The job journal records
+# a song as staged and only as transferred once the copy is in place. Files a
+# run could not copy stay staged and are copied by the next open_run().
+#
+# The library index of a staged library is a mirror in the cache (Run.index_path)
+# instead of a database on the share. It gets the tags of every copied file from
+# the local copy, so the share is only listed, and only files someone else
+# changed there are read over the network.
+
+PART_PREFIX = ".ytd_part_" # is_index_file() names, ignored by the library scan and the orphans
+
+def transfer_file(file_path, songs_path):
+    """
+    Copy a staged file into Songs under the same name and delete the staged one.
+
+    An empty placeholder claims the name first, like move_to_songs() does, then the data
+    is written in one pass to a .ytd_part_ file that replaces the placeholder.
+
+    Returns:
+        tuple: (path in Songs, its os.stat_result, index entry read from the staged copy), or None.
+    """
+    name = os.path.basename(file_path)
+    target = os.path.join(songs_path, name)
+    part = os.path.join(songs_path, PART_PREFIX + name)
+    entry = read_entry(file_path)
+    try:
+        os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        print(colortxt("Y", f"The song {name} is probably repeated, skipping..."))
+        os.remove(file_path)
+        return None
+    except OSError as e:
+        print(colortxt("R", f"Error creating {target}, {name} stays staged: {e}"))
+        return None
+    try:
+        shutil.copyfile(file_path, part)
+        os.replace(part, target)
+        stat = os.stat(target)
+    except Exception as e:
+        print(colortxt("R", f"Error copying {name} to {songs_path}, it stays staged: {e}"))
+        for path in (part, target):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        return None
+    os.remove(file_path)
+    return target, stat, entry
+
+
+class TransferStage:
+    """
+    Copies staged files to Songs in batches, see STAGING.
+
+    submit() collects files and hands every full batch to the stage's own thread, which copies
+    it at most threads files at a time. submit() only blocks while max_pending batches wait for
+    that thread. on_result is called with (url, path in Songs) for every file once its batch is
+    done, the path is None if the file could not be copied.
+    """
+
+    def __init__(self, batch_size, threads, on_result=None, max_pending=2):
+        self.batch_size = batch_size
+        self.threads = threads
+        self.on_result = on_result
+        self.lock = threading.Lock()
+        self.batch = []
+        self.transferred = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="transfer")
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, url, file_path):
+        with self.lock:
+            self.batch.append((url, file_path))
+            if len(self.batch) < self.batch_size:
+                return
+            batch, self.batch = self.batch, []
+        self.queue(batch)
+
+    def queue(self, batch):
+        self.pending.acquire()
+        future = self.executor.submit(contextvars.copy_context().run, self.transfer, batch)
+        future.add_done_callback(lambda _: self.pending.release())
+
+    def close(self):
+        """ Copy the files of the last batch and wait for every batch. Returns how many files were copied in all. """
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if batch:
+            self.queue(batch)
+        self.executor.shutdown(wait=True)
+        return self.transferred
+
+    def transfer(self, batch):
+        run = this_run()
+        with stage_timer("transfer", files=len(batch)) as event:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as pool:
+                copied = list(pool.map(transfer_file, [file_path for _, file_path in batch], [run.songs_path] * len(batch)))
+            event['ok'] = None not in copied
+            event['bytes'] = sum(item[1].st_size for item in copied if item is not None)
+        if run.library_index is not None:
+            run.library_index.add([item for item in copied if item is not None])
+        for (url, file_path), item in zip(batch, copied):
+            if url is None:
+                continue
+            if item is not None:
+                record_stage(url, "transferred", file=item[0])
+            elif not os.path.exists(file_path):
+                record_stage(url, "abandoned") # a song of the same name was there already
+        with self.lock:
+            self.transferred += sum(1 for item in copied if item is not None)
+        print(colortxt("B", f"Copied {sum(1 for item in copied if item is not None)} of {len(batch)} songs to {run.songs_path}."))
+        if self.on_result is not None:
+            for (url, _), item in zip(batch, copied):
+                self.on_result(url, item[0] if item is not None else None)
+
+def new_transfer_stage(on_result=None):
+    """ TransferStage sized from _Params.txt. """
+    return TransferStage(get_param("transfer_batch", 20, int), get_param("transfer_threads", 4, int), on_result)
+
+def transfer_leftovers():
+    """ Copy the files an earlier run staged but could not copy to Songs. """
+    run = this_run()
+    leftovers = sorted(entry.path for entry in os.scandir(run.staging_path) if entry.is_file())
+    if not leftovers:
+        return 0
+    print(colortxt("B", f"Copying {len(leftovers)} songs staged by an earlier run to {run.songs_path}..."))
+    # the journal knows the video of every file a run staged, so it can record the copy
+    staged = {}
+    if run.job_journal is not None:
+        staged = {os.path.normcase(job['file']): video_url(video_id) for video_id, job in run.job_journal.jobs.items() if job['stage'] == "staged"}
+    transfer_stage = new_transfer_stage()
+    for file_path in leftovers:
+        transfer_stage.submit(staged.get(os.path.normcase(file_path)), file_path)
+    return transfer_stage.close()
+
+
+
+
+
+
+
+
+
+# EMBEDDING API ================================================
+# A Downloader runs syncs for a program that imports ytd.py instead of starting
+# the exe for every request:
+#
+#     async with Downloader({"output": "Songs", "download_threads": 8}) as downloader:
+#         async for track in downloader.sync(["https://www.youtube.com/playlist?list=..."]):
+#             print(track.status, track.path)
+#
+# The config takes the keys of _Params.txt, plus temp_path, cache_path,
+# yt_dlp_path and ffmpeg_path. Nothing is read from the working directory and
+# the Downloader's Run stays open between syncs (library index, caches, download
+# limiter), so one warm process can serve many syncs, also at the same time: they
+# share the download limiter, and a video two of them want is downloaded once.
+# Each sync runs main()'s pipeline in worker threads and hands a TrackResult per
+# video to the event loop as soon as it is done. Downloaders of different
+# libraries need their own temp_path, the job journal lives there.
+
+class TrackResult:
+    """ What a sync did with one video. """
+
+    def __init__(self, url, status, path=None, error=None):
+        self.url = url
+        self.video_id = video_id_from_url(url)
+        self.status = status # downloaded, failed, present, skipped (failed before, see FAILURE CACHE) or duplicate
+        self.path = path # the file in Songs: downloaded, present or the library copy of a duplicate
+        self.error = error # why it failed or was skipped
+
+    def __repr__(self):
+        return f"TrackResult({self.url!r}, {self.status!r}, path={self.path!r}, error={self.error!r})"
+
+class Downloader:
+    """
+    Asynchronous syncs of one library, see EMBEDDING API.
+
+    Args:
+        config (dict or Run): Params like in _Params.txt, or the Run to use (the command line passes default_run).
+    """
+
+    def __init__(self, config=None):
+        self.run = config if isinstance(config, Run) else Run(config)
+        self.lock = threading.Lock()
+        self.in_flight = {} # video ID -> Future of its file, for the videos one of the syncs is downloading
+        self.syncs = set() # sync threads that are still running, close() waits for them
+        self.open_lock = asyncio.Lock()
+        self.opened = False
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def call(self, function, *args):
+        """ Call a function of this module with the Downloader's Run as the current one. """
+        token = current_run.set(self.run)
+        try:
+            return function(*args)
+        finally:
+            current_run.reset(token)
+
+    async def execute(self, function, *args):
+        """ Same as call() in a worker thread, e.g. execute(reconcile, result) after a sync. """
+        return await asyncio.to_thread(self.call, function, *args)
+
+    async def open(self):
+        """ Open the library index and caches and check for a yt-dlp update. The first sync does it if needed. """
+        async with self.open_lock:
+            if not self.opened:
+                await self.execute(open_run)
+                await self.execute(start_update_check)
+                self.opened = True
+
+    async def close(self):
+        """ Wait for the syncs still running, also the ones stopped early, and close the Run. """
+        if self.syncs:
+            await asyncio.wait(set(self.syncs))
+        async with self.open_lock:
+            if self.opened:
+                await self.execute(close_run)
+                self.opened = False
+
+    async def sync(self, urls, result=None, max_pending=16):
+        """
+        Download every video of the URLs (videos and playlists) that is not in the library yet, yielding a
+        TrackResult for every video as soon as it is done or passed over.
+
+        Backpressure: while max_pending results wait for the caller, the pipeline stops taking new videos.
+        Cancellation: once the caller stops early (aclose(), a break inside contextlib.aclosing() or a
+        cancelled task) no new video is started, the ones in progress finish in the background.
+
+        Args:
+            urls (list): Input lines, video and playlist URLs.
+            result (dict): A new_sync_result() to fill in, e.g. for reconcile().
+            max_pending (int): Results that may wait for the caller.
+        """
+        await self.open()
+        loop = asyncio.get_running_loop()
+        tracks = asyncio.Queue()
+        slots = threading.Semaphore(max_pending)
+        stopped = threading.Event()
+        result = new_sync_result() if result is None else result
+
+        def emit(track):
+            # from the sync's threads, blocks them while max_pending tracks are waiting
+            while not slots.acquire(timeout=0.5):
+                if stopped.is_set():
+                    return
+            if not stopped.is_set():
+                with contextlib.suppress(RuntimeError): # the loop is gone
+                    loop.call_soon_threadsafe(tracks.put_nowait, track)
+
+        def passed(url, status, detail):
+            if status == "skipped":
+                emit(TrackResult(url, status, error=detail['error']))
+            else:
+                emit(TrackResult(url, status, detail if status == "present" else detail.get('path')))
+
+        def track_result(url, file_path):
+            if file_path:
+                return TrackResult(url, "downloaded", file_path)
+            entry = cached_failure(url)
+            return TrackResult(url, "failed", error=entry['error'] if entry else "failed, see the console")
+
+        def sync_thread():
+            refresh_library()
+            owned = {} # video ID -> Future, the videos this sync downloads for the other syncs too
+            shared = [] # (url, Future) of the videos another sync is already downloading
+
+            def planned():
+                for url in plan_downloads(urls, result, on_passed=passed):
+                    if stopped.is_set():
+                        return
+                    video_id = video_id_from_url(url)
+                    with self.lock:
+                        future = self.in_flight.get(video_id)
+                        if future is None:
+                            future = owned[video_id] = self.in_flight[video_id] = concurrent.futures.Future()
+                    if video_id in owned:
+                        yield url
+                    else:
+                        shared.append((url, future))
+
+            def finished(url, file_path):
+                video_id = video_id_from_url(url)
+                with self.lock:
+                    del self.in_flight[video_id]
+                owned.pop(video_id).set_result(file_path)
+                emit(track_result(url, file_path))
+
+            try:
+                download_urls(planned(), result, finished, stopped)
+                for url, future in shared:
+                    if stopped.is_set():
+                        break
+                    file_path = future.result()
+                    if file_path:
+                        result["expected_files"].add(file_path)
+                    else:
+                        result["failed"].add(video_id_from_url(url))
+                    emit(track_result(url, file_path))
+                print_sync_summary(result)
+            finally:
+                # videos that never got through the pipeline, the other syncs stop waiting for them
+                with self.lock:
+                    for video_id, future in owned.items():
+                        del self.in_flight[video_id]
+                        future.set_result(None)
+            return result
+
+        # a thread of its own rather than the event loop's executor, which only has a few
+        done = concurrent.futures.Future()
+        def run_sync():
+            try:
+                done.set_result(self.call(sync_thread))
+            except BaseException as e:
+                done.set_exception(e)
+        threading.Thread(target=run_sync, daemon=True).start()
+        task = asyncio.wrap_future(done)
+        self.syncs.add(task)
+        task.add_done_callback(self.syncs.discard)
+        task.add_done_callback(lambda _: tracks.put_nowait(None))
+        try:
+            while (track := await tracks.get()) is not None:
+                slots.release()
+                yield track
+            task.result() # the error of the sync thread, if it failed
+        finally:
+            stopped.set()
 
 
 
@@ -420,42 +2150,237 @@ def setup():
             f.write("output=Songs\n")
             print(colortxt("Y", f"File '{params_file_path}' not found. Created with parameters."))
 
-    global songs_path
+    # Create title rules file if it doesn't exist
+    if not os.path.exists(title_rules_path):
+        with open(title_rules_path, 'w', encoding='utf-8') as f:
+            f.write(DEFAULT_TITLE_RULES)
+            print(colortxt("Y", f"File '{title_rules_path}' not found. Created with the default title rules."))
 
+    run = default_run
     with open(params_file_path, 'r') as f:
         for line in f:
-            if line.startswith("output="):
-                try:
-                    songs_path = normalize_path(line.split("=", 1)[1].strip())
-                    os.makedirs(songs_path, exist_ok=True)
-                    print(colortxt("B", f"Output directory set to: {songs_path}"))
-                except Exception as e:
-                    print(colortxt("R", f"Error creating output directory: {e}"))
-                    exit(1)
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split("=", 1)
+            run.params[key.strip()] = value.strip()
+
+    try:
+        run.title_rules = TitleRules.load(title_rules_path)
+    except ValueError as e:
+        print(colortxt("R", f"Error in {title_rules_path}, using the default title rules: {e}"))
+
+    try:
+        run.configure()
+        os.makedirs(run.songs_path, exist_ok=True)
+        print(colortxt("B", f"Output directory set to: {run.songs_path}"))
+    except Exception as e:
+        print(colortxt("R", f"Error creating output directory: {e}"))
+        exit(1)
 
     # Ensure the directories exist
-    os.makedirs(songs_path, exist_ok=True)
-    os.makedirs(temp_path, exist_ok=True)
-    clean_directory(temp_path)
+    os.makedirs(run.songs_path, exist_ok=True)
+    os.makedirs(run.temp_path, exist_ok=True)
+    os.makedirs(run.cache_path, exist_ok=True)
 
     # Check if yt-dlp is available
-    if not os.path.exists(yt_dlp_path):
+    if not os.path.exists(run.yt_dlp_path):
         print(colortxt("R", "yt-dlp not found. Please ensure it is in the 'src' directory."))
         exit(1)
 
     # Check if ffmpeg is available
-    if not os.path.exists(ffmpeg_path):
+    if not os.path.exists(run.ffmpeg_path):
         print(colortxt("R", "ffmpeg not found. Please ensure it is in the 'src' directory."))
         exit(1)
     
-    # Update yt-dlp to the latest version
-    try:
-        subprocess.run([yt_dlp_path, "-U"], check=True)
-        print(colortxt("B", "yt-dlp updated to the latest version."))
-    except subprocess.CalledProcessError as e:
-        print(colortxt("R", f"Error updating yt-dlp: {e}"))
-        exit(1)
+    # Update yt-dlp to the latest version, in the background and at most once per update_check_hours
+    start_update_check()
+
+
+def open_run():
+    """ Open the state a run keeps warm for its whole life: metrics, library index, job journal, art cache, download limiter and failure cache. """
+    run = this_run()
+    for path in (run.songs_path, run.temp_path, run.cache_path) + ((run.staging_path,) if run.staging else ()):
+        os.makedirs(path, exist_ok=True)
+    hooks = [load_metrics_hook(run.params["metrics_hook"])] if "metrics_hook" in run.params else []
+    run.run_metrics = RunMetrics(normalize_path(get_param("events_file", os.path.join(run.cache_path, "events.jsonl"))),
+                                 [hook for hook in hooks if hook is not None])
+    run.library_index = open_library_index()
+    run.job_journal = JobJournal(os.path.join(run.temp_path, "journal.jsonl"))
+    run.job_journal.clean()
+    run.art_cache = new_art_cache()
+    run.download_limiter = new_download_limiter()
+    run.failure_cache = FailureCache(os.path.join(run.cache_path, "failures.sqlite"))
+    if run.staging:
+        transfer_leftovers()
+
+def open_library_index():
+    """
+    The LibraryIndex of the current Run: in Songs, or its mirror in the cache when staging.
+    A new mirror starts as a copy of the index in Songs, so the share doesn't have to be read again.
+    """
+    run = this_run()
+    if run.index_path is not None and not os.path.exists(run.index_path):
+        shared_index = os.path.join(run.songs_path, INDEX_FILENAME)
+        if os.path.exists(shared_index):
+            try:
+                shutil.copyfile(shared_index, run.index_path)
+            except OSError as e:
+                print(colortxt("R", f"Error copying {shared_index}, the index is built from scratch: {e}"))
+    return LibraryIndex(run.songs_path, run.index_path)
+
+def close_run():
+    # Clean up the Temp directory, files of unfinished videos are kept for the next run
+    run = this_run()
+    run.job_journal.clean()
+    run.job_journal.close()
+    run.art_cache.close()
+    run.failure_cache.close()
+    run.run_metrics.close()
+    run.youtube_dls.close()
+    with contextlib.suppress(OSError): # only removed when every staged file was copied
+        os.rmdir(run.staging_path)
+    if not os.listdir(run.temp_path):
+        os.rmdir(run.temp_path)
+    else:
+        print(colortxt("Y", "Some downloads did not finish, they will be resumed on the next run."))
+    run.library_index.close()
+    # closed, nothing may use them any more
+    run.library_index = run.job_journal = run.art_cache = run.failure_cache = run.download_limiter = run.run_metrics = None
 
+def new_sync_result():
+    """
+    The result of a sync, filled by plan_downloads() and download_urls().
+
+    'expected_files' (set of the files of the input in Songs), 'listed' (every video ID in the input),
+    'failed' (video IDs that could not be downloaded), 'failed_listings' (playlists that could not
+    be listed, so 'listed' and 'expected_files' may be incomplete), 'skipped' (video IDs in the
+    failure cache), 'duplicates' (video ID -> what it duplicates, see DuplicateIndex.check()),
+    'downloaded' and 'new' (counts).
+    """
+    return {"expected_files": set(), "listed": set(), "failed": set(), "failed_listings": [], "skipped": set(),
+            "duplicates": {}, "downloaded": 0, "new": 0}
+
+def refresh_library():
+    """ Bring the library index up to date with Songs. """
+    with stage_timer("library_scan"):
+        stats = this_run().library_index.refresh()
+    print(colortxt("B", f"Library index: {stats['files']} files, {stats['updated']} updated, {stats['removed']} removed."))
+
+def plan_downloads(lines, result, skip_ids=frozenset(), announce_present=True, on_passed=None):
+    """
+    Yield the URL of every video of the input lines that has to be downloaded, while the input is being listed.
+
+    Videos that are already downloaded, failed before or duplicate another song are passed over and
+    recorded in the result (see new_sync_result()).
+
+    Args:
+        skip_ids (set): Video IDs to pass over without looking at them, e.g. the ones an earlier watch cycle handled.
+        announce_present (bool): Print every video that is already downloaded.
+        on_passed (callable): Called with (url, status, detail) for every video passed over: "present" with
+            its file, "skipped" with its failure cache entry or "duplicate" with what it duplicates.
+    """
+    run = this_run()
+    downloaded = {entry['video_id']: entry for entry in run.library_index.entries() if entry['video_id']}
+    duplicate_index = new_duplicate_index()
+    skip_duplicates = get_param("duplicate_policy", "skip").lower() == "skip"
+    listed_info = {}
+    for video_url in stream_input_urls(lines, result["failed_listings"], listed_info):
+        video_id = video_id_from_url(video_url)
+        result["listed"].add(video_id)
+        if video_id in skip_ids:
+            continue
+        entry = downloaded.get(video_id)
+        if entry is not None:
+            if announce_present:
+                print(colortxt("B", f"Video already downloaded: {os.path.basename(entry['path'])}"))
+                print(colortxt("B", f"  Metadata: {entry['artist']} - {entry['title']}"))
+                print(colortxt("B", f"  URL: {video_url}"))
+            result["expected_files"].add(entry['path'])
+            if on_passed is not None:
+                on_passed(video_url, "present", entry['path'])
+        elif run.failure_cache is not None and (failure := run.failure_cache.blocked(video_id)):
+            result["skipped"].add(video_id)
+            if on_passed is not None:
+                on_passed(video_url, "skipped", failure)
+        else:
+            duplicate = duplicate_index.check(video_id, listed_info.pop(video_id, None)) if duplicate_index is not None else None
+            if duplicate is not None:
+                result["duplicates"][video_id] = duplicate
+                other = os.path.basename(duplicate['path']) if 'path' in duplicate else f"video {duplicate['video_id']}"
+                print(colortxt("Y", f"{video_url} looks like a duplicate of {other}{', skipped' if skip_duplicates else ''}."))
+                if skip_duplicates:
+                    if 'path' in duplicate:
+                        result["expected_files"].add(duplicate['path']) # keep the copy we have
+                    if on_passed is not None:
+                        on_passed(video_url, "duplicate", duplicate)
+                    continue
+            yield video_url
+
+def download_urls(urls, result, on_result=None, stop=None, on_processed=None):
+    """
+    Download, convert and tag the URLs, then embed their lyrics, recording the outcome in the result.
+
+    on_result, if given, is also called with (url, file_path) for every URL, file_path is None on failure.
+    stop, a threading.Event, drops the URLs that did not start yet once it is set.
+    on_processed, if given, is called with every URL as soon as the pipeline is done with it,
+    before its lyrics and (when staging) its copy to Songs.
+    """
+    transcode_threads = get_param("transcode_threads", os.cpu_count() or 4, int)
+    # Download videos in the network pool, convert and tag them in the CPU pool
+    lyrics_stage = new_lyrics_stage()
+    def finished(url, file_path):
+        if file_path is None:
+            result["failed"].add(video_id_from_url(url))
+        else:
+            result["expected_files"].add(file_path)
+            result["downloaded"] += 1
+        if on_result is not None:
+            on_result(url, file_path)
+    transfer_stage = new_transfer_stage(finished) if this_run().staging else None
+    def record_result(url, file_path):
+        if on_processed is not None:
+            on_processed(url)
+        if file_path is not None and transfer_stage is not None:
+            # a staged file is copied to Songs once it has its lyrics, and only then finished
+            context = contextvars.copy_context()
+            lyrics_stage.submit(file_path, lambda: context.run(transfer_stage.submit, url, file_path))
+            return
+        if file_path is not None:
+            lyrics_stage.submit(file_path)
+        finished(url, file_path)
+    result["new"] += len(run_pipeline(urls, this_run().download_limiter.workers_max, transcode_threads, record_result, stop))
+    print(colortxt("B", "Waiting for lyrics..."))
+    lyrics_stage.close()
+    if transfer_stage is not None:
+        transfer_stage.close()
+
+def sync(lines, skip_ids=frozenset(), announce_present=True):
+    """
+    Download every video of the input lines that is not in the library yet.
+
+    Args:
+        lines (list): Input lines, video and playlist URLs.
+        skip_ids (set): Video IDs to pass over without looking at them, e.g. the ones an earlier watch cycle handled.
+        announce_present (bool): Print every video that is already downloaded.
+
+    Returns:
+        dict: See new_sync_result().
+    """
+    refresh_library()
+    result = new_sync_result()
+    download_urls(plan_downloads(lines, result, skip_ids, announce_present), result)
+    print_sync_summary(result)
+    return result
+
+def print_sync_summary(result):
+    if result["skipped"]:
+        print(colortxt("Y", f"Skipped {len(result['skipped'])} videos that failed before, see --list-failures."))
+    if result["duplicates"]:
+        skip_duplicates = get_param("duplicate_policy", "skip").lower() == "skip"
+        print(colortxt("Y", f"{len(result['duplicates'])} videos look like duplicates of songs in the library or the input "
+                            f"({'skipped' if skip_duplicates else 'downloaded anyway'}, duplicate_policy={get_param('duplicate_policy', 'skip')})."))
+    print(colortxt("B", f"{len(result['listed'])} videos in the input, downloaded {result['downloaded']} of {result['new']} new videos."))
 
 def main():
     print(colortxt("B", "Starting YouTube Video Downloader..."))
@@ -463,77 +2388,499 @@ def main():
     #read the input URL from the file 
     with open(input_file_path, 'r') as f:
         input_url = f.read().strip()
+    asyncio.run(sync_input(input_url.splitlines()))
+
+async def sync_input(lines):
+    """ main()'s sync: the input lines through a Downloader of default_run, then the summary and the orphans. """
+    async with Downloader(default_run) as downloader:
+        result = new_sync_result()
+        async for _ in downloader.sync(lines, result):
+            pass # every track is printed by the pipeline
+        run = downloader.run
+        run.run_metrics.summary()
+        print(colortxt("C", f"Ended with {run.download_limiter.limit} concurrent downloads, {run.download_limiter.fragments} fragments each."))
+        await downloader.execute(reconcile, result)
+
+def find_orphans(expected_files):
+    """ Files in Songs that are not in expected_files, found with a set difference. """
+    expected = {os.path.normcase(os.path.abspath(path)) for path in expected_files}
+    return sorted(entry.path for entry in os.scandir(this_run().songs_path)
+                  if entry.is_file() and not is_index_file(entry.name)
+                  and os.path.normcase(os.path.abspath(entry.path)) not in expected)
+
+def quarantine_file(file_path, quarantine_path):
+    """ Move a file into the quarantine directory without overwriting anything there, returns its new path. """
+    name, ext = os.path.splitext(os.path.basename(file_path))
+    target = os.path.join(quarantine_path, name + ext)
+    count = 1
+    while os.path.exists(target):
+        count += 1
+        target = os.path.join(quarantine_path, f"{name} ({count}){ext}")
+    shutil.move(file_path, target)
+    return target
+
+def reconcile(result):
+    """
+    Apply orphan_policy to the files in Songs that are not in the input, all in one batch and without prompts.
 
-    threads = 20 #number of threads to use
+    orphan_policy is keep (the default, only reported), quarantine (moved to quarantine_path)
+    or delete. Nothing is touched when a playlist could not be listed, since its files would
+    look like orphans. Every orphan and what happened to it goes to cache/orphans.json.
+    """
+    run = this_run()
+    policy = get_param("orphan_policy", "keep").lower()
+    if policy not in ("keep", "quarantine", "delete"):
+        print(colortxt("R", f"Unknown orphan_policy '{policy}' in {params_file_path}, keeping the files."))
+        policy = "keep"
+    orphans = find_orphans(result["expected_files"])
+    if result["failed_listings"] and policy != "keep":
+        print(colortxt("Y", f"{len(result['failed_listings'])} playlists could not be listed, orphaned files are kept this time."))
+        policy = "keep"
+    quarantine_path = normalize_path(get_param("quarantine_path", "Quarantine"))
+    if orphans and policy == "quarantine":
+        os.makedirs(quarantine_path, exist_ok=True)
+
+    report = []
+    for file_path in orphans:
+        item = {"path": file_path, "action": policy}
+        try:
+            if policy == "quarantine":
+                item["moved_to"] = quarantine_file(file_path, quarantine_path)
+            elif policy == "delete":
+                os.remove(file_path)
+            if policy != "keep":
+                run.library_index.remove(file_path)
+        except Exception as e:
+            item["action"], item["error"] = "keep", str(e)
+            print(colortxt("R", f"Error applying orphan_policy={policy} to {os.path.basename(file_path)}: {e}"))
+        report.append(item)
 
-    url_list = []
-    for line in input_url.splitlines():
-        line = line.strip()
-        if not line or line.startswith('#'):  # Skip empty lines and comments
-            continue
-        if is_video(line):
-            url_list.append(line)
-        elif is_playlist(line):
-            playlist_urls = get_playlist_videos(line).splitlines()
-            for i in range(len(playlist_urls)):
-                playlist_urls[i] = "https://www.youtube.com/watch?v=" + playlist_urls[i]
-            url_list.extend(playlist_urls)
-        else:
-            print(colortxt("R", f"Invalid URL: {line}"))
+    report_path = os.path.join(run.cache_path, "orphans.json")
+    try:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "policy": policy, "orphans": report}, f, indent=2, ensure_ascii=False)
+    except OSError as e:
+        print(colortxt("R", f"Error writing {report_path}: {e}"))
+    if orphans:
+        done = sum(1 for item in report if item["action"] == policy)
+        verb = {"keep": "kept", "quarantine": f"moved to {quarantine_path}", "delete": "deleted"}[policy]
+        print(colortxt("Y", f"{len(orphans)} files in {run.songs_path} are not in the input, {done} {verb}. See {report_path}."))
+    return report
+
+def watch():
+    """
+    Stay running and keep Songs in sync with _Input.txt, without any prompts.
+
+    The library index, job journal, art cache, download limiter and yt-dlp engine stay open between
+    cycles. A cycle starts when _Input.txt changes or every watch_interval_minutes to pick up new
+    playlist entries. Playlists are listed in full on every poll, since YouTube has no "added since"
+    listing and new entries can show up anywhere in a playlist, but every video ID the previous
+    cycle already handled is passed over, so only the new IDs reach the library lookup and the
+    downloads. Failed videos are tried again after watch_retry_minutes, and everything is looked
+    at again when _Input.txt changes. Every cycle also runs the yt-dlp update check, which updates
+    at most once per update_check_hours. Files that are not in the input are left alone. Stop with Ctrl+C.
+    """
+    run = this_run()
+    interval = get_param("watch_interval_minutes", 15, float) * 60
+    retry_after = get_param("watch_retry_minutes", 60, float) * 60
+    print(colortxt("B", f"Watching {input_file_path}, playlists are checked every {interval / 60:g} minutes. Press Ctrl+C to stop."))
+    open_run()
+    input_mtime = None
+    next_poll = 0
+    known = set() # video IDs listed and handled by the previous cycle
+    failed = {} # video ID -> time of its last failed download
+    try:
+        while True:
+            mtime = os.path.getmtime(input_file_path) if os.path.exists(input_file_path) else None
+            if mtime == input_mtime and time.time() < next_poll:
+                time.sleep(2)
+                continue
+            if mtime != input_mtime and input_mtime is not None:
+                print(colortxt("B", f"{input_file_path} changed, syncing..."))
+                known.clear()
+                failed.clear()
+            input_mtime = mtime
+            next_poll = time.time() + interval
+            start_update_check() # a long watch keeps yt-dlp up to date too, at most once per update_check_hours
+            try:
+                with open(input_file_path, 'r') as f:
+                    lines = f.read().splitlines()
+            except OSError as e:
+                print(colortxt("Y", f"Could not read {input_file_path}, trying again at the next check: {e}"))
+                continue
+
+            now = time.time()
+            retry = {video_id for video_id, failed_at in failed.items() if now - failed_at >= retry_after}
+            result = sync(lines, known - retry, announce_present=not known)
+            if known:
+                print(colortxt("B", f"{len(result['listed'] - known)} videos added and {len(known - result['listed'])} removed since the last check."))
+            known = result["listed"]
+            for video_id in retry - result["failed"]:
+                del failed[video_id]
+            failed.update((video_id, now) for video_id in result["failed"])
+            if result["new"]:
+                run.run_metrics.summary()
+            run.run_metrics.reset()
+            run.job_journal.clean()
+            print(colortxt("B", f"Next check at {time.strftime('%H:%M', time.localtime(next_poll))}."))
+    except KeyboardInterrupt:
+        print(colortxt("B", "Stopping..."))
+    finally:
+        close_run()
+
+def open_job_queue():
+    """ The shared JobQueue at queue_path, next to the library in Songs by default. """
+    return JobQueue(normalize_path(get_param("queue_path", os.path.join(this_run().songs_path, QUEUE_FILENAME))),
+                    lease_seconds=get_param("queue_lease_seconds", 120, float),
+                    max_attempts=get_param("queue_max_attempts", 3, int))
+
+def coordinate():
+    """
+    Coordinator of the shared job queue (--coordinator): list the input and queue every video the library
+    doesn't have for the workers (--worker, on any host that sees the same Songs), then wait for them.
 
-    # Remove duplicates
-    url_list = list(set(url_list))
+    Nothing is downloaded here. Once every job is done or failed the orphans are reconciled like in main().
+    """
+    with open(input_file_path, 'r') as f:
+        lines = f.read().splitlines()
+    open_run()
+    job_queue = open_job_queue()
+    poll = get_param("queue_poll_seconds", 5, float)
+    try:
+        refresh_library()
+        result = new_sync_result()
+        job_queue.start_listing()
+        queued = []
+        batch = []
+        flushed_at = time.time()
+        for url in plan_downloads(lines, result):
+            batch.append(url)
+            # in batches, so a long listing costs a few transactions but the workers can start early
+            if len(batch) >= 50 or time.time() - flushed_at > 2:
+                job_queue.enqueue(batch)
+                queued += batch
+                batch = []
+                flushed_at = time.time()
+        job_queue.enqueue(batch)
+        queued += batch
+        job_queue.finish_listing()
+        print_sync_summary(result)
+        print(colortxt("B", f"Queued {len(queued)} videos in {job_queue.path}, waiting for the workers..."))
+
+        last_stats = None
+        while not job_queue.drained():
+            stats = job_queue.stats()
+            if stats != last_stats:
+                print(colortxt("C", f"{stats['done']} done, {stats['leased']} in progress, {stats['pending']} waiting, "
+                                    f"{stats['failed']} failed, {len(stats['workers'])} workers"))
+                last_stats = stats
+            time.sleep(poll)
+
+        jobs = job_queue.results()
+        for video_id in map(video_id_from_url, queued):
+            job = jobs.get(video_id, {})
+            if job.get('state') == "done" and job.get('file'):
+                result["expected_files"].add(job['file'])
+                result["downloaded"] += 1
+            else:
+                result["failed"].add(video_id)
+        print(colortxt("B", f"The workers downloaded {result['downloaded']} of {len(queued)} queued videos, {len(result['failed'])} failed."))
+        refresh_library()
+        reconcile(result)
+    finally:
+        job_queue.close()
+        close_run()
+
+def work():
+    """
+    Worker of the shared job queue (--worker): claim a few jobs at a time, download them into Songs
+    like main() does and report every result, until the coordinator's queue is drained.
 
-    expected_files = []
-    # Remove videos that are already downloaded
-    for file in os.listdir(songs_path):
-        file_path = os.path.abspath(os.path.join(songs_path, file))
-        if os.path.isfile(file_path):
+    A heartbeat thread keeps the leases of the claimed jobs alive. Several workers can run on the same
+    or on other hosts, each in its own working directory (Temp, cache) with the same output in _Params.txt.
+    """
+    open_run()
+    run = this_run()
+    job_queue = open_job_queue()
+    batch_size = get_param("queue_batch", 4, int)
+    poll = get_param("queue_poll_seconds", 5, float)
+    stop = threading.Event()
+    backlog = threading.Condition()
+    in_progress = set() # claimed URLs the pipeline is not done with
+    def send_heartbeats():
+        while not stop.wait(job_queue.lease_seconds / 4):
             try:
-                video_url = read_url_metadata(file_path)
-                if video_url in url_list:
-                    url_list.remove(video_url)
-                    
-                    print(colortxt("B", f"Video already downloaded: {file}"))
-                    print(colortxt("B", f"  Metadata: {read_metadata(file_path)}"))
-                    print(colortxt("B", f"  URL: {video_url}"))
-                    expected_files.append(file_path)
-            except Exception as e:
-                print(colortxt("R", f"Error reading metadata for {file_path}: {e}"))
-                continue
-    
-    print(colortxt("B", f"Found {len(url_list)} videos to download."))
-    effective_threads = min(threads, len(url_list), 50)
-    # Download videos using multithreading
-    if effective_threads > 0:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=effective_threads) as executor:
-            future_to_url = {executor.submit(download_video, url): url for url in url_list}
-            for future in concurrent.futures.as_completed(future_to_url):
-                #future.result()
-                file_path = future.result()
-                expected_files.append(file_path)
-
-    # ask user if they want to delete songs not in expected_files
-    for file in os.listdir(songs_path):
-        file_path = os.path.abspath(os.path.join(songs_path, file))
-        if os.path.isfile(file_path):
-            if file_path not in expected_files:
-                print(colortxt("Y", f"File {file} not in expected files."))
-                delete = input(colortxt("Y", f"Do you want to delete {file}? (y/n) "))
-                if delete.lower() == 'y':
-                    try:
-                        os.remove(file_path)
-                        print(colortxt("B", f"Deleted {file}."))
-                    except Exception as e:
-                        print(colortxt("R", f"Error deleting file {file}: {e}"))
-    
-    clean_directory(temp_path)  # Clean up Temp setupdirectory
+                job_queue.heartbeat()
+            except sqlite3.Error as e:
+                print(colortxt("R", f"Error sending a heartbeat to the job queue: {e}"))
+
+    def claimed_urls():
+        # the pipeline's feeder would take jobs as fast as it can queue them, so only claim more once
+        # no more than batch_size of this worker's jobs are waiting for one of its download slots
+        while True:
+            with backlog:
+                while (count := min(batch_size, batch_size + run.download_limiter.limit - len(in_progress))) <= 0:
+                    backlog.wait(1) # the limit may change too
+            urls = job_queue.claim(count)
+            if urls:
+                with backlog:
+                    in_progress.update(urls)
+                yield from urls
+            elif job_queue.drained():
+                return
+            else:
+                time.sleep(poll) # the rest is leased to other workers, their leases may still expire
+
+    def processed(url):
+        with backlog:
+            in_progress.discard(url)
+            backlog.notify_all()
+
+    def report(url, file_path):
+        if file_path is not None:
+            if not job_queue.complete(url, file_path):
+                print(colortxt("Y", f"The lease of {url} expired before it finished, another worker may download it too."))
+            return
+        entry = cached_failure(url)
+        if entry is None:
+            job_queue.fail(url, "failed, see the worker's console")
+        else:
+            job_queue.fail(url, entry['error'], retry=entry['class'] == "transient")
+
+    print(colortxt("B", f"Worker {job_queue.worker} waiting for jobs. Press Ctrl+C to stop."))
+    job_queue.heartbeat()
+    threading.Thread(target=send_heartbeats, daemon=True).start()
+    result = new_sync_result()
     try:
-        os.rmdir(temp_path)
-    except OSError as e:
-        print(colortxt("R", f"Error deleting temp directory: {e}"))
+        download_urls(claimed_urls(), result, report, on_processed=processed)
+        this_run().run_metrics.summary()
+        print(colortxt("B", f"Queue drained, this worker downloaded {result['downloaded']} of {result['new']} videos."))
+    except KeyboardInterrupt:
+        print(colortxt("B", "Stopping, unfinished jobs go back to the queue..."))
+    finally:
+        stop.set()
+        job_queue.release()
+        job_queue.close()
+        close_run()
+
+
+def rebuild_index():
+    """ Rebuild the library index from scratch by reading every file in Songs. """
+    index = open_library_index()
+    stats = index.rebuild()
+    index.close()
+    print(colortxt("B", f"Library index rebuilt: {stats['files']} files indexed."))
+
+def verify_index():
+    """ Compare the library index with the files in Songs and fix any stale entries. """
+    index = open_library_index()
+    problems = index.verify()
+    index.close()
+    for path, problem in problems:
+        print(colortxt("Y", f"{problem}: {path}"))
+    if problems:
+        print(colortxt("Y", f"Library index had {len(problems)} problems, all fixed."))
+    else:
+        print(colortxt("G", "Library index is up to date."))
+
+def verify_library():
+    """
+    Check every audio file in Songs in a process pool and download the broken ones again, see integrity.py.
+
+    Results are cached in cache/verify.sqlite by size and mtime, so only new and changed files
+    are read. With verify_policy=requeue (the default) broken files that have a video URL are
+    moved to quarantine_path and downloaded again, report only lists them. Every file with a
+    problem and what happened to it goes to cache/verify.json.
+    """
+    run = this_run()
+    policy = get_param("verify_policy", "requeue").lower()
+    if policy not in ("requeue", "report"):
+        print(colortxt("R", f"Unknown verify_policy '{policy}' in {params_file_path}, only reporting."))
+        policy = "report"
+    open_run()
+    try:
+        refresh_library()
+        entries = [entry for entry in run.library_index.entries() if is_audio_file(entry['path'])]
+        cache = VerifyCache(os.path.join(run.cache_path, "verify.sqlite"))
+        try:
+            cached = cache.results()
+            results = {}
+            changed = []
+            for entry in entries:
+                size, mtime_ns, result = cached.get(entry['path'], (None, None, None))
+                if (size, mtime_ns) == (entry['size'], entry['mtime_ns']):
+                    results[entry['path']] = result
+                else:
+                    changed.append(entry)
+            print(colortxt("B", f"Verifying {len(changed)} of {len(entries)} files, the others did not change since they were last checked."))
+
+            tolerance = get_param("verify_duration_tolerance", 3, float)
+            # a process costs more to start than a few files take to check
+            processes = max(1, min(get_param("verify_processes", os.cpu_count() or 4, int), len(changed) // 8))
+            with stage_timer("verify", files=len(changed), processes=processes), contextlib.ExitStack() as stack:
+                paths = [entry['path'] for entry in changed]
+                if processes > 1:
+                    pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=processes))
+                    checked = pool.map(check_audio_file, paths, [tolerance] * len(paths), chunksize=8)
+                else:
+                    checked = map(check_audio_file, paths, [tolerance] * len(paths))
+                batch = []
+                for entry, result in zip(changed, checked):
+                    results[entry['path']] = result
+                    if result['status'] != "error": # unreadable right now, try again next time
+                        batch.append((entry['path'], entry['size'], entry['mtime_ns'], result))
+                    if len(batch) >= 100:
+                        cache.store(batch)
+                        batch = []
+                cache.store(batch)
+            cache.prune([entry['path'] for entry in entries])
+        finally:
+            cache.close()
+
+        quarantine_path = normalize_path(get_param("quarantine_path", "Quarantine"))
+        report = []
+        urls = []
+        for path, result in sorted(results.items()):
+            if result['status'] == "ok":
+                continue
+            item = {"path": path, "status": result['status'], "problems": result['problems'], "action": "reported"}
+            if policy == "requeue" and result['status'] == "broken" and video_id_from_url(result['url']) is not None:
+                try:
+                    os.makedirs(quarantine_path, exist_ok=True)
+                    item["moved_to"] = quarantine_file(path, quarantine_path)
+                    run.library_index.remove(path)
+                    item["action"] = "requeued"
+                    urls.append(result['url'])
+                except Exception as e:
+                    item["error"] = str(e)
+                    print(colortxt("R", f"Error moving {os.path.basename(path)} to {quarantine_path}: {e}"))
+            print(colortxt("R" if result['status'] == "broken" else "Y", f"{os.path.basename(path)}: {'; '.join(result['problems'])}"))
+            report.append(item)
+
+        report_path = os.path.join(run.cache_path, "verify.json")
+        try:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "policy": policy, "files": report}, f, indent=2, ensure_ascii=False)
+        except OSError as e:
+            print(colortxt("R", f"Error writing {report_path}: {e}"))
+        broken = sum(1 for item in report if item["status"] == "broken")
+        print(colortxt("Y" if report else "G", f"{len(entries)} files verified: {broken} broken, {len(report) - broken} with tag problems. See {report_path}."))
+
+        if urls:
+            print(colortxt("B", f"Downloading {len(urls)} broken songs again, the old files are in {quarantine_path}..."))
+            sync_result = new_sync_result()
+            download_urls(urls, sync_result)
+            print(colortxt("B", f"Downloaded {sync_result['downloaded']} of {len(urls)} broken songs again."))
+    finally:
+        close_run()
+    return report
+
+def dry_run(output):
+    """ Print (output "-") or write the sync plan for _Input.txt as JSON, nothing is downloaded or deleted. """
+    run = this_run()
+    run.library_index = open_library_index()
+    run.library_index.refresh()
+    run.failure_cache = FailureCache(os.path.join(run.cache_path, "failures.sqlite"))
+    # the same planning a sync does, every video it passes over is recorded by its status
+    result = new_sync_result()
+    plan = {"to_download": [], "already_present": {}, "skipped": {}, "duplicates": {}, "orphaned": [], "failed_listings": []}
+    sections = {"present": "already_present", "skipped": "skipped", "duplicate": "duplicates"}
+    def passed(url, status, detail):
+        plan[sections[status]][url] = detail
+    with open(input_file_path, 'r') as f:
+        plan["to_download"] = list(plan_downloads(f.read().splitlines(), result, announce_present=False, on_passed=passed))
+    # with duplicate_policy=download duplicates are downloaded anyway, but still listed
+    for video_id, duplicate in result["duplicates"].items():
+        plan["duplicates"].setdefault(video_url(video_id), duplicate)
+    plan["orphaned"] = sorted(entry['path'] for entry in run.library_index.entries() if entry['path'] not in result["expected_files"])
+    plan["failed_listings"] = result["failed_listings"]
+    run.failure_cache.close()
+    run.library_index.close()
+
+    if output == "-":
+        print(json.dumps(plan, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(plan, f, indent=2)
+    print(colortxt("B", f"Plan: {len(plan['to_download'])} to download, {len(plan['already_present'])} already present, "
+                        f"{len(plan['skipped'])} skipped after failing, {len(plan['duplicates'])} duplicates, {len(plan['orphaned'])} orphaned."))
+
+def list_failures():
+    """ Print every entry of the failure cache, the ones that are skipped right now first. """
+    cache = FailureCache(os.path.join(this_run().cache_path, "failures.sqlite"))
+    entries = sorted(cache.entries.values(), key=retry_time, reverse=True)
+    cache.close()
+    now = time.time()
+    for entry in entries:
+        skipped = retry_time(entry) > now
+        retry = time.strftime('%Y-%m-%d %H:%M', time.localtime(retry_time(entry))) if skipped else "next run"
+        print(colortxt("Y" if skipped else "B",
+                       f"{video_url(entry['video_id'])}  {entry['class']}, failed {entry['failures']}x, retry {retry}: {entry['error']}"))
+    print(colortxt("B", f"{len(entries)} videos in the failure cache, {sum(1 for entry in entries if retry_time(entry) > now)} skipped right now."))
+
+def clear_failures(keys):
+    """ Drop failure cache entries by video ID, URL or failure class, or all of them, so they are tried on the next run. """
+    cache = FailureCache(os.path.join(this_run().cache_path, "failures.sqlite"))
+    dropped = cache.clear({video_id_from_url(key) or key for key in keys})
+    cache.close()
+    print(colortxt("G", f"Cleared {dropped} entries from the failure cache."))
+
+def lyrics_backfill():
+    """ Look up and embed lyrics for every song in the library that has none yet. """
+    run = this_run()
+    run.library_index = open_library_index()
+    run.library_index.refresh()
+    files = [entry['path'] for entry in run.library_index.entries() if is_audio_file(entry['path'])]
+    print(colortxt("B", f"Checking lyrics for {len(files)} songs..."))
+    lyrics_stage = new_lyrics_stage(skip_existing=True)
+    for file_path in files:
+        lyrics_stage.submit(file_path)
+    embedded = lyrics_stage.close()
+    run.library_index.close()
+    print(colortxt("G", f"Lyrics embedded for {embedded} songs."))
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # --verify's process pool in the PyInstaller .exe
+    parser = argparse.ArgumentParser(description="Download the music listed in _Input.txt")
+    parser.add_argument("--rebuild-index", action="store_true", help="rebuild the library index and exit")
+    parser.add_argument("--verify-index", action="store_true", help="check the library index against Songs and exit")
+    parser.add_argument("--verify", action="store_true", help="check every song for truncated or corrupt audio and tag problems, download the broken ones again and exit")
+    parser.add_argument("--plan", "--dry-run", nargs="?", const="-", metavar="FILE",
+                        help="write what a sync would download, keep and delete as JSON (to FILE or the console) and exit")
+    parser.add_argument("--lyrics-backfill", action="store_true", help="add lyrics to every song in Songs that has none and exit")
+    parser.add_argument("--watch", action="store_true", help="keep running and sync whenever _Input.txt changes or playlists get new videos")
+    parser.add_argument("--coordinator", action="store_true", help="queue the downloads in the shared job queue for --worker processes and wait for them")
+    parser.add_argument("--worker", action="store_true", help="download jobs from the shared job queue until it is drained")
+    parser.add_argument("--list-failures", action="store_true", help="list the videos that failed to download and when they are tried again, and exit")
+    parser.add_argument("--clear-failures", nargs="*", metavar="ID_OR_CLASS",
+                        help="forget failed downloads (video IDs, URLs or classes like private, all if none given) and exit")
+    args = parser.parse_args()
+
     setup()
-    main()
-    input("Press Enter to exit...")
\ No newline at end of file
+    if args.rebuild_index:
+        rebuild_index()
+    elif args.verify_index:
+        verify_index()
+    elif args.verify:
+        verify_library()
+    elif args.plan:
+        dry_run(args.plan)
+    elif args.lyrics_backfill:
+        lyrics_backfill()
+    elif args.coordinator or args.worker:
+        coordinate() if args.coordinator else work()
+        wait_for_update()
+        sys.exit(0) # no one is waiting at the console
+    elif args.list_failures:
+        list_failures()
+    elif args.clear_failures is not None:
+        clear_failures(args.clear_failures)
+    elif args.watch:
+        watch()
+        wait_for_update()
+        sys.exit(0) # no one is waiting at the console
+    else:
+        main()
+    if sys.stdin is not None and sys.stdin.isatty(): # headless runs (scheduled tasks, pipes) just exit
+        input("Press Enter to exit...")
+    wait_for_update() # let a running yt-dlp -U finish replacing yt-dlp.exe
\ No newline at end of file